@@ -0,0 +1,128 @@
+import json
+from collections import deque
+
+# === アラーム判定ルールエンジン ===
+# 閾値変更（app.py）と説明欄追加（説明欄追加/app.py）で共通に使う。
+#
+# ルール（dict）:
+#   "match":    (ComparisonOperator, Threshold)  省略時はすべての演算子・閾値に一致
+#   "exact":    MetricName の完全一致
+#   "contains": MetricName（小文字化）に含まれるべき文字列のリスト（すべて含むこと）
+#   それ以外のキー（"set", "desc_env" など）は呼び出し側が使う
+#
+# ルールは (演算子, 閾値) → 完全一致メトリクス名 の索引と、
+# 部分一致語句の Aho-Corasick オートマトンに事前コンパイルする。
+# 判定はリスト順で最初に一致したルールを返す（従来の for ループと同じ優先順位）。
+
+class _Automaton:
+    """複数語句の同時部分一致（Aho-Corasick）。テキスト1回の走査で含まれる語句の集合を返す"""
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+        for w in words:
+            node = 0
+            for ch in w:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(set())
+                node = nxt
+            self.out[node].add(w)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                # 1文字目のノードの fail は根
+                target = self.goto[f].get(ch, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.out[nxt] |= self.out[self.fail[nxt]]
+
+    def find(self, text):
+        found = set()
+        node = 0
+        for ch in text:
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            if self.out[node]:
+                found |= self.out[node]
+        return found
+
+def _match_key(rule):
+    m = rule.get("match")
+    if m is None:
+        return None
+    op, thr = m
+    return (op, float(thr))
+
+class RuleSet:
+    """ルール列を索引化して、アラーム1件を O(語句長 + 候補ルール数) で判定する"""
+    def __init__(self, rules):
+        self.rules = [self._normalize(r) for r in rules]
+        # (演算子, 閾値) or None（ワイルドカード） → {"exact": {名前: [順位]}, "contains": [順位], "any": [順位]}
+        self.index = {}
+        words = set()
+        for pos, r in enumerate(self.rules):
+            bucket = self.index.setdefault(_match_key(r), {"exact": {}, "contains": [], "any": []})
+            words.update(r.get("contains") or ())
+            if "exact" in r:
+                bucket["exact"].setdefault(r["exact"], []).append(pos)
+            elif r.get("contains"):
+                bucket["contains"].append(pos)
+            else:
+                bucket["any"].append(pos)
+        self.automaton = _Automaton(sorted(words)) if words else None
+
+    @staticmethod
+    def _normalize(rule):
+        r = dict(rule)
+        if r.get("match") is not None:
+            r["match"] = tuple(r["match"])
+        if r.get("set") is not None:
+            r["set"] = tuple(r["set"])
+        if r.get("contains"):
+            r["contains"] = [t.lower() for t in r["contains"]]
+        return r
+
+    @classmethod
+    def from_file(cls, path, key=None):
+        """JSON ファイルからルールを読み込む（key 指定時はそのキーの配列を使う）"""
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data[key] if key else data)
+
+    def _contains_all(self, pos, found):
+        return all(t in found for t in self.rules[pos].get("contains") or ())
+
+    def _candidates(self, bucket, metric, found):
+        pos = list(bucket["any"])
+        pos.extend(p for p in bucket["exact"].get(metric, ()) if self._contains_all(p, found))
+        pos.extend(p for p in bucket["contains"] if self._contains_all(p, found))
+        return pos
+
+    def first_match(self, alarm):
+        """アラーム定義（MetricName / ComparisonOperator / Threshold）に最初に一致するルール"""
+        metric = alarm.get("MetricName") or ""
+        try:
+            key = (alarm.get("ComparisonOperator"), float(alarm.get("Threshold")))
+        except (TypeError, ValueError):
+            key = None
+        buckets = [b for b in (self.index.get(key) if key else None, self.index.get(None)) if b]
+        if not buckets:
+            return None
+        found = self.automaton.find(metric.lower()) if self.automaton else set()
+        best = None
+        for bucket in buckets:
+            for p in self._candidates(bucket, metric, found):
+                if best is None or p < best:
+                    best = p
+        return self.rules[best] if best is not None else None
@@ -1,30 +1,46 @@
-import os, json, urllib.parse, time
+import os, json, uuid
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.config import Config
+from alarm_rules import RuleSet
+from rate_limiter import RateLimiter  # ssm-auto-common レイヤー
 
 # === 環境変数 ===
 REGION = os.environ.get("AWS_REGION", "ap-northeast-1")
 FORCE_ONE = os.environ.get("FORCE_ONE_DATAPOINT", "false").lower() == "true"
 S3_BUCKET = os.environ.get("SNAPSHOT_S3_BUCKET")
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "8"))   # apply の並列数
+PUT_TPS = float(os.environ.get("PUT_TPS", "20"))        # PutMetricAlarm の送信レート上限（/秒）
+DESCRIBE_BATCH_SIZE = 100                               # DescribeAlarms の AlarmNames 上限
+RULES_FILE = os.environ.get("RULES_FILE")               # ルール定義JSON（{"update": [...], "rollback": [...]}）
 
-cw = boto3.client("cloudwatch", region_name=REGION)
+cw = boto3.client("cloudwatch", region_name=REGION,
+                  config=Config(retries={"max_attempts": 10, "mode": "adaptive"}))
 s3 = boto3.client("s3")
 
 # === 保存先キー ===
-def _s3_key(alarm_name: str) -> str:
-    enc = urllib.parse.quote(alarm_name, safe="")
-    return f"cw-alarm-backup/{REGION}/{enc}.json"
-
-def snapshot_merge_write(alarm_name: str, label: str, alarm_obj: dict):
-    key = _s3_key(alarm_name)
-    try:
-        cur = s3.get_object(Bucket=S3_BUCKET, Key=key)
-        data = json.loads(cur["Body"].read().decode("utf-8"))
-    except Exception:
-        data = {}
-    data[label] = alarm_obj
+# 1回の実行（run_id）ごとに計画・スナップショットを1オブジェクトにまとめる
+def _plan_key(run_id: str) -> str:
+    return f"cw-alarm-plans/{REGION}/{run_id}.json"
+
+def _snapshot_key(run_id: str) -> str:
+    return f"cw-alarm-backup/{REGION}/runs/{run_id}.json"
+
+def _result_key(run_id: str) -> str:
+    return f"cw-alarm-backup/{REGION}/runs/{run_id}.result.json"
+
+def _new_run_id(mode: str) -> str:
+    return f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{mode}-{uuid.uuid4().hex[:8]}"
+
+def s3_write_json(key: str, data: dict):
     body = json.dumps(data, ensure_ascii=False).encode("utf-8")
     s3.put_object(Bucket=S3_BUCKET, Key=key, Body=body, ContentType="application/json")
 
+def s3_read_json(key: str) -> dict:
+    cur = s3.get_object(Bucket=S3_BUCKET, Key=key)
+    return json.loads(cur["Body"].read().decode("utf-8"))
+
 # === 引数生成（説明を含む完全形） ===
 def build_put_args_from(a: dict) -> dict:
     stat, estat = a.get("Statistic"), a.get("ExtendedStatistic")
@@ -83,6 +99,14 @@ INVERT_RULES = [
      "contains": ["windows", "service", "status"]},
 ]
 
+# 事前コンパイル済みのルール索引（RULES_FILE 指定時はファイルのルールを使う）
+if RULES_FILE:
+    UPDATE_RULESET = RuleSet.from_file(RULES_FILE, "update")
+    INVERT_RULESET = RuleSet.from_file(RULES_FILE, "rollback")
+else:
+    UPDATE_RULESET = RuleSet(UPDATE_RULES)
+    INVERT_RULESET = RuleSet(INVERT_RULES)
+
 # === 共通関数 ===
 def describe_all_metric_alarms():
     p = cw.get_paginator("describe_alarms")
@@ -92,20 +116,15 @@ def describe_all_metric_alarms():
                 continue
             yield a
 
-def describe_alarm_by_name(name: str):
-    r = cw.describe_alarms(AlarmNames=[name])
-    lst = r.get("MetricAlarms", [])
-    return lst[0] if lst else None
-
-def _matches(a, rule):
-    metric = a["MetricName"]
-    if "exact" in rule and metric != rule["exact"]:
-        return False
-    if "contains" in rule:
-        m = (metric or "").lower()
-        if not all(t in m for t in rule["contains"]):
-            return False
-    return True
+def describe_alarms_by_names(names):
+    """100 件ずつまとめて取得し、名前 → 定義の dict を返す"""
+    found = {}
+    p = cw.get_paginator("describe_alarms")
+    for i in range(0, len(names), DESCRIBE_BATCH_SIZE):
+        for page in p.paginate(AlarmNames=names[i:i + DESCRIBE_BATCH_SIZE], AlarmTypes=["MetricAlarm"]):
+            for a in page.get("MetricAlarms", []):
+                found[a["AlarmName"]] = a
+    return found
 
 def _apply(a, rule):
     op, thr = a["ComparisonOperator"], float(a["Threshold"])
@@ -121,56 +140,142 @@ def _apply(a, rule):
         put["DatapointsToAlarm"] = 1
     return put
 
-# === アクション ===
-def do_update(prefix, dry_run):
-    res = []
+# === 計画（plan）===
+def _pick(a, ruleset):
+    r = ruleset.first_match(a)
+    return _apply(a, r) if r else None
+
+def build_plan(mode, prefix):
+    """1回の一覧取得でルール判定し、変更対象だけの差分マニフェストを作る（書き込みはしない）"""
+    rules = UPDATE_RULESET if mode == "update" else INVERT_RULESET
+    changes, skipped = [], 0
     for a in describe_all_metric_alarms():
         if prefix and not a["AlarmName"].startswith(prefix):
             continue
-        before = build_put_args_from(a)
-        snapshot_merge_write(a["AlarmName"], "before", before)
-        updated = None
-        for r in UPDATE_RULES:
-            if not _matches(a, r):
-                continue
-            u = _apply(a, r)
-            if u:
-                updated = u
-                break
-        if not updated:
-            res.append({"name": a["AlarmName"], "status": "skip"})
+        after = _pick(a, rules)
+        if not after:
+            skipped += 1
             continue
-        if not dry_run:
-            cw.put_metric_alarm(**updated)
-        after_live = describe_alarm_by_name(a["AlarmName"]) if not dry_run else updated
-        snapshot_merge_write(a["AlarmName"], "after", build_put_args_from(after_live))
-        res.append({"name": a["AlarmName"], "from": before["Threshold"], "to": updated["Threshold"], "dry_run": dry_run})
-        time.sleep(0.05)
-    return {"result": "updated", "count": len(res), "items": res}
+        changes.append({"name": a["AlarmName"], "before": build_put_args_from(a), "after": after})
+    return {
+        "run_id": _new_run_id(mode),
+        "mode": mode,
+        "region": REGION,
+        "name_prefix": prefix,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "skipped": skipped,
+        "changes": changes,
+    }
+
+# === 適用（apply）===
+def apply_plan(plan):
+    """
+    計画を並列・レート制限付きで適用する。
+    適用前に現行定義をまとめて取得し、計画時から変わっているアラームは上書きしない（drifted）。
+    スナップショット（before と適用予定の after）は PutMetricAlarm を送る前に保存し、
+    途中でタイムアウト・異常終了しても切り戻せるようにする。完了結果は別オブジェクトに保存する。
+    """
+    changes = plan["changes"]
+    names = [c["name"] for c in changes]
+    live = describe_alarms_by_names(names)
+
+    todo, drifted, missing = [], [], []
+    for c in changes:
+        cur = live.get(c["name"])
+        if cur is None:
+            missing.append(c["name"])
+        elif build_put_args_from(cur) != c["before"]:
+            drifted.append(c["name"])
+        else:
+            todo.append(c)
+
+    # 1件も変更しないうちに切り戻し用のデータを残す
+    s3_write_json(_snapshot_key(plan["run_id"]), {
+        "run_id": plan["run_id"],
+        "mode": plan["mode"],
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "before": {c["name"]: c["before"] for c in todo},
+        "planned": {c["name"]: c["after"] for c in todo},
+    })
+
+    limiter = RateLimiter(PUT_TPS)
+
+    def _put(c):
+        try:
+            limiter.acquire()
+            cw.put_metric_alarm(**c["after"])
+            return c["name"], None
+        except Exception as e:
+            return c["name"], str(e)
+
+    applied, errors = [], []
+    if todo:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(todo))) as ex:
+            for name, err in ex.map(_put, todo):
+                if err:
+                    errors.append({"name": name, "error": err})
+                else:
+                    applied.append(name)
+
+    # 反映後の定義もまとめて取得して完了記録に残す（このオブジェクトがなければ途中で止まった実行）
+    after_live = describe_alarms_by_names(applied)
+    s3_write_json(_result_key(plan["run_id"]), {
+        "run_id": plan["run_id"],
+        "mode": plan["mode"],
+        "applied_at": datetime.now(timezone.utc).isoformat(),
+        "applied": applied,
+        "errors": errors,
+        "after": {n: build_put_args_from(a) for n, a in after_live.items()},
+    })
+
+    by_name = {c["name"]: c for c in changes}
+    items = [{"name": n, "from": by_name[n]["before"]["Threshold"], "to": by_name[n]["after"]["Threshold"]}
+             for n in applied]
+    return {
+        "result": "updated" if plan["mode"] == "update" else "rolled_back",
+        "run_id": plan["run_id"],
+        "count": len(applied),
+        "items": items,
+        "drifted": drifted,
+        "missing": missing,
+        "errors": errors,
+        "snapshot_key": _snapshot_key(plan["run_id"]),
+        "result_key": _result_key(plan["run_id"]),
+    }
+
+def _plan_summary(plan, plan_key=None):
+    return {
+        "result": "planned",
+        "run_id": plan["run_id"],
+        "mode": plan["mode"],
+        "plan_key": plan_key,
+        "count": len(plan["changes"]),
+        "skipped": plan["skipped"],
+        "items": [{"name": c["name"], "from": c["before"]["Threshold"], "to": c["after"]["Threshold"]}
+                  for c in plan["changes"]],
+    }
+
+# === アクション ===
+def do_update(prefix, dry_run):
+    plan = build_plan("update", prefix)
+    if dry_run:
+        return _plan_summary(plan)
+    return apply_plan(plan)
 
 def do_rollback(prefix, dry_run):
-    res = []
-    for a in describe_all_metric_alarms():
-        if prefix and not a["AlarmName"].startswith(prefix):
-            continue
-        restored = None
-        for r in INVERT_RULES:
-            if not _matches(a, r):
-                continue
-            rb = _apply(a, r)
-            if rb:
-                restored = rb
-                break
-        if not restored:
-            res.append({"name": a["AlarmName"], "status": "skip"})
-            continue
-        if not dry_run:
-            cw.put_metric_alarm(**restored)
-        after_live = describe_alarm_by_name(a["AlarmName"]) if not dry_run else restored
-        snapshot_merge_write(a["AlarmName"], "rollback", build_put_args_from(after_live))
-        res.append({"name": a["AlarmName"], "restored_to": restored["Threshold"], "dry_run": dry_run})
-        time.sleep(0.05)
-    return {"result": "rolled_back", "count": len(res), "items": res}
+    plan = build_plan("rollback", prefix)
+    if dry_run:
+        return _plan_summary(plan)
+    return apply_plan(plan)
+
+def do_plan(mode, prefix):
+    plan = build_plan(mode, prefix)
+    key = _plan_key(plan["run_id"])
+    s3_write_json(key, plan)
+    return _plan_summary(plan, key)
+
+def do_apply(plan_key):
+    return apply_plan(s3_read_json(plan_key))
 
 # === Lambda Handler ===
 def handler(event, context):
@@ -183,5 +288,15 @@ def handler(event, context):
         return do_update(prefix, dry_run)
     elif action == "rollback":
         return do_rollback(prefix, dry_run)
+    elif action == "plan":
+        mode = (event or {}).get("mode", "update")
+        if mode not in ("update", "rollback"):
+            return {"error": "mode must be update or rollback"}
+        return do_plan(mode, prefix)
+    elif action == "apply":
+        plan_key = (event or {}).get("plan_key")
+        if not plan_key:
+            return {"error": "plan_key is required"}
+        return do_apply(plan_key)
     else:
         return {"error": "unknown action"}
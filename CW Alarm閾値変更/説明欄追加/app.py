@@ -2,45 +2,42 @@ import os, json, time
 
 import boto3
 
+from alarm_rules import RuleSet  # ../alarm_rules.py をパッケージに同梱する（README 参照）
+
 REGION = os.environ.get("AWS_REGION", os.getenv("AWS_DEFAULT_REGION", "ap-northeast-1"))
+RULES_FILE = os.environ.get("RULES_FILE")  # ルール定義JSON（{"description": [...]}）
 cw = boto3.client("cloudwatch", region_name=REGION)
 
 # ---- 対象は「説明が空」かつ「テスト用しきい値」に一致するアラームのみ ----
-def is_windows_service(metric_name: str) -> bool:
-    m = metric_name.lower()
-    return ("windows" in m) and ("service" in m) and ("status" in m)
-
-def pick_description(a):
-    """各テスト閾値に対応する説明文を環境変数から取得。合致しなければ None。"""
-    metric = a["MetricName"]
-    op = a["ComparisonOperator"]
-    thr = float(a["Threshold"])
-
-    # Windowsサービス系は完全スキップ
-    if is_windows_service(metric):
-        return None
-
+# 閾値変更（../app.py）と同じルールエンジンで判定する。先に一致したルールが優先。
+DESCRIPTION_RULES = [
+    # Windowsサービス系は完全スキップ（演算子・閾値を問わない）
+    {"contains": ["windows", "service", "status"], "skip": True},
     # Disk: LogicalDisk % Free Space <= 99.5
-    if "% Free Space" in metric and op == "LessThanOrEqualToThreshold" and thr == 99.5:
-        return os.environ.get("DESC_DISK")
-
+    {"match": ("LessThanOrEqualToThreshold", 99.5), "contains": ["% free space"], "desc_env": "DESC_DISK"},
     # Memory: Memory Available Bytes <= 1,000,000,000,000
-    if metric == "Memory Available Bytes" and op == "LessThanOrEqualToThreshold" and thr == 1_000_000_000_000:
-        return os.environ.get("DESC_MEMORY")
-
+    {"match": ("LessThanOrEqualToThreshold", 1_000_000_000_000.0), "exact": "Memory Available Bytes",
+     "desc_env": "DESC_MEMORY"},
     # CPU: Processor % Processor Time > 1
-    if "% Processor Time" in metric and op == "GreaterThanThreshold" and thr == 1.0:
-        return os.environ.get("DESC_CPU")
-
+    {"match": ("GreaterThanThreshold", 1.0), "contains": ["% processor time"], "desc_env": "DESC_CPU"},
     # Status: Instance >= 0
-    if metric == "StatusCheckFailed_Instance" and op == "GreaterThanOrEqualToThreshold" and thr == 0.0:
-        return os.environ.get("DESC_STATUS_INSTANCE")
-
+    {"match": ("GreaterThanOrEqualToThreshold", 0.0), "exact": "StatusCheckFailed_Instance",
+     "desc_env": "DESC_STATUS_INSTANCE"},
     # Status: System >= 0
-    if metric == "StatusCheckFailed_System" and op == "GreaterThanOrEqualToThreshold" and thr == 0.0:
-        return os.environ.get("DESC_STATUS_SYSTEM")
+    {"match": ("GreaterThanOrEqualToThreshold", 0.0), "exact": "StatusCheckFailed_System",
+     "desc_env": "DESC_STATUS_SYSTEM"},
+]
 
-    return None
+DESCRIPTION_RULESET = RuleSet.from_file(RULES_FILE, "description") if RULES_FILE else RuleSet(DESCRIPTION_RULES)
+
+def pick_description(a):
+    """各テスト閾値に対応する説明文を取得（desc があればそれ、なければ desc_env の環境変数）。合致しなければ None。"""
+    rule = DESCRIPTION_RULESET.first_match(a)
+    if not rule or rule.get("skip"):
+        return None
+    if rule.get("desc"):
+        return rule["desc"]
+    return os.environ.get(rule["desc_env"]) if rule.get("desc_env") else None
 
 def build_put_args_from(a: dict) -> dict:
     """現定義を踏襲して説明だけ差し込む。"""
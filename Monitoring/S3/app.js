@@ -1,8 +1,14 @@
 // API GatewayのエンドポイントURL（最後のスラッシュは不要）
 const API_BASE_URL = 'https://YOUR_API_ID.execute-api.ap-northeast-1.amazonaws.com/prod';
 
+// 1ページあたりの取得件数
+const PAGE_LIMIT = 50;
+
 let allAlerts = [];
 let currentFilter = 'all';
+let nextToken = null;
+let summary = null;
+let selectedIds = new Set();
 
 // ページ読み込み時の初期化
 document.addEventListener('DOMContentLoaded', () => {
@@ -23,19 +29,67 @@ function setupFilterButtons() {
     });
 }
 
-// アラート一覧を取得
+// アラート一覧を1ページ取得
+async function fetchAlertsPage(token) {
+    const params = new URLSearchParams({ limit: PAGE_LIMIT });
+    if (token) {
+        params.set('next_token', token);
+    }
+    
+    const response = await fetch(`${API_BASE_URL}/alerts?${params.toString()}`);
+    
+    if (!response.ok) {
+        throw new Error(`HTTPエラー: ${response.status}`);
+    }
+    
+    return response.json();
+}
+
+// ステータス別件数を取得（サーバー側で集計済み）
+async function fetchSummary() {
+    const response = await fetch(`${API_BASE_URL}/alerts/summary`);
+    
+    if (!response.ok) {
+        throw new Error(`HTTPエラー: ${response.status}`);
+    }
+    
+    return response.json();
+}
+
+// アラート一覧を取得（先頭ページから読み直す）
 async function loadAlerts() {
     try {
         showMessage('データを読み込んでいます...', 'info');
         
-        const response = await fetch(`${API_BASE_URL}/alerts`);
+        const [data, summaryData] = await Promise.all([
+            fetchAlertsPage(null),
+            fetchSummary()
+        ]);
+        allAlerts = data.alerts || [];
+        nextToken = data.next_token || null;
+        summary = summaryData;
+        selectedIds = new Set();
         
-        if (!response.ok) {
-            throw new Error(`HTTPエラー: ${response.status}`);
-        }
+        updateStats();
+        renderTable();
+        clearMessage();
         
-        const data = await response.json();
-        allAlerts = data.alerts || [];
+    } catch (error) {
+        console.error('エラー:', error);
+        showMessage(`データの読み込みに失敗しました: ${error.message}`, 'error');
+    }
+}
+
+// 続きのページを取得して追加
+async function loadMoreAlerts() {
+    if (!nextToken) return;
+    
+    try {
+        showMessage('データを読み込んでいます...', 'info');
+        
+        const data = await fetchAlertsPage(nextToken);
+        allAlerts = allAlerts.concat(data.alerts || []);
+        nextToken = data.next_token || null;
         
         updateStats();
         renderTable();
@@ -49,15 +103,12 @@ async function loadAlerts() {
 
 // 統計情報を更新
 function updateStats() {
-    const total = allAlerts.length;
-    const pending = allAlerts.filter(a => a.status === 'pending').length;
-    const truePositive = allAlerts.filter(a => a.status === 'true_positive').length;
-    const falsePositive = allAlerts.filter(a => a.status === 'false_positive').length;
+    if (!summary) return;
     
-    document.getElementById('total-count').textContent = total;
-    document.getElementById('pending-count').textContent = pending;
-    document.getElementById('true-positive-count').textContent = truePositive;
-    document.getElementById('false-positive-count').textContent = falsePositive;
+    document.getElementById('total-count').textContent = summary.total;
+    document.getElementById('pending-count').textContent = summary.pending;
+    document.getElementById('true-positive-count').textContent = summary.true_positive;
+    document.getElementById('false-positive-count').textContent = summary.false_positive;
 }
 
 // テーブルを描画
@@ -69,8 +120,12 @@ function renderTable() {
         filteredAlerts = allAlerts.filter(a => a.status === currentFilter);
     }
     
+    const moreButton = nextToken
+        ? '<div class="loading"><button class="refresh-btn" onclick="loadMoreAlerts()">さらに読み込む</button></div>'
+        : '';
+    
     if (filteredAlerts.length === 0) {
-        container.innerHTML = '<div class="loading">アラートがありません</div>';
+        container.innerHTML = '<div class="loading">アラートがありません</div>' + moreButton;
         return;
     }
     
@@ -78,6 +133,7 @@ function renderTable() {
         <table>
             <thead>
                 <tr>
+                    <th></th>
                     <th>発生日時</th>
                     <th>アラーム名</th>
                     <th>種別</th>
@@ -88,6 +144,7 @@ function renderTable() {
             <tbody>
                 ${filteredAlerts.map(alert => `
                     <tr>
+                        <td>${renderSelectBox(alert)}</td>
                         <td>${formatDate(alert.timestamp)}</td>
                         <td>${alert.alarm_name || '-'}</td>
                         <td>${alert.alert_type || '-'}</td>
@@ -99,7 +156,7 @@ function renderTable() {
         </table>
     `;
     
-    container.innerHTML = table;
+    container.innerHTML = table + moreButton;
 }
 
 // 日時をフォーマット
@@ -128,6 +185,22 @@ function renderStatusBadge(status) {
     return `<span class="status-badge ${statusInfo.class}">${statusInfo.label}</span>`;
 }
 
+// 一括更新用のチェックボックスを描画（未判定のみ）
+function renderSelectBox(alert) {
+    if (alert.status !== 'pending') return '';
+    const checked = selectedIds.has(alert.alert_id) ? 'checked' : '';
+    return `<input type="checkbox" ${checked} onchange="toggleSelect('${alert.alert_id}', this.checked)">`;
+}
+
+// 選択状態を切り替え
+function toggleSelect(alertId, checked) {
+    if (checked) {
+        selectedIds.add(alertId);
+    } else {
+        selectedIds.delete(alertId);
+    }
+}
+
 // 操作ボタンを描画
 function renderActionButtons(alert) {
     if (alert.status === 'pending') {
@@ -171,6 +244,52 @@ async function updateStatus(alertId, newStatus) {
     }
 }
 
+// 選択したアラートのステータスを一括更新
+async function bulkUpdateStatus(newStatus) {
+    if (selectedIds.size === 0) {
+        showMessage('アラートを選択してください', 'error');
+        return;
+    }
+    
+    try {
+        showMessage('更新中...', 'info');
+        
+        // 未判定のまま変わっていないものだけを更新する
+        const updates = Array.from(selectedIds).map(alertId => ({
+            alert_id: alertId,
+            status: newStatus,
+            expected_status: 'pending'
+        }));
+        
+        const response = await fetch(`${API_BASE_URL}/alerts`, {
+            method: 'PUT',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ updates: updates })
+        });
+        
+        if (!response.ok) {
+            throw new Error(`HTTPエラー: ${response.status}`);
+        }
+        
+        const result = await response.json();
+        
+        // データを再読み込み
+        await loadAlerts();
+        
+        if (result.failed > 0) {
+            showMessage(`${result.updated}件を更新しました（${result.failed}件は更新できませんでした）`, 'error');
+        } else {
+            showMessage(`${result.updated}件を更新しました`, 'success');
+        }
+        
+    } catch (error) {
+        console.error('エラー:', error);
+        showMessage(`更新に失敗しました: ${error.message}`, 'error');
+    }
+}
+
 // メッセージを表示
 function showMessage(text, type) {
     const messageDiv = document.getElementById('message');
@@ -0,0 +1,72 @@
+import json
+import boto3
+import gzip
+import os
+from collections import defaultdict
+from decimal import Decimal
+from boto3.dynamodb.types import TypeDeserializer
+
+# MonitoringAlerts の DynamoDB Streams（OLD_IMAGE を含む）から起動され、
+# TTL で期限切れになったアラートを日付パーティション付きの gzip JSON Lines として S3 に退避する。
+# 出力先: s3://{ARCHIVE_BUCKET}/{ARCHIVE_PREFIX}/alert_date=YYYY-MM-DD/{シーケンス番号}.jsonl.gz
+ARCHIVE_BUCKET = os.environ.get('ARCHIVE_BUCKET', '')
+ARCHIVE_PREFIX = os.environ.get('ARCHIVE_PREFIX', 'monitoring-alerts').strip('/')
+
+s3 = boto3.client('s3')
+deserializer = TypeDeserializer()
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return int(obj) if obj == obj.to_integral_value() else float(obj)
+        return super(DecimalEncoder, self).default(obj)
+
+def is_ttl_removal(record):
+    """TTLによる自動削除か（手動削除はアーカイブしない）"""
+    identity = record.get('userIdentity') or {}
+    return (
+        record.get('eventName') == 'REMOVE'
+        and identity.get('type') == 'Service'
+        and identity.get('principalId') == 'dynamodb.amazonaws.com'
+    )
+
+def group_expired_alerts(records):
+    """期限切れアラートを alert_date ごとにまとめる（先頭レコードのシーケンス番号も返す）"""
+    partitions = defaultdict(list)
+    first_sequence = {}
+    for record in records:
+        if not is_ttl_removal(record):
+            continue
+        image = record.get('dynamodb', {}).get('OldImage')
+        if not image:
+            continue
+        item = {k: deserializer.deserialize(v) for k, v in image.items()}
+        alert_date = item.get('alert_date', 'unknown')
+        partitions[alert_date].append(item)
+        first_sequence.setdefault(alert_date, record['dynamodb'].get('SequenceNumber', '0'))
+    return partitions, first_sequence
+
+def to_jsonl_gzip(items):
+    lines = [json.dumps(item, cls=DecimalEncoder, ensure_ascii=False) for item in items]
+    return gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+
+def lambda_handler(event, context):
+    partitions, first_sequence = group_expired_alerts(event.get('Records', []))
+
+    archived = 0
+    for alert_date, items in partitions.items():
+        # シーケンス番号をファイル名にするので、再試行時は同じオブジェクトを上書きする
+        key = f"{ARCHIVE_PREFIX}/alert_date={alert_date}/{first_sequence[alert_date]}.jsonl.gz"
+        s3.put_object(
+            Bucket=ARCHIVE_BUCKET,
+            Key=key,
+            Body=to_jsonl_gzip(items),
+            ContentType='application/gzip'
+        )
+        archived += len(items)
+        print(f"Archived {len(items)} alerts to s3://{ARCHIVE_BUCKET}/{key}")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'archived': archived, 'partitions': len(partitions)})
+    }
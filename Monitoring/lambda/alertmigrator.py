@@ -0,0 +1,96 @@
+import json
+import boto3
+import os
+from datetime import datetime, timezone, timedelta
+from botocore.exceptions import ClientError
+
+# alert_date をキーに加える前の MonitoringAlerts（パーティションキー alert_id のみ）から、
+# 現行のキー構成（alert_date + alert_id）のテーブルへ項目をコピーする一回限りの移行用 Lambda。
+# 手順は README の「旧キー構成からの移行」を参照。手動で実行する:
+#   {"source_table": "MonitoringAlerts-legacy"}            （省略時は SOURCE_TABLE_NAME）
+#   {"source_table": "...", "start_key": {...}}            （前回の next_start_key から再開）
+#   {"source_table": "...", "dry_run": true}               （件数の確認のみ）
+#
+# - alert_date は alert_id（alert-YYYYmmddHHMMSS-xxxxxxxx）から updatealertstatus と同じ規則で決める
+# - expires_at がない項目には「アラート時刻 + HOT_RETENTION_DAYS」を入れる。
+#   既に保持期間を過ぎた項目も移行後 MIGRATION_MIN_TTL_SEC は残し（集計の rebuild に含めるため）、
+#   その後 TTL で削除されて alertarchiver が S3 へ退避する
+# - attribute_not_exists(alert_id) の条件付き Put なので、新テーブルに既にある項目（移行中に届いた通知や
+#   判定済みの項目）は上書きしない。途中で止まっても同じ入力で再実行できる
+TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'MonitoringAlerts')
+SOURCE_TABLE_NAME = os.environ.get('SOURCE_TABLE_NAME')
+HOT_RETENTION_DAYS = int(os.environ.get('HOT_RETENTION_DAYS', '90'))
+# 保持期間を過ぎた項目を移行後に残しておく最短の秒数
+MIGRATION_MIN_TTL_SEC = int(os.environ.get('MIGRATION_MIN_TTL_SEC', '86400'))
+# 残り時間がこれを切ったら打ち切って next_start_key を返す（ミリ秒）
+STOP_MARGIN_MS = int(os.environ.get('MIGRATION_STOP_MARGIN_MS', '30000'))
+
+dynamodb = boto3.resource('dynamodb')
+table = dynamodb.Table(TABLE_NAME)
+
+def alert_time(alert_id):
+    """alert_id（alert-YYYYmmddHHMMSS-xxxxxxxx）に埋め込まれた時刻。形式が違えば None"""
+    parts = alert_id.split('-') if isinstance(alert_id, str) else []
+    if len(parts) != 3 or parts[0] != 'alert' or len(parts[1]) != 14 or not parts[1].isdigit():
+        return None
+    return datetime.strptime(parts[1], '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc)
+
+def migrate_item(item):
+    """旧形式の項目に alert_date（と expires_at）を補う。alert_id が不正なら None"""
+    id_time = alert_time(item.get('alert_id'))
+    if id_time is None:
+        return None
+    migrated = dict(item)
+    migrated['alert_date'] = id_time.strftime('%Y-%m-%d')
+    if 'expires_at' not in migrated:
+        expires_at = int((id_time + timedelta(days=HOT_RETENTION_DAYS)).timestamp())
+        migrated['expires_at'] = max(expires_at, int(datetime.now(timezone.utc).timestamp()) + MIGRATION_MIN_TTL_SEC)
+    return migrated
+
+def copy_item(item):
+    """新テーブルにまだない場合だけ書き込む。戻り値は 'copied' / 'exists'"""
+    try:
+        table.put_item(Item=item, ConditionExpression='attribute_not_exists(alert_id)')
+        return 'copied'
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return 'exists'
+        raise
+
+def lambda_handler(event, context):
+    source_name = event.get('source_table') or SOURCE_TABLE_NAME
+    if not source_name or source_name == TABLE_NAME:
+        raise ValueError('source_table（または SOURCE_TABLE_NAME）に移行元の旧テーブルを指定してください')
+    source = dynamodb.Table(source_name)
+    dry_run = bool(event.get('dry_run'))
+
+    counts = {'scanned': 0, 'copied': 0, 'exists': 0, 'invalid': 0}
+    scan_kwargs = {}
+    if event.get('start_key'):
+        scan_kwargs['ExclusiveStartKey'] = event['start_key']
+    next_start_key = None
+    while True:
+        response = source.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            counts['scanned'] += 1
+            migrated = migrate_item(item)
+            if migrated is None:
+                counts['invalid'] += 1
+                print(f"Skip item with invalid alert_id: {item.get('alert_id')}")
+                continue
+            if not dry_run:
+                counts[copy_item(migrated)] += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        # タイムアウト前に止め、続きは next_start_key を渡して再実行する
+        if context and context.get_remaining_time_in_millis() < STOP_MARGIN_MS:
+            next_start_key = response['LastEvaluatedKey']
+            break
+
+    print(f"Migrated from {source_name} to {TABLE_NAME}: {counts}")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({**counts, 'dry_run': dry_run, 'source_table': source_name}),
+        'next_start_key': next_start_key
+    }
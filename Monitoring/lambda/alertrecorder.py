@@ -2,32 +2,70 @@ import json
 import boto3
 import uuid
 import os
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from botocore.exceptions import ClientError
 
 # 環境変数からテーブル名を取得
 TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'MonitoringAlerts')
+# 書き込みの並列数
+PUT_MAX_WORKERS = int(os.environ.get('PUT_MAX_WORKERS', '10'))
+# 条件付き Put がスロットリングされたときの再試行回数と初回待ち時間（秒）
+# （BatchWriteItem 時代の MAX_BATCH_RETRIES / RETRY_BASE_DELAY_SEC も読む）
+MAX_PUT_RETRIES = int(os.environ.get('MAX_PUT_RETRIES') or os.environ.get('MAX_BATCH_RETRIES', '5'))
+PUT_RETRY_BASE_DELAY_SEC = float(os.environ.get('PUT_RETRY_BASE_DELAY_SEC') or os.environ.get('RETRY_BASE_DELAY_SEC', '0.1'))
+RETRYABLE_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+# ホットテーブルでの保持日数（TTL属性 expires_at に設定。期限切れは alertarchiver が S3 へ退避）
+HOT_RETENTION_DAYS = int(os.environ.get('HOT_RETENTION_DAYS', '90'))
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(TABLE_NAME)
 
-def lambda_handler(event, context):
-    # SNSメッセージを取得
-    sns_message = json.loads(event['Records'][0]['Sns']['Message'])
-    
+def _epoch_ms_to_iso(value):
+    return datetime.fromtimestamp(int(value) / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def parse_record(record):
+    """
+    SNS / SQS のレコードから (メッセージID, アラーム通知本文, 配信時刻) を取り出す。
+    SQS は SNS サブスクリプション経由（エンベロープ付き）と Raw 配信の両方に対応。
+    """
+    if 'Sns' in record:
+        sns = record['Sns']
+        return sns['MessageId'], json.loads(sns['Message']), sns.get('Timestamp')
+
+    if record.get('eventSource') == 'aws:sqs':
+        body = json.loads(record['body'])
+        if body.get('Type') == 'Notification' and 'Message' in body:
+            return body['MessageId'], json.loads(body['Message']), body.get('Timestamp')
+        sent = record.get('attributes', {}).get('SentTimestamp')
+        return record['messageId'], body, _epoch_ms_to_iso(sent) if sent else None
+
+    raise ValueError(f"Unsupported record: {record.get('eventSource') or record.get('EventSource')}")
+
+def build_item(message_id, sns_message, delivered_at):
     # アラーム情報を抽出
     alarm_name = sns_message.get('AlarmName', 'Unknown')
     new_state = sns_message.get('NewStateValue', 'ALARM')
     timestamp = sns_message.get('StateChangeTime', datetime.utcnow().isoformat())
-    
+
     # Trigger情報からメトリクス詳細を取得
     trigger = sns_message.get('Trigger', {})
     metric_name = trigger.get('MetricName', 'Unknown')
-    
-    # alert_idを生成
-    alert_id = f"alert-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{str(uuid.uuid4())[:8]}"
-    
-    # DynamoDBに保存
-    item = {
+
+    # alert_idを生成（配信時刻 + メッセージIDから決定的に作るので、再配信されても重複しない）
+    if delivered_at:
+        id_time = datetime.fromisoformat(delivered_at.replace('Z', '+00:00'))
+    else:
+        id_time = datetime.utcnow()
+    suffix = str(uuid.uuid5(uuid.NAMESPACE_URL, message_id))[:8]
+    alert_id = f"alert-{id_time.strftime('%Y%m%d%H%M%S')}-{suffix}"
+
+    # テーブルキー: alert_date(HASH, 日単位) + alert_id(RANGE, 時刻順にソートされる)
+    expires_at = int((datetime.now(timezone.utc) + timedelta(days=HOT_RETENTION_DAYS)).timestamp())
+
+    return {
+        'alert_date': id_time.strftime('%Y-%m-%d'),
         'alert_id': alert_id,
         'timestamp': timestamp,
         'alarm_name': alarm_name,
@@ -35,19 +73,89 @@ def lambda_handler(event, context):
         'status': 'pending',
         'new_state': new_state,
         'notification_time': datetime.utcnow().isoformat(),
-        'raw_message': json.dumps(sns_message)
+        'raw_message': json.dumps(sns_message),
+        'expires_at': expires_at
     }
-    
-    try:
-        table.put_item(Item=item)
-        print(f"Alert recorded: {alert_id}")
-        return {
-            'statusCode': 200,
-            'body': json.dumps(f'Alert {alert_id} recorded successfully')
-        }
-    except Exception as e:
-        print(f"Error recording alert: {str(e)}")
+
+def put_new_item(item):
+    """
+    まだ記録されていない場合だけ書き込む（attribute_not_exists の条件付き Put）。
+    再配信で同じ alert_id が来ても、判定済みのステータスを pending に戻さない。
+    戻り値は 'recorded' / 'duplicate' / 'failed'。スロットリングは指数バックオフで再試行する。
+    """
+    for attempt in range(MAX_PUT_RETRIES + 1):
+        try:
+            table.put_item(Item=item, ConditionExpression='attribute_not_exists(alert_id)')
+            return 'recorded'
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code == 'ConditionalCheckFailedException':
+                return 'duplicate'
+            if code not in RETRYABLE_ERRORS or attempt == MAX_PUT_RETRIES:
+                print(f"Error in put_item {item['alert_id']}: {str(e)}")
+                return 'failed'
+        except Exception as e:
+            print(f"Error in put_item {item['alert_id']}: {str(e)}")
+            return 'failed'
+        time.sleep(PUT_RETRY_BASE_DELAY_SEC * (2 ** attempt))
+    return 'failed'
+
+def put_items(items):
+    """
+    項目ごとの条件付き Put を並列に行う（BatchWriteItem は条件を付けられないため）。
+    {alert_id: 結果} を返す。
+    """
+    if not items:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(PUT_MAX_WORKERS, len(items))) as executor:
+        results = executor.map(put_new_item, items)
+        return {item['alert_id']: result for item, result in zip(items, results)}
+
+def lambda_handler(event, context):
+    records = event.get('Records', [])
+    is_sqs = bool(records) and records[0].get('eventSource') == 'aws:sqs'
+
+    items = {}
+    record_ids = {}
+    failed_records = []
+
+    for record in records:
+        record_id = record.get('messageId') or record.get('Sns', {}).get('MessageId')
+        try:
+            message_id, sns_message, delivered_at = parse_record(record)
+            item = build_item(message_id, sns_message, delivered_at)
+        except Exception as e:
+            print(f"Error parsing record {record_id}: {str(e)}")
+            failed_records.append(record_id)
+            continue
+        # 同一バッチ内の重複配信は1件にまとめる
+        items[item['alert_id']] = item
+        record_ids.setdefault(item['alert_id'], []).append(record_id)
+
+    results = put_items(list(items.values()))
+    failed_ids = [alert_id for alert_id, result in results.items() if result == 'failed']
+    for alert_id in failed_ids:
+        failed_records.extend(record_ids[alert_id])
+
+    recorded = sum(1 for result in results.values() if result == 'recorded')
+    duplicates = sum(1 for result in results.values() if result == 'duplicate')
+    print(f"Alerts recorded: {recorded}/{len(records)} (duplicate: {duplicates}, failed: {len(failed_records)})")
+
+    if is_sqs:
+        # 部分バッチ失敗レスポンス（ReportBatchItemFailures を有効にする）
         return {
-            'statusCode': 500,
-            'body': json.dumps(f'Error: {str(e)}')
+            'batchItemFailures': [{'itemIdentifier': rid} for rid in failed_records]
         }
+
+    if failed_ids:
+        # SNS は非同期呼び出しなので例外で再試行させる（alert_id は決定的なので重複しない）
+        raise RuntimeError(f"Failed to record {len(failed_ids)} alerts")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'recorded': recorded,
+            'duplicate': duplicates,
+            'failed': len(failed_records)
+        })
+    }
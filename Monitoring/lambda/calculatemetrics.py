@@ -2,39 +2,60 @@ import json
 import boto3
 import os
 from datetime import datetime, timedelta
-from decimal import Decimal
 
-TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'MonitoringAlerts')
+# metricsaggregator が更新する集計テーブル
+AGGREGATE_TABLE_NAME = os.environ.get('AGGREGATE_TABLE_NAME', 'MonitoringAlertAggregates')
 CLOUDWATCH_NAMESPACE = os.environ.get('CLOUDWATCH_NAMESPACE', 'MonitoringSystem')
 
+# 直近の誤検知率・遅延を計算する時間窓（時間単位のバケット数）
+RECENT_WINDOW_HOURS = int(os.environ.get('RECENT_WINDOW_HOURS', '24'))
+
+# 集計行のキー（metricsaggregator と同じ形式）
+TOTAL_KEY = 'TOTAL'
+HOUR_KEY_PREFIX = 'HOUR#'
+COUNTER_NAMES = ['total_alerts', 'pending', 'true_positive', 'false_positive', 'delay_sum', 'delay_count']
+BATCH_GET_SIZE = 100  # BatchGetItem の上限
+
 dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(TABLE_NAME)
+aggregate_table = dynamodb.Table(AGGREGATE_TABLE_NAME)
 cloudwatch = boto3.client('cloudwatch')
 
 def lambda_handler(event, context):
     try:
-        # DynamoDBから全アラートデータを取得
-        response = table.scan()
-        items = response.get('Items', [])
+        # 集計テーブルから全期間の集計行を1件取得（アラートテーブルはスキャンしない）
+        response = aggregate_table.get_item(Key={'metric_key': TOTAL_KEY})
+        aggregate = response.get('Item', {})
+        total_alerts = int(aggregate.get('total_alerts', 0))
         
-        print(f"Total alerts found: {len(items)}")
+        print(f"Total alerts found: {total_alerts}")
         
         # 誤検知率を計算
-        false_positive_rate = calculate_false_positive_rate(items)
+        false_positive_rate = calculate_false_positive_rate(aggregate)
         
         # 遅延時間を計算
-        avg_delay_time = calculate_average_delay_time(items)
+        avg_delay_time = calculate_average_delay_time(aggregate)
+        
+        # 直近 RECENT_WINDOW_HOURS 時間のバケットを合算して同じ指標を計算
+        recent = get_recent_aggregate(RECENT_WINDOW_HOURS)
+        recent_alerts = int(recent.get('total_alerts', 0))
+        recent_false_positive_rate = calculate_false_positive_rate(recent)
+        recent_avg_delay_time = calculate_average_delay_time(recent)
         
         # CloudWatch Metricsに送信
-        send_metrics(false_positive_rate, avg_delay_time, len(items))
+        send_metrics(false_positive_rate, avg_delay_time, total_alerts)
+        send_metrics(recent_false_positive_rate, recent_avg_delay_time, recent_alerts, prefix='Recent')
         
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Metrics calculated and sent successfully',
-                'total_alerts': len(items),
+                'total_alerts': total_alerts,
                 'false_positive_rate': float(false_positive_rate) if false_positive_rate is not None else None,
-                'average_delay_time': float(avg_delay_time) if avg_delay_time is not None else None
+                'average_delay_time': float(avg_delay_time) if avg_delay_time is not None else None,
+                'recent_window_hours': RECENT_WINDOW_HOURS,
+                'recent_alerts': recent_alerts,
+                'recent_false_positive_rate': float(recent_false_positive_rate) if recent_false_positive_rate is not None else None,
+                'recent_average_delay_time': float(recent_avg_delay_time) if recent_avg_delay_time is not None else None
             })
         }
         
@@ -45,64 +66,60 @@ def lambda_handler(event, context):
             'body': json.dumps({'error': str(e)})
         }
 
-def calculate_false_positive_rate(items):
-    """誤検知率を計算"""
-    if not items:
+def hour_keys(hours, now=None):
+    """現在の時間を含む直近 hours 個の時間バケットのキー（metricsaggregator.hour_bucket と同じ形式）"""
+    now = now or datetime.utcnow()
+    return [HOUR_KEY_PREFIX + (now - timedelta(hours=i)).strftime('%Y-%m-%dT%H') for i in range(hours)]
+
+def get_recent_aggregate(hours):
+    """直近の時間バケット行を BatchGetItem でまとめて読み、カウンタを合算する"""
+    totals = {name: 0 for name in COUNTER_NAMES}
+    keys = [{'metric_key': key} for key in hour_keys(hours)]
+    for i in range(0, len(keys), BATCH_GET_SIZE):
+        request = {AGGREGATE_TABLE_NAME: {'Keys': keys[i:i + BATCH_GET_SIZE]}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for row in response.get('Responses', {}).get(AGGREGATE_TABLE_NAME, []):
+                for name in COUNTER_NAMES:
+                    totals[name] += float(row.get(name, 0))
+            request = response.get('UnprocessedKeys') or None
+    return totals
+
+def calculate_false_positive_rate(aggregate):
+    """誤検知率を集計行のカウンタから計算"""
+    if not aggregate:
         return None
     
     # 判定済みのアラートのみを対象
-    judged_items = [item for item in items if item.get('status') in ['true_positive', 'false_positive']]
+    false_positive_count = int(aggregate.get('false_positive', 0))
+    total_judged = int(aggregate.get('true_positive', 0)) + false_positive_count
     
-    if not judged_items:
+    if total_judged <= 0:
         print("No judged alerts found")
         return None
     
-    false_positive_count = len([item for item in judged_items if item.get('status') == 'false_positive'])
-    total_judged = len(judged_items)
-    
     rate = (false_positive_count / total_judged) * 100
     
     print(f"False positive rate: {rate}% ({false_positive_count}/{total_judged})")
     
     return rate
 
-def calculate_average_delay_time(items):
-    """平均遅延時間を計算（秒）"""
-    delay_times = []
-    
-    for item in items:
-        timestamp = item.get('timestamp')
-        notification_time = item.get('notification_time')
-        
-        if timestamp and notification_time:
-            try:
-                # ISO形式の日時文字列をパース
-                alert_time = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                notif_time = datetime.fromisoformat(notification_time.replace('Z', '+00:00'))
-                
-                # 遅延時間を秒で計算
-                delay = (notif_time - alert_time).total_seconds()
-                
-                # 負の値やあまりに大きな値は除外
-                if 0 <= delay <= 3600:  # 1時間以内
-                    delay_times.append(delay)
-                    
-            except Exception as e:
-                print(f"Error parsing timestamps: {e}")
-                continue
+def calculate_average_delay_time(aggregate):
+    """平均遅延時間を集計行の遅延合計・件数から計算（秒）"""
+    delay_count = int(aggregate.get('delay_count', 0))
     
-    if not delay_times:
+    if delay_count <= 0:
         print("No valid delay times found")
         return None
     
-    avg_delay = sum(delay_times) / len(delay_times)
+    avg_delay = float(aggregate.get('delay_sum', 0)) / delay_count
     
-    print(f"Average delay time: {avg_delay} seconds (from {len(delay_times)} alerts)")
+    print(f"Average delay time: {avg_delay} seconds (from {delay_count} alerts)")
     
     return avg_delay
 
-def send_metrics(false_positive_rate, avg_delay_time, total_alerts):
-    """CloudWatch Metricsにカスタムメトリクスを送信"""
+def send_metrics(false_positive_rate, avg_delay_time, total_alerts, prefix=''):
+    """CloudWatch Metricsにカスタムメトリクスを送信（prefix='Recent' で直近の時間窓の値）"""
     metric_data = []
     
     timestamp = datetime.utcnow()
@@ -110,7 +127,7 @@ def send_metrics(false_positive_rate, avg_delay_time, total_alerts):
     # 誤検知率のメトリクス
     if false_positive_rate is not None:
         metric_data.append({
-            'MetricName': 'FalsePositiveRate',
+            'MetricName': prefix + 'FalsePositiveRate',
             'Value': float(false_positive_rate),
             'Unit': 'Percent',
             'Timestamp': timestamp
@@ -119,7 +136,7 @@ def send_metrics(false_positive_rate, avg_delay_time, total_alerts):
     # 平均遅延時間のメトリクス
     if avg_delay_time is not None:
         metric_data.append({
-            'MetricName': 'AverageDelayTime',
+            'MetricName': prefix + 'AverageDelayTime',
             'Value': float(avg_delay_time),
             'Unit': 'Seconds',
             'Timestamp': timestamp
@@ -127,7 +144,7 @@ def send_metrics(false_positive_rate, avg_delay_time, total_alerts):
     
     # 全アラート数のメトリクス
     metric_data.append({
-        'MetricName': 'TotalAlerts',
+        'MetricName': prefix + 'TotalAlerts',
         'Value': total_alerts,
         'Unit': 'Count',
         'Timestamp': timestamp
@@ -1,53 +1,251 @@
 import json
 import boto3
 import os
-from boto3.dynamodb.conditions import Attr
+import base64
+import gzip
+import heapq
+from boto3.dynamodb.conditions import Key
 from decimal import Decimal
 
+try:
+    import orjson
+except ImportError:  # orjson が同梱されていない場合は標準の json で動かす
+    orjson = None
+
 TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'MonitoringAlerts')
+# status(HASH) + timestamp(RANGE) のGSI。射影は ALL を想定
+STATUS_INDEX_NAME = os.environ.get('STATUS_INDEX_NAME', 'status-timestamp-index')
+DEFAULT_LIMIT = int(os.environ.get('DEFAULT_PAGE_LIMIT', '50'))
+MAX_LIMIT = int(os.environ.get('MAX_PAGE_LIMIT', '200'))
+# 集計テーブル（metricsaggregator が更新）
+AGGREGATE_TABLE_NAME = os.environ.get('AGGREGATE_TABLE_NAME', 'MonitoringAlertAggregates')
+# この長さ（バイト）を超えるレスポンスはクライアントが対応していれば gzip 圧縮する
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', '1024'))
+
+VALID_STATUSES = ['pending', 'true_positive', 'false_positive']
+TOTAL_KEY = 'TOTAL'
+
+# 一覧表示で返す既定の項目（raw_message は含めない）
+DEFAULT_FIELDS = [
+    'alert_date', 'alert_id', 'timestamp', 'alarm_name', 'alert_type',
+    'status', 'new_state', 'notification_time'
+]
+# ページングのカーソルに必要な項目（常に取得する）
+CURSOR_FIELDS = ['alert_date', 'alert_id', 'status', 'timestamp']
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(TABLE_NAME)
+aggregate_table = dynamodb.Table(AGGREGATE_TABLE_NAME)
 
 # DynamoDBのDecimal型をJSON化するためのヘルパー
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super(DecimalEncoder, self).default(obj)
+def _decimal_default(obj):
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def dumps(obj):
+    """JSONをバイト列にする（orjson があればそちらを使う）"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_decimal_default)
+    return json.dumps(obj, default=_decimal_default, separators=(',', ':')).encode('utf-8')
+
+def _accepts_gzip(event):
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == 'accept-encoding' and 'gzip' in (value or '').lower():
+            return True
+    return False
+
+def _response(status_code, body, event=None):
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Allow-Methods': 'GET,OPTIONS'
+    }
+    payload = dumps(body)
+    if event is not None and len(payload) >= GZIP_MIN_BYTES and _accepts_gzip(event):
+        # API Gateway のバイナリメディアタイプに */* を設定しておくこと
+        headers['Content-Encoding'] = 'gzip'
+        return {
+            'statusCode': status_code,
+            'headers': headers,
+            'isBase64Encoded': True,
+            'body': base64.b64encode(gzip.compress(payload, compresslevel=6)).decode('ascii')
+        }
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': payload.decode('utf-8')
+    }
+
+def encode_token(cursors):
+    """ステータスごとの続きの位置を next_token 文字列にする"""
+    if not cursors:
+        return None
+    return base64.urlsafe_b64encode(dumps(cursors)).decode('ascii')
+
+def decode_token(token):
+    """next_token を {status: ExclusiveStartKey or None} に戻す"""
+    raw = base64.urlsafe_b64decode(token.encode('ascii'))
+    cursors = json.loads(raw)
+    if not isinstance(cursors, dict) or not set(cursors) <= set(VALID_STATUSES):
+        raise ValueError('invalid next_token')
+    return cursors
+
+def parse_limit(value):
+    if value is None:
+        return DEFAULT_LIMIT
+    limit = int(value)
+    if limit <= 0:
+        raise ValueError('limit must be positive')
+    return min(limit, MAX_LIMIT)
+
+def parse_fields(value):
+    """fields パラメータ（カンマ区切り）を取得項目リストにする。all なら全項目（None）"""
+    if value == 'all':
+        return None
+    fields = [f.strip() for f in value.split(',') if f.strip()] if value else list(DEFAULT_FIELDS)
+    for name in CURSOR_FIELDS:
+        if name not in fields:
+            fields.append(name)
+    return fields
+
+def build_key_condition(status, time_from=None, time_to=None):
+    """GSIのキー条件（status一致 + timestampの範囲）を組み立てる"""
+    condition = Key('status').eq(status)
+    if time_from and time_to:
+        condition = condition & Key('timestamp').between(time_from, time_to)
+    elif time_from:
+        condition = condition & Key('timestamp').gte(time_from)
+    elif time_to:
+        condition = condition & Key('timestamp').lte(time_to)
+    return condition
+
+def query_status_page(status, limit, start_key=None, time_from=None, time_to=None, fields=None):
+    """1ステータス分を新しい順に最大 limit 件取得する（1回のQuery）"""
+    params = {
+        'IndexName': STATUS_INDEX_NAME,
+        'KeyConditionExpression': build_key_condition(status, time_from, time_to),
+        'ScanIndexForward': False,
+        'Limit': limit
+    }
+    if fields:
+        # timestamp / status は予約語なので属性名はすべてプレースホルダにする
+        names = {f'#f{i}': name for i, name in enumerate(fields)}
+        params['ProjectionExpression'] = ', '.join(names)
+        params['ExpressionAttributeNames'] = names
+    if start_key:
+        params['ExclusiveStartKey'] = start_key
+    response = table.query(**params)
+    return response.get('Items', []), response.get('LastEvaluatedKey')
+
+def _index_key(item):
+    # GSIのExclusiveStartKeyにはテーブルキー + インデックスキーが必要
+    return {
+        'alert_date': item['alert_date'],
+        'alert_id': item['alert_id'],
+        'status': item['status'],
+        'timestamp': item['timestamp']
+    }
+
+def fetch_alerts(statuses, limit, cursors=None, time_from=None, time_to=None, fields=None):
+    """
+    ステータスごとのGSIパーティションを新しい順に読み、timestampでマージして
+    先頭 limit 件と次ページ用カーソルを返す。
+    読み取り件数は ステータス数 × limit を上限とし、テーブルサイズに依存しない。
+    """
+    if cursors is not None:
+        # 読み切ったステータスはカーソルから除かれている
+        statuses = [s for s in statuses if s in cursors]
+
+    pages = {}
+    for status in statuses:
+        start_key = cursors.get(status) if cursors else None
+        items, last_key = query_status_page(status, limit, start_key, time_from, time_to, fields)
+        pages[status] = (items, last_key)
+
+    # 各ページはすでに降順なのでマージだけでよい（全件ソートはしない）
+    merged = heapq.merge(
+        *[[(item.get('timestamp', ''), status, item) for item in items]
+          for status, (items, _) in pages.items()],
+        key=lambda x: x[0],
+        reverse=True
+    )
+
+    alerts = []
+    last_taken = {}
+    for _, status, item in merged:
+        if len(alerts) >= limit:
+            break
+        alerts.append(item)
+        last_taken[status] = item
+
+    next_cursors = {}
+    for status, (items, last_key) in pages.items():
+        if status in last_taken:
+            taken = last_taken[status]
+            if taken is not items[-1]:
+                # ページの途中までしか返していない -> 最後に返した項目の次から
+                next_cursors[status] = _index_key(taken)
+            elif last_key:
+                next_cursors[status] = last_key
+        elif items:
+            # 1件も返していない -> 同じ位置から読み直す
+            next_cursors[status] = cursors.get(status) if cursors else None
+        elif last_key:
+            next_cursors[status] = last_key
+
+    return alerts, next_cursors
+
+def get_summary():
+    """ステータス別の件数を集計テーブルの TOTAL 行から返す（アラートテーブルは読まない）"""
+    aggregate = aggregate_table.get_item(Key={'metric_key': TOTAL_KEY}).get('Item', {})
+    summary = {'total': int(aggregate.get('total_alerts', 0))}
+    for status in VALID_STATUSES:
+        summary[status] = int(aggregate.get(status, 0))
+    return summary
+
+def _is_summary_request(event):
+    resource = event.get('resource') or event.get('path') or ''
+    return resource.rstrip('/').endswith('/summary')
 
 def lambda_handler(event, context):
     try:
+        # GET /alerts/summary: ステータス別件数のみ返す
+        if _is_summary_request(event):
+            return _response(200, get_summary(), event)
+
         # クエリパラメータからフィルタを取得（オプション）
         query_params = event.get('queryStringParameters', {}) or {}
         status_filter = query_params.get('status')
-        
-        # DynamoDBからデータを取得
+        time_from = query_params.get('from')
+        time_to = query_params.get('to')
+        fields = parse_fields(query_params.get('fields'))
+
+        try:
+            limit = parse_limit(query_params.get('limit'))
+            token = query_params.get('next_token')
+            cursors = decode_token(token) if token else None
+        except (ValueError, TypeError) as e:
+            return _response(400, {'error': f'Invalid pagination parameter: {str(e)}'})
+
         if status_filter:
-            response = table.scan(
-                FilterExpression=Attr('status').eq(status_filter)
-            )
+            if status_filter not in VALID_STATUSES:
+                return _response(400, {
+                    'error': f'Invalid status. Must be one of: {VALID_STATUSES}'
+                })
+            statuses = [status_filter]
         else:
-            response = table.scan()
-        
-        items = response.get('Items', [])
-        
-        # timestampで降順ソート（新しい順）
-        items.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Methods': 'GET,OPTIONS'
-            },
-            'body': json.dumps({
-                'alerts': items,
-                'count': len(items)
-            }, cls=DecimalEncoder)
-        }
+            statuses = VALID_STATUSES
+
+        items, next_cursors = fetch_alerts(statuses, limit, cursors, time_from, time_to, fields)
+
+        return _response(200, {
+            'alerts': items,
+            'count': len(items),
+            'next_token': encode_token(next_cursors)
+        }, event)
     except Exception as e:
         print(f"Error: {str(e)}")
         return {
@@ -0,0 +1,277 @@
+import json
+import boto3
+import os
+import time
+import random
+from collections import defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+# MonitoringAlerts の DynamoDB Streams（NEW_AND_OLD_IMAGES）から起動され、
+# 集計テーブルのカウンタを差分だけ加算する。
+# calculatemetrics は集計行を数件読むだけで済むようになる。
+#
+# 再試行されたバッチで二重に加算しないよう、ストリームレコードごとに適用済みマーカー
+# （metric_key = APPLIED#{eventID}）を集計行の ADD と同じ TransactWriteItems で書き込み、
+# マーカーが既にあるレコードは適用しない。マーカーは APPLIED_MARKER_TTL_SEC 後に TTL で消える。
+TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'MonitoringAlerts')
+AGGREGATE_TABLE_NAME = os.environ.get('AGGREGATE_TABLE_NAME', 'MonitoringAlertAggregates')
+
+# 集計行のキー（calculatemetrics と同じ形式）
+TOTAL_KEY = 'TOTAL'
+HOUR_KEY_PREFIX = 'HOUR#'
+ALARM_KEY_PREFIX = 'ALARM#'
+APPLIED_KEY_PREFIX = 'APPLIED#'
+
+# ストリームの保持期間（24時間）より長く残せば再試行を取りこぼさない
+APPLIED_MARKER_TTL_SEC = int(os.environ.get('APPLIED_MARKER_TTL_SEC', str(48 * 3600)))
+MAX_TRANSACT_ITEMS = 100
+MAX_CONFLICT_RETRIES = 5
+
+JUDGED_STATUSES = ['true_positive', 'false_positive']
+COUNTER_STATUSES = ['pending'] + JUDGED_STATUSES
+MAX_VALID_DELAY_SEC = 3600  # 1時間を超える遅延は除外（従来の計算と同じ）
+
+dynamodb = boto3.resource('dynamodb')
+table = dynamodb.Table(TABLE_NAME)
+aggregate_table = dynamodb.Table(AGGREGATE_TABLE_NAME)
+deserializer = TypeDeserializer()
+
+def _parse_time(value):
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    # notification_time はタイムゾーンなし（UTC）で保存されている
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def hour_bucket(timestamp):
+    """アラート発生時刻から1時間単位のバケットキーを作る（例: HOUR#2025-11-12T10）"""
+    try:
+        return HOUR_KEY_PREFIX + _parse_time(timestamp).astimezone(timezone.utc).strftime('%Y-%m-%dT%H')
+    except (AttributeError, ValueError):
+        return None
+
+def delay_seconds(item):
+    """発生時刻から通知時刻までの遅延（秒）。対象外なら None"""
+    timestamp = item.get('timestamp')
+    notification_time = item.get('notification_time')
+    if not timestamp or not notification_time:
+        return None
+    try:
+        delay = (_parse_time(notification_time) - _parse_time(timestamp)).total_seconds()
+    except ValueError as e:
+        print(f"Error parsing timestamps: {e}")
+        return None
+    if 0 <= delay <= MAX_VALID_DELAY_SEC:
+        return delay
+    return None
+
+def aggregate_keys(item):
+    """1件のアラートが寄与する集計行のキー一覧"""
+    keys = [TOTAL_KEY]
+    bucket = hour_bucket(item.get('timestamp'))
+    if bucket:
+        keys.append(bucket)
+    alarm_name = item.get('alarm_name')
+    if alarm_name:
+        keys.append(ALARM_KEY_PREFIX + alarm_name)
+    return keys
+
+def item_counters(item, sign):
+    """アラート1件分のカウンタ（sign=1 で加算、-1 で減算）"""
+    counters = {'total_alerts': sign}
+    status = item.get('status')
+    if status in COUNTER_STATUSES:
+        counters[status] = sign
+    delay = delay_seconds(item)
+    if delay is not None:
+        counters['delay_sum'] = sign * delay
+        counters['delay_count'] = sign
+    return counters
+
+def status_counters(old_status, new_status):
+    counters = {}
+    if old_status in COUNTER_STATUSES:
+        counters[old_status] = -1
+    if new_status in COUNTER_STATUSES:
+        counters[new_status] = counters.get(new_status, 0) + 1
+    return counters
+
+def is_ttl_removal(record):
+    """TTLによる自動削除か（alertarchiver が S3 に退避するので集計からは引かない）"""
+    identity = record.get('userIdentity') or {}
+    return identity.get('type') == 'Service' and identity.get('principalId') == 'dynamodb.amazonaws.com'
+
+def record_deltas(record):
+    """ストリームレコード1件を [(集計キー, カウンタ差分)] に変換する"""
+    event_name = record.get('eventName')
+    images = record.get('dynamodb', {})
+    new_item = _deserialize(images.get('NewImage'))
+    old_item = _deserialize(images.get('OldImage'))
+
+    if event_name == 'INSERT' and new_item:
+        return [(key, item_counters(new_item, 1)) for key in aggregate_keys(new_item)]
+
+    if event_name == 'REMOVE' and old_item and not is_ttl_removal(record):
+        return [(key, item_counters(old_item, -1)) for key in aggregate_keys(old_item)]
+
+    if event_name == 'MODIFY' and new_item and old_item:
+        if old_item.get('status') == new_item.get('status'):
+            return []
+        counters = status_counters(old_item.get('status'), new_item.get('status'))
+        return [(key, counters) for key in aggregate_keys(new_item)]
+
+    return []
+
+def _deserialize(image):
+    if not image:
+        return None
+    return {k: deserializer.deserialize(v) for k, v in image.items()}
+
+def _to_decimal(value):
+    if float(value).is_integer():
+        return Decimal(int(value))
+    return Decimal(str(round(value, 6)))
+
+def merge_deltas(deltas):
+    """差分を集計キーごとにまとめ、書き込み回数を行数分に抑える"""
+    merged = defaultdict(lambda: defaultdict(float))
+    for key, counters in deltas:
+        for name, value in counters.items():
+            merged[key][name] += value
+    return {key: {n: v for n, v in counters.items() if v != 0} for key, counters in merged.items()}
+
+def _add_update(key, counters):
+    names = {}
+    values = {}
+    parts = []
+    for i, (name, value) in enumerate(sorted(counters.items())):
+        names[f'#c{i}'] = name
+        values[f':v{i}'] = _to_decimal(value)
+        parts.append(f'#c{i} :v{i}')
+    return {
+        'Update': {
+            'TableName': AGGREGATE_TABLE_NAME,
+            'Key': {'metric_key': key},
+            'UpdateExpression': 'ADD ' + ', '.join(parts),
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values
+        }
+    }
+
+def _marker_put(event_id, expires_at):
+    return {
+        'Put': {
+            'TableName': AGGREGATE_TABLE_NAME,
+            'Item': {'metric_key': APPLIED_KEY_PREFIX + event_id, 'expires_at': expires_at},
+            'ConditionExpression': 'attribute_not_exists(metric_key)'
+        }
+    }
+
+def _cancel_reasons(e):
+    return [r.get('Code') for r in e.response.get('CancellationReasons', [])]
+
+def _apply_chunk(chunk):
+    """
+    レコードのまとまりをマーカーと集計行の ADD の1トランザクションで適用する。
+    戻り値は (適用したレコード数, 更新した集計行数)。
+    一部のマーカーが既にある（再試行で適用済み）場合は、それらを除いた残りだけで適用し直す。
+    """
+    expires_at = int(time.time()) + APPLIED_MARKER_TTL_SEC
+    merged = merge_deltas(d for _, deltas in chunk for d in deltas)
+    rows = {key: counters for key, counters in merged.items() if counters}
+    items = [_marker_put(event_id, expires_at) for event_id, _ in chunk]
+    items += [_add_update(key, counters) for key, counters in rows.items()]
+
+    for attempt in range(MAX_CONFLICT_RETRIES):
+        try:
+            dynamodb.meta.client.transact_write_items(TransactItems=items)
+            return len(chunk), len(rows)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'TransactionCanceledException':
+                raise
+            reasons = _cancel_reasons(e)
+            if 'ConditionalCheckFailed' in reasons:
+                # CancellationReasons は TransactItems と同じ順。先頭 len(chunk) 件がマーカー
+                remaining = [c for c, reason in zip(chunk, reasons) if reason != 'ConditionalCheckFailed']
+                print(f"Skipped {len(chunk) - len(remaining)} already applied stream records")
+                return _apply_chunk(remaining) if remaining else (0, 0)
+            if 'TransactionConflict' not in reasons or attempt == MAX_CONFLICT_RETRIES - 1:
+                raise
+            # 別シャードの更新と同じ集計行（TOTAL など）で競合した。少し待って再試行
+            time.sleep(random.uniform(0.05, 0.2) * (2 ** attempt))
+    return 0, 0
+
+def apply_records(records):
+    """
+    ストリームレコードを冪等に集計行へ反映する。
+    マーカー + 集計行が MAX_TRANSACT_ITEMS に収まる単位でまとめてトランザクションにする。
+    戻り値は (適用したレコード数, 更新した集計行の延べ数)
+    """
+    applied = 0
+    updated = 0
+    chunk = []
+    keys = set()
+    for record in records:
+        deltas = [(key, counters) for key, counters in record_deltas(record) if counters]
+        if not deltas:
+            continue
+        record_keys = {key for key, _ in deltas}
+        if chunk and len(chunk) + 1 + len(keys | record_keys) > MAX_TRANSACT_ITEMS:
+            a, u = _apply_chunk(chunk)
+            applied += a
+            updated += u
+            chunk, keys = [], set()
+        chunk.append((record['eventID'], deltas))
+        keys |= record_keys
+    if chunk:
+        a, u = _apply_chunk(chunk)
+        applied += a
+        updated += u
+    return applied, updated
+
+def rebuild_aggregates():
+    """既存データから集計行を作り直す（導入時の初期投入用。全件スキャンする）"""
+    merged = defaultdict(lambda: defaultdict(float))
+    scan_kwargs = {}
+    scanned = 0
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            scanned += 1
+            for key in aggregate_keys(item):
+                for name, value in item_counters(item, 1).items():
+                    merged[key][name] += value
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    with aggregate_table.batch_writer() as batch:
+        for key, counters in merged.items():
+            row = {'metric_key': key}
+            for name in ['total_alerts', 'delay_sum', 'delay_count'] + COUNTER_STATUSES:
+                row[name] = _to_decimal(counters.get(name, 0))
+            batch.put_item(Item=row)
+
+    print(f"Rebuilt {len(merged)} aggregate rows from {scanned} alerts")
+    return scanned, len(merged)
+
+def lambda_handler(event, context):
+    # 手動実行: {"action": "rebuild"} で集計行を再構築
+    if event.get('action') == 'rebuild':
+        scanned, rows = rebuild_aggregates()
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'scanned_alerts': scanned, 'aggregate_rows': rows})
+        }
+
+    records = event.get('Records', [])
+    applied, updated = apply_records(records)
+    print(f"Applied {applied}/{len(records)} stream records to {updated} aggregate rows")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'records': len(records), 'applied': applied, 'aggregate_rows': updated})
+    }
@@ -1,24 +1,209 @@
 import json
 import boto3
 import os
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 
 TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'MonitoringAlerts')
+# 一括更新の上限件数と並列数
+MAX_BULK_UPDATES = int(os.environ.get('MAX_BULK_UPDATES', '500'))
+BULK_MAX_WORKERS = int(os.environ.get('BULK_MAX_WORKERS', '16'))
+# TransactWriteItems の上限件数
+MAX_TRANSACT_ITEMS = 100
+
+VALID_STATUSES = ['pending', 'true_positive', 'false_positive']
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(TABLE_NAME)
+# スレッド間で共有できるクライアント（resource 経由なので Python 型のまま渡せる）
+client = dynamodb.meta.client
+
+def alert_key(alert_id):
+    """alert_id（alert-YYYYmmddHHMMSS-xxxxxxxx）からテーブルキーを組み立てる"""
+    parts = alert_id.split('-')
+    if len(parts) != 3 or parts[0] != 'alert' or len(parts[1]) != 14 or not parts[1].isdigit():
+        raise ValueError(f'Invalid alert_id: {alert_id}')
+    day = parts[1][:8]
+    return {'alert_date': f'{day[:4]}-{day[4:6]}-{day[6:]}', 'alert_id': alert_id}
+
+def _json_response(status_code, body, methods='PUT,OPTIONS'):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Methods': methods
+        },
+        'body': json.dumps(body)
+    }
+
+def _parse_body(event):
+    """リクエスト本文を JSON として読む（API Gateway のバイナリメディアタイプで base64 化された本文も受け付ける）"""
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return json.loads(body)
+
+def _condition(expected_status):
+    """項目が存在し、expected_status 指定時は現在のステータスが一致することを条件にする"""
+    condition = 'attribute_exists(alert_id)'
+    values = {}
+    if expected_status:
+        condition += ' AND #status = :expected'
+        values[':expected'] = expected_status
+    return condition, values
+
+def _current_status(item):
+    # 条件失敗時に返る項目は低レベル形式（{'S': ...}）
+    status = (item or {}).get('status', {})
+    return status.get('S') if isinstance(status, dict) else status
+
+def parse_bulk_updates(body):
+    """一括更新リクエストを検証し [(key, 新ステータス, 期待する現ステータス)] にする"""
+    updates = body.get('updates')
+    if not isinstance(updates, list) or not updates:
+        raise ValueError('updates must be a non-empty list')
+    if len(updates) > MAX_BULK_UPDATES:
+        raise ValueError(f'Too many updates. Max: {MAX_BULK_UPDATES}')
+
+    parsed = []
+    seen = set()
+    for update in updates:
+        alert_id = update.get('alert_id')
+        new_status = update.get('status')
+        expected_status = update.get('expected_status')
+        if not alert_id:
+            raise ValueError('alert_id is required')
+        if alert_id in seen:
+            raise ValueError(f'Duplicate alert_id: {alert_id}')
+        seen.add(alert_id)
+        if new_status not in VALID_STATUSES or (expected_status and expected_status not in VALID_STATUSES):
+            raise ValueError(f'Invalid status for {alert_id}. Must be one of: {VALID_STATUSES}')
+        parsed.append((alert_key(alert_id), new_status, expected_status))
+    return parsed
+
+def update_one(key, new_status, expected_status):
+    """1件を条件付きで更新し、結果を返す"""
+    condition, values = _condition(expected_status)
+    values[':status'] = new_status
+    result = {'alert_id': key['alert_id'], 'new_status': new_status}
+    try:
+        client.update_item(
+            TableName=TABLE_NAME,
+            Key=key,
+            UpdateExpression='SET #status = :status',
+            ConditionExpression=condition,
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues=values,
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        result['result'] = 'updated'
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            result['result'] = 'error'
+            result['error'] = str(e)
+        elif 'Item' in e.response:
+            result['result'] = 'conflict'
+            result['current_status'] = _current_status(e.response['Item'])
+        else:
+            result['result'] = 'not_found'
+    return result
+
+def update_parallel(updates):
+    """各項目を独立した条件付き更新として並列に適用する（項目ごとに成否が分かれる）"""
+    with ThreadPoolExecutor(max_workers=min(BULK_MAX_WORKERS, len(updates))) as executor:
+        return list(executor.map(lambda u: update_one(*u), updates))
+
+def update_atomic(updates):
+    """TransactWriteItems で全件を一括適用する（1件でも条件を満たさなければ全件取り消し）"""
+    if len(updates) > MAX_TRANSACT_ITEMS:
+        raise ValueError(f'Too many updates for atomic mode. Max: {MAX_TRANSACT_ITEMS}')
+
+    items = []
+    for key, new_status, expected_status in updates:
+        condition, values = _condition(expected_status)
+        values[':status'] = new_status
+        items.append({
+            'Update': {
+                'TableName': TABLE_NAME,
+                'Key': key,
+                'UpdateExpression': 'SET #status = :status',
+                'ConditionExpression': condition,
+                'ExpressionAttributeNames': {'#status': 'status'},
+                'ExpressionAttributeValues': values,
+                'ReturnValuesOnConditionCheckFailure': 'ALL_OLD'
+            }
+        })
+
+    results = [{'alert_id': key['alert_id'], 'new_status': new_status} for key, new_status, _ in updates]
+    try:
+        client.transact_write_items(TransactItems=items)
+        for result in results:
+            result['result'] = 'updated'
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        reasons = e.response.get('CancellationReasons', [])
+        for result, reason in zip(results, reasons):
+            code = reason.get('Code')
+            if code == 'ConditionalCheckFailed':
+                if 'Item' in reason:
+                    result['result'] = 'conflict'
+                    result['current_status'] = _current_status(reason['Item'])
+                else:
+                    result['result'] = 'not_found'
+            elif code and code != 'None':
+                result['result'] = 'error'
+                result['error'] = reason.get('Message', code)
+            else:
+                result['result'] = 'cancelled'
+    return results
+
+def lambda_handler_bulk(event):
+    """
+    一括更新: {"updates": [{"alert_id", "status", "expected_status"(任意)}], "atomic": false}
+    結果は項目ごとに updated / conflict / not_found / cancelled / error で返す。
+    """
+    try:
+        body = _parse_body(event)
+        updates = parse_bulk_updates(body)
+        if body.get('atomic'):
+            results = update_atomic(updates)
+        else:
+            results = update_parallel(updates)
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        return _json_response(400, {'error': str(e)})
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return _json_response(500, {'error': str(e)})
+
+    updated = sum(1 for r in results if r['result'] == 'updated')
+    print(f"Bulk status update: {updated}/{len(results)} updated")
+
+    return _json_response(200, {
+        'message': 'Bulk status update finished',
+        'updated': updated,
+        'failed': len(results) - updated,
+        'results': results
+    })
 
 def lambda_handler(event, context):
+    # パスに alert_id がなければ一括更新（PUT /alerts）
+    if not (event.get('pathParameters') or {}).get('alert_id'):
+        return lambda_handler_bulk(event)
+
     try:
         # パスパラメータからalert_idを取得
         alert_id = event['pathParameters']['alert_id']
         
         # リクエストボディからstatusを取得
-        body = json.loads(event['body'])
+        body = _parse_body(event)
         new_status = body.get('status')
         
         # バリデーション
-        valid_statuses = ['pending', 'true_positive', 'false_positive']
-        if new_status not in valid_statuses:
+        if new_status not in VALID_STATUSES:
             return {
                 'statusCode': 400,
                 'headers': {
@@ -26,13 +211,25 @@ def lambda_handler(event, context):
                     'Access-Control-Allow-Origin': '*'
                 },
                 'body': json.dumps({
-                    'error': f'Invalid status. Must be one of: {valid_statuses}'
+                    'error': f'Invalid status. Must be one of: {VALID_STATUSES}'
                 })
             }
         
+        try:
+            key = alert_key(alert_id)
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({'error': str(e)})
+            }
+        
         # DynamoDBのステータスを更新
         response = table.update_item(
-            Key={'alert_id': alert_id},
+            Key=key,
             UpdateExpression='SET #status = :status',
             ExpressionAttributeNames={'#status': 'status'},
             ExpressionAttributeValues={':status': new_status},
@@ -39,10 +39,21 @@ def lambda_handler(event, context):
             status VARCHAR(20) NOT NULL,
             records_processed INTEGER,
             error_message TEXT,
+            watermark BIGINT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
     
+    # 既存テーブルには incremental モードのウォーターマーク列を追加
+    cursor.execute("""
+        ALTER TABLE etl_job_history ADD COLUMN IF NOT EXISTS watermark BIGINT
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_etl_job_history_watermark
+        ON etl_job_history (job_name, job_id DESC)
+        WHERE watermark IS NOT NULL
+    """)
+    
     conn.commit()
     cursor.close()
     conn.close()
@@ -1,69 +1,239 @@
 """
 RDS PostgreSQL 接続管理モジュール
+
+- Secrets Manager の認証情報はプロセス内で SECRET_CACHE_TTL_SEC 秒キャッシュする
+- コネクションはプロセス全体で共有する ThreadedConnectionPool から貸し出す
+  (Lambda のウォーム起動でも接続を使い回す。DB_POOL_ENABLED=false で従来どおり毎回接続)
+- DB_PROXY_ENDPOINT を指定すると RDS Proxy 経由で接続する (接続の多重化は Proxy 側に任せ、プールは小さくてよい)
+- プールから借りた接続は SELECT 1 で生存確認し、Proxy のアイドルタイムアウトやフェイルオーバーで切れていれば張り直す
+- 認証エラー (シークレットのローテーション直後など) はシークレットを取り直して1回だけ再接続する
+  古い認証情報のプールは、貸し出し中の接続がすべて返ってから閉じる
 """
 import os
 import json
+import time
+import threading
 import boto3
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 from contextlib import contextmanager
 
 
+SECRET_CACHE_TTL_SEC = int(os.environ.get('SECRET_CACHE_TTL_SEC', '300'))
+DB_POOL_ENABLED = os.environ.get('DB_POOL_ENABLED', 'true').lower() == 'true'
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_PROXY_ENDPOINT = os.environ.get('DB_PROXY_ENDPOINT')
+
+# シークレット ARN -> (取得時刻, 認証情報)
+_secret_cache = {}
+# (host, port, dbname, user) -> ThreadedConnectionPool
+_pools = {}
+# プール -> 貸し出し中の接続数
+_borrowed = {}
+# 認証情報の更新で置き換えられ、返却待ちの接続が残っているプール
+_retired = set()
+_lock = threading.Lock()
+
+
+def _is_auth_error(e):
+    message = str(e).lower()
+    return 'password authentication failed' in message or 'pam authentication failed' in message
+
+
 class DBConnector:
     """RDS接続管理クラス"""
-    
-    def __init__(self):
-        """Secrets Manager から認証情報を取得して初期化"""
-        self.credentials = self._get_credentials_from_secrets_manager()
-        
-        self.host = self.credentials['host']
+
+    def __init__(self, pooled=None):
+        """Secrets Manager から認証情報を取得して初期化 (キャッシュがあればそれを使う)"""
+        self.pooled = DB_POOL_ENABLED if pooled is None else pooled
+        # バックフィルでは同じインスタンスを複数スレッドで使うので、認証情報の読み書きはこのロックで守る
+        self._cred_lock = threading.RLock()
+        self._load_credentials(self._get_credentials_from_secrets_manager())
+
+    def _load_credentials(self, credentials):
+        self.credentials = credentials
+        self.host = DB_PROXY_ENDPOINT or self.credentials['host']
         self.database = self.credentials.get('dbname', 'batch_etl')
         self.user = self.credentials['username']
         self.password = self.credentials['password']
         self.port = int(self.credentials.get('port', 5432))
-    
-    def _get_credentials_from_secrets_manager(self):
+
+    def _get_credentials_from_secrets_manager(self, force_refresh=False):
         """Secrets Manager から認証情報を取得"""
         secret_arn = os.environ.get('DB_SECRET_ARN')
-        
+
         if not secret_arn:
             raise ValueError("環境変数 DB_SECRET_ARN が設定されていません")
-        
+
+        with _lock:
+            cached = _secret_cache.get(secret_arn)
+            if cached and not force_refresh and time.time() - cached[0] < SECRET_CACHE_TTL_SEC:
+                return cached[1]
+
         try:
             client = boto3.client('secretsmanager', region_name='ap-northeast-1')
             response = client.get_secret_value(SecretId=secret_arn)
-            return json.loads(response['SecretString'])
+            credentials = json.loads(response['SecretString'])
         except Exception as e:
             raise Exception(f"Secrets Manager からの認証情報取得に失敗: {str(e)}")
-    
+
+        with _lock:
+            _secret_cache[secret_arn] = (time.time(), credentials)
+        return credentials
+
+    def _connect_params(self):
+        with self._cred_lock:
+            params = {
+                'host': self.host,
+                'database': self.database,
+                'user': self.user,
+                'password': self.password,
+                'port': self.port,
+                'connect_timeout': 10
+            }
+        if DB_PROXY_ENDPOINT:
+            # RDS Proxy は TLS 必須の設定にしておく
+            params['sslmode'] = 'require'
+        return params
+
+    def _pool_key(self):
+        with self._cred_lock:
+            return (self.host, self.port, self.database, self.user)
+
+    def _get_pool(self):
+        """プロセス共有のプールを返す (なければ作る)"""
+        key = self._pool_key()
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None or pool.closed:
+                pool = _pools[key] = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **self._connect_params())
+            return pool
+
+    def _refresh_credentials(self, stale):
+        """
+        認証情報を取り直し、古い認証情報で作ったプールを新規の貸し出しから外す
+        他のスレッドが使用中の接続は切らず、すべて返ってきた時点でプールを閉じる
+        stale は認証エラーになったときの認証情報。別スレッドが先に取り直していれば何もしない
+        """
+        with self._cred_lock:
+            if self.credentials is not stale:
+                return
+            old_key = self._pool_key()
+            self._load_credentials(self._get_credentials_from_secrets_manager(force_refresh=True))
+        with _lock:
+            pool = _pools.pop(old_key, None)
+            if pool is None or pool.closed:
+                return
+            if _borrowed.get(pool):
+                _retired.add(pool)
+                return
+            _borrowed.pop(pool, None)
+        pool.closeall()
+
+    @staticmethod
+    def _is_alive(conn):
+        """
+        サーバー側で切られた接続は conn.closed では分からない (次の操作が失敗するまで 0 のまま) ので、
+        軽いクエリを1回流して確認する
+        """
+        if conn.closed:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _acquire(self):
+        """(接続, 借りたプール) を返す。プールを使わない場合のプールは None"""
+        for attempt in range(2):
+            credentials = self.credentials
+            try:
+                if not self.pooled:
+                    return psycopg2.connect(**self._connect_params()), None
+                pool = self._get_pool()
+                # 切れた接続は捨てて取り直す (フェイルオーバー直後はプール内の接続がすべて切れていることもある)
+                for _ in range(DB_POOL_MAX + 1):
+                    conn = pool.getconn()
+                    if self._is_alive(conn):
+                        break
+                    pool.putconn(conn, close=True)
+                else:
+                    raise psycopg2.OperationalError("プールから有効な接続を取得できません")
+                with _lock:
+                    _borrowed[pool] = _borrowed.get(pool, 0) + 1
+                return conn, pool
+            except psycopg2.OperationalError as e:
+                if attempt == 0 and _is_auth_error(e):
+                    self._refresh_credentials(credentials)
+                    continue
+                raise Exception(f"DB接続エラー: {str(e)}")
+
+    def _release(self, conn, pool, broken=False):
+        """接続を借りたプールに返す (認証情報の更新でプールが置き換わっていても元のプールへ)"""
+        if pool is None:
+            conn.close()
+            return
+        if not conn.closed and not broken:
+            # 未コミットの処理を残したままプールに返さない
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        close_pool = False
+        with _lock:
+            _borrowed[pool] = _borrowed.get(pool, 1) - 1
+            if pool in _retired and _borrowed[pool] <= 0:
+                _retired.discard(pool)
+                _borrowed.pop(pool, None)
+                close_pool = True
+        if pool.closed:
+            conn.close()
+            return
+        pool.putconn(conn, close=broken or bool(conn.closed))
+        if close_pool:
+            pool.closeall()
+
     @contextmanager
     def get_connection(self):
         """
         DB コネクションを取得 (with文で使用)
-        
+
         使用例:
             with db.get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT * FROM orders")
         """
-        conn = None
+        conn, pool = self._acquire()
+        broken = False
         try:
-            conn = psycopg2.connect(
-                host=self.host,
-                database=self.database,
-                user=self.user,
-                password=self.password,
-                port=self.port,
-                connect_timeout=10
-            )
             yield conn
         except psycopg2.OperationalError as e:
-            if conn:
-                conn.rollback()
+            # 接続が切れている可能性があるのでプールには戻さない
+            broken = True
             raise Exception(f"DB接続エラー: {str(e)}")
-        except Exception as e:
-            if conn:
+        except Exception:
+            # rollback 自体が失敗した (接続が切れていた) 場合も元の例外を投げ、接続はプールに戻さない
+            try:
                 conn.rollback()
-            raise e
+            except psycopg2.Error:
+                broken = True
+            raise
         finally:
-            if conn:
-                conn.close()
+            self._release(conn, pool, broken)
+
+
+def close_all_pools():
+    """プロセス終了時などにすべてのプールを閉じる"""
+    with _lock:
+        pools = list(_pools.values()) + list(_retired)
+        _pools.clear()
+        _retired.clear()
+        _borrowed.clear()
+    for pool in pools:
+        if not pool.closed:
+            pool.closeall()
@@ -1,11 +1,18 @@
 """
 ETL メイン処理
 昨日の注文データを集計して daily_summary テーブルに保存
+BACKFILL_START / BACKFILL_END を指定すると期間内の各日を並列に再集計する (バックフィル)
+LOAD_MODE=incremental では前回の基準値 (ウォーターマーク) 以降の注文だけを集計して加算する
 """
+import io
+import csv
 import json
 import time
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from psycopg2.extras import execute_values
+import db_connector
 from db_connector import DBConnector
 
 
@@ -19,16 +26,30 @@ def main():
     
     start_time = time.time()
     job_id = f"etl-{int(start_time)}"
+    records_processed = 0
     
     try:
         # DB接続
         db = DBConnector()
         
         # ETL処理実行
-        records_processed = process_daily_summary(db)
+        if BACKFILL_START:
+            result = process_backfill(db, BACKFILL_START, BACKFILL_END or BACKFILL_START)
+        elif LOAD_MODE == 'incremental':
+            result = process_incremental(db)
+        else:
+            result = process_daily_summary(db)
+        records_processed = result["records_processed"]
         
         duration = time.time() - start_time
         
+        if result.get("failed_dates"):
+            # 一部の日が失敗しても成功分は確定済み。失敗日だけ再実行すればよい (各日は冪等な UPSERT)
+            raise Exception(
+                f"バックフィルの一部が失敗: {', '.join(result['failed_dates'])} "
+                f"(成功 {len(result['succeeded_dates'])} 日 / {records_processed} 件)"
+            )
+        
         # 成功ログ (JSON形式)
         log_data = {
             "timestamp": datetime.utcnow().isoformat() + "Z",
@@ -39,13 +60,29 @@ def main():
             "status": "SUCCEEDED",
             "duration": round(duration, 3),
             "records_processed": records_processed,
+            "load_mode": result["load_mode"],
+            "load_duration": result["duration"],
+            "rows_per_sec": result["rows_per_sec"],
             "message": f"ETL job completed successfully. Processed {records_processed} records."
         }
+        if "watermark" in result:
+            log_data.update({
+                "previous_watermark": result["previous_watermark"],
+                "watermark": result["watermark"]
+            })
+        if BACKFILL_START:
+            log_data.update({
+                "backfill_start": BACKFILL_START,
+                "backfill_end": BACKFILL_END or BACKFILL_START,
+                "days": len(result["succeeded_dates"]),
+                "parallelism": result["parallelism"]
+            })
         
         print(json.dumps(log_data))
         
-        # ジョブ履歴記録
-        record_job_history(db, job_type, "SUCCEEDED", records_processed, duration, None)
+        # ジョブ履歴記録 (incremental は集計と同じトランザクションでウォーターマークとともに記録済み)
+        if not result.get("history_recorded"):
+            record_job_history(db, job_type, "SUCCEEDED", records_processed, duration, None)
         
         return 0
         
@@ -67,67 +104,414 @@ def main():
         
         print(json.dumps(log_data))
         
-        # エラー履歴記録
+        # エラー履歴記録 (バックフィルの一部失敗では成功分の件数を残す)
         try:
-            record_job_history(db, job_type, "FAILED", 0, duration, str(e))
+            record_job_history(db, job_type, "FAILED", records_processed, duration, str(e))
         except:
             pass
         
         return 1
 
 
-def process_daily_summary(db):
+# ロード方式
+#   sql  : 集計と UPSERT を INSERT ... SELECT ... ON CONFLICT の1文で DB 内で完結させる（既定）
+#   bulk : Python 側で変換が必要な場合。集計結果を一時テーブルへ一括投入（execute_values / COPY）してからマージ
+#   stream : bulk と同じだが、抽出をサーバーサイドカーソルで itersize 行ずつ流す（メモリはチャンク分のみ）
+#   row  : 従来の1行ずつ INSERT（比較・切り戻し用）
+#   incremental : 前回のウォーターマーク以降に追加された注文だけを集計し、daily_summary に加算する（日中の高頻度実行用）
+LOAD_MODE = os.environ.get('LOAD_MODE', 'sql')
+# stream モードでサーバーから1回に受け取る行数
+EXTRACT_ITERSIZE = int(os.environ.get('EXTRACT_ITERSIZE', '10000'))
+# bulk モードで一時テーブルへ入れる方法 (values / copy) と1回に送る行数
+BULK_METHOD = os.environ.get('BULK_METHOD', 'copy')
+BULK_PAGE_SIZE = int(os.environ.get('BULK_PAGE_SIZE', '5000'))
+# バックフィル期間 (YYYY-MM-DD、両端を含む。END 省略時は START の1日のみ) と同時に処理する日数
+BACKFILL_START = os.environ.get('BACKFILL_START')
+BACKFILL_END = os.environ.get('BACKFILL_END')
+BACKFILL_PARALLELISM = int(os.environ.get('BACKFILL_PARALLELISM', '4'))
+# incremental モードのウォーターマーク
+#   単調増加する列を使う (既定は注文ID)。加算で反映するので追加のみが対象。
+#   updated_at のように既存注文の更新で進む列は二重計上になるため使わない
+#   (注文の更新・削除は全量モードの再集計で反映する)
+WATERMARK_COLUMN = os.environ.get('WATERMARK_COLUMN', 'order_id')
+# 列名は SQL にそのまま埋め込むので、ここに挙げた列だけを受け付ける (単調増加の列を使う場合はここに足す)
+WATERMARK_COLUMNS = ('order_id',)
+if WATERMARK_COLUMN not in WATERMARK_COLUMNS:
+    raise ValueError(f"WATERMARK_COLUMN は {', '.join(WATERMARK_COLUMNS)} のいずれかを指定してください: {WATERMARK_COLUMN}")
+WATERMARK_JOB_NAME = os.environ.get('WATERMARK_JOB_NAME', f"{os.environ.get('JOB_TYPE', 'daily-summary')}-incremental")
+# incremental と全量モードを併用する場合は全量ジョブ側も true にする
+#   全量の再集計をウォーターマーク以下の注文に限定し、incremental と同時に走らないようにする
+#   (境界より後の注文は次の incremental が加算するので二重計上にならない)
+INCREMENTAL_ENABLED = os.environ.get('INCREMENTAL_ENABLED', 'false').lower() == 'true' or LOAD_MODE == 'incremental'
+
+SUMMARY_COLUMNS = ('summary_date', 'region', 'product_id', 'total_orders', 'total_quantity', 'total_amount')
+
+EXTRACT_QUERY = """
+    SELECT
+        order_date,
+        region,
+        product_id,
+        COUNT(*) as total_orders,
+        SUM(quantity) as total_quantity,
+        SUM(total_amount) as total_amount
+    FROM orders
+    WHERE {where}
+    GROUP BY order_date, region, product_id
+    ORDER BY region, product_id
+"""
+
+UPSERT_SET = """
+    ON CONFLICT (summary_date, region, product_id)
+    DO UPDATE SET
+        total_orders = EXCLUDED.total_orders,
+        total_quantity = EXCLUDED.total_quantity,
+        total_amount = EXCLUDED.total_amount,
+        created_at = CURRENT_TIMESTAMP
+"""
+
+# incremental 用: 既存の集計値に差分を足し込む
+UPSERT_ADD = """
+    ON CONFLICT (summary_date, region, product_id)
+    DO UPDATE SET
+        total_orders = daily_summary.total_orders + EXCLUDED.total_orders,
+        total_quantity = daily_summary.total_quantity + EXCLUDED.total_quantity,
+        total_amount = daily_summary.total_amount + EXCLUDED.total_amount,
+        created_at = CURRENT_TIMESTAMP
+"""
+
+# daily_summary を書き換える処理どうしの排他に使う advisory lock のキー
+SUMMARY_LOCK_KEY = 'daily_summary'
+
+
+def process_daily_summary(db, target_date=None, load_mode=None):
     """
     日次集計処理
     昨日の注文データを地域・商品別に集計
+
+    Returns:
+        dict: records_processed（書き込んだ行数）/ load_mode / duration / rows_per_sec
     """
     
-    # 集計対象日 (昨日)
-    target_date = (datetime.now() - timedelta(days=1)).date()
+    # 集計対象日 (省略時は昨日)
+    if target_date is None:
+        target_date = (datetime.now() - timedelta(days=1)).date()
+    load_mode = load_mode or LOAD_MODE
     
+    start = time.time()
     with db.get_connection() as conn:
         cursor = conn.cursor()
         
-        # Extract & Transform
-        # 昨日の注文データを地域・商品別に集計
-        query = """
-            SELECT
-                order_date,
-                region,
-                product_id,
-                COUNT(*) as total_orders,
-                SUM(quantity) as total_quantity,
-                SUM(total_amount) as total_amount
-            FROM orders
-            WHERE order_date = %s
-            GROUP BY order_date, region, product_id
-            ORDER BY region, product_id
-        """
-        
-        cursor.execute(query, (target_date,))
-        results = cursor.fetchall()
-        
-        # Load
-        # daily_summary テーブルに保存 (既存データは更新)
-        insert_query = """
-            INSERT INTO daily_summary 
-            (summary_date, region, product_id, total_orders, total_quantity, total_amount)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (summary_date, region, product_id)
-            DO UPDATE SET
-                total_orders = EXCLUDED.total_orders,
-                total_quantity = EXCLUDED.total_quantity,
-                total_amount = EXCLUDED.total_amount,
-                created_at = CURRENT_TIMESTAMP
-        """
+        cap = None
+        if INCREMENTAL_ENABLED:
+            # 全量どうし (バックフィルの並列実行) は共有ロックで同時に走れる。incremental とは排他
+            cursor.execute("SELECT pg_advisory_xact_lock_shared(hashtext(%s))", (SUMMARY_LOCK_KEY,))
+            cap = get_watermark(cursor)
         
-        for row in results:
-            cursor.execute(insert_query, row)
+        if load_mode == 'sql':
+            records = load_set_based(cursor, target_date, cap)
+        elif load_mode == 'bulk':
+            cursor.execute(*_extract_query(target_date, cap))
+            records = load_bulk(cursor, transform(cursor.fetchall()))
+        elif load_mode == 'stream':
+            # extract -> transform -> チャンク単位の bulk load をジェネレータでつなぐ
+            records = load_bulk(cursor, transform(extract_stream(conn, target_date, cap)))
+        elif load_mode == 'row':
+            records = load_row_by_row(cursor, target_date, cap)
+        else:
+            raise ValueError(f"不明な LOAD_MODE: {load_mode}")
         
         conn.commit()
         cursor.close()
+    
+    duration = time.time() - start
+    return {
+        "records_processed": records,
+        "load_mode": load_mode,
+        "duration": round(duration, 3),
+        "rows_per_sec": round(records / duration, 1) if duration > 0 else None
+    }
+
+
+def process_backfill(db, start_date, end_date, parallelism=None, load_mode=None):
+    """
+    期間内の各日を1単位として process_daily_summary を並列に実行する
+    各日は独立したトランザクションの UPSERT なので、失敗した日だけ再実行してよい (冪等)
+
+    Returns:
+        dict: records_processed（全日の合計）/ load_mode / duration / rows_per_sec /
+              parallelism / succeeded_dates / failed_dates / days（日ごとの結果）
+    """
+    start_date = _to_date(start_date)
+    end_date = _to_date(end_date)
+    if end_date < start_date:
+        raise ValueError(f"BACKFILL_END ({end_date}) が BACKFILL_START ({start_date}) より前です")
+    
+    dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    parallelism = parallelism or BACKFILL_PARALLELISM
+    if db.pooled and parallelism > db_connector.DB_POOL_MAX:
+        # プールの上限を超えて借りると PoolError になるので合わせる
+        print(json.dumps({
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "message": f"parallelism {parallelism} exceeds DB_POOL_MAX, using {db_connector.DB_POOL_MAX}"
+        }))
+        parallelism = db_connector.DB_POOL_MAX
+    workers = max(1, min(parallelism, len(dates)))
+    
+    start = time.time()
+    days = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_daily_summary, db, d, load_mode): d for d in dates}
+        for future in as_completed(futures):
+            d = futures[future].isoformat()
+            try:
+                days[d] = future.result()
+            except Exception as e:
+                days[d] = {"error": str(e)}
+            print(json.dumps({
+                "timestamp": datetime.utcnow().isoformat() + "Z",
+                "message": "backfill day finished",
+                "target_date": d,
+                **days[d]
+            }))
+    
+    days = dict(sorted(days.items()))
+    records = sum(r.get("records_processed", 0) for r in days.values())
+    duration = time.time() - start
+    return {
+        "records_processed": records,
+        "load_mode": load_mode or LOAD_MODE,
+        "duration": round(duration, 3),
+        "rows_per_sec": round(records / duration, 1) if duration > 0 else None,
+        "parallelism": workers,
+        "succeeded_dates": [d for d, r in days.items() if "error" not in r],
+        "failed_dates": [d for d, r in days.items() if "error" in r],
+        "days": days
+    }
+
+
+def _to_date(value):
+    return value if isinstance(value, date) else datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def process_incremental(db):
+    """
+    前回のウォーターマーク以降に追加された注文だけを集計して daily_summary に加算する
+    集計・加算・ウォーターマークの記録を1トランザクションで行うので、途中で失敗しても二重計上しない
+    初回 (ウォーターマーク未記録) は現在の最大値を記録するだけ (それまでの分は全量モードで集計済みの前提)
+
+    Returns:
+        dict: records_processed（加算した daily_summary の行数）/ load_mode / duration / rows_per_sec /
+              previous_watermark / watermark / history_recorded
+    """
+    start = time.time()
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        
+        # 同時に走る incremental / 全量処理と直列化 (トランザクション終了で解放)
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (SUMMARY_LOCK_KEY,))
+        low = get_watermark(cursor)
+        cursor.execute(f"SELECT MAX({WATERMARK_COLUMN}) FROM orders")
+        high = cursor.fetchone()[0]
+        if high is None or (low is not None and high < low):
+            high = low
         
-        return len(results)
+        records = 0
+        if low is not None and high > low:
+            records = load_incremental(cursor, low, high)
+        
+        cursor.execute("""
+            INSERT INTO etl_job_history
+            (job_name, execution_date, start_time, end_time, status, records_processed, error_message, watermark)
+            VALUES (%s, CURRENT_DATE, CURRENT_TIMESTAMP, clock_timestamp(), 'SUCCEEDED', %s, NULL, %s)
+        """, (WATERMARK_JOB_NAME, records, high))
+        
+        conn.commit()
+        cursor.close()
+    
+    duration = time.time() - start
+    return {
+        "records_processed": records,
+        "load_mode": "incremental",
+        "duration": round(duration, 3),
+        "rows_per_sec": round(records / duration, 1) if duration > 0 else None,
+        "previous_watermark": low,
+        "watermark": high,
+        "history_recorded": True
+    }
+
+
+def get_watermark(cursor):
+    """最後に成功した incremental のウォーターマーク (未記録なら None)"""
+    cursor.execute("""
+        SELECT watermark FROM etl_job_history
+        WHERE job_name = %s AND status = 'SUCCEEDED' AND watermark IS NOT NULL
+        ORDER BY job_id DESC
+        LIMIT 1
+    """, (WATERMARK_JOB_NAME,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def load_incremental(cursor, low, high):
+    """ウォーターマーク (low, high] の注文を日付・地域・商品別に集計して加算する (日付をまたぐ遅延分も対象)"""
+    
+    query = f"""
+        INSERT INTO daily_summary
+        ({', '.join(SUMMARY_COLUMNS)})
+        SELECT
+            order_date,
+            region,
+            product_id,
+            COUNT(*),
+            SUM(quantity),
+            SUM(total_amount)
+        FROM orders
+        WHERE {WATERMARK_COLUMN} > %s AND {WATERMARK_COLUMN} <= %s
+        GROUP BY order_date, region, product_id
+        {UPSERT_ADD}
+    """
+    cursor.execute(query, (low, high))
+    return cursor.rowcount
+
+
+def _day_filter(target_date, cap):
+    """対象日の抽出条件。cap があればウォーターマーク以下に限定する (それより後は incremental が加算する)"""
+    if cap is None:
+        return "order_date = %s", (target_date,)
+    return f"order_date = %s AND {WATERMARK_COLUMN} <= %s", (target_date, cap)
+
+
+def _extract_query(target_date, cap=None):
+    where, params = _day_filter(target_date, cap)
+    return EXTRACT_QUERY.format(where=where), params
+
+
+def load_set_based(cursor, target_date, cap=None):
+    """集計と UPSERT を DB 内で1文で実行（行データを Python に持ってこない）"""
+    
+    where, params = _day_filter(target_date, cap)
+    query = f"""
+        INSERT INTO daily_summary
+        ({', '.join(SUMMARY_COLUMNS)})
+        SELECT
+            order_date,
+            region,
+            product_id,
+            COUNT(*),
+            SUM(quantity),
+            SUM(total_amount)
+        FROM orders
+        WHERE {where}
+        GROUP BY order_date, region, product_id
+        {UPSERT_SET}
+    """
+    cursor.execute(query, params)
+    return cursor.rowcount
+
+
+def extract_stream(conn, target_date, cap=None):
+    """
+    名前付き（サーバーサイド）カーソルで集計結果を EXTRACT_ITERSIZE 行ずつ取り出す
+    結果セット全体をクライアントのメモリに載せない
+    """
+    with conn.cursor(name='daily_summary_extract') as cursor:
+        cursor.itersize = EXTRACT_ITERSIZE
+        cursor.execute(*_extract_query(target_date, cap))
+        for row in cursor:
+            yield row
+
+
+def transform(rows):
+    """
+    Python 側の変換処理（bulk モード用のフック）
+    1行 = SUMMARY_COLUMNS の順のタプル。既定では何もしない
+    """
+    return rows
+
+
+def load_bulk(cursor, rows):
+    """
+    一時テーブルへ一括投入してから daily_summary にマージする
+    rows はイテラブル（ジェネレータ可）。BULK_PAGE_SIZE 行ずつ送り、チャンクごとに進捗をログ出力する
+    """
+    # トランザクション終了時に消える一時テーブル
+    cursor.execute(f"""
+        CREATE TEMP TABLE daily_summary_stage ON COMMIT DROP AS
+        SELECT {', '.join(SUMMARY_COLUMNS)} FROM daily_summary WITH NO DATA
+    """)
+    
+    staged = 0
+    start = time.time()
+    for i, chunk in enumerate(_chunks(rows, BULK_PAGE_SIZE), 1):
+        if BULK_METHOD == 'copy':
+            cursor.copy_expert(
+                f"COPY daily_summary_stage ({', '.join(SUMMARY_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                _to_csv(chunk)
+            )
+        else:
+            execute_values(
+                cursor,
+                f"INSERT INTO daily_summary_stage ({', '.join(SUMMARY_COLUMNS)}) VALUES %s",
+                chunk,
+                page_size=BULK_PAGE_SIZE
+            )
+        staged += len(chunk)
+        elapsed = time.time() - start
+        print(json.dumps({
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "message": "chunk staged",
+            "chunk": i,
+            "chunk_rows": len(chunk),
+            "staged_rows": staged,
+            "rows_per_sec": round(staged / elapsed, 1) if elapsed > 0 else None
+        }))
+    
+    cursor.execute(f"""
+        INSERT INTO daily_summary
+        ({', '.join(SUMMARY_COLUMNS)})
+        SELECT {', '.join(SUMMARY_COLUMNS)} FROM daily_summary_stage
+        {UPSERT_SET}
+    """)
+    return cursor.rowcount if cursor.rowcount >= 0 else staged
+
+
+def load_row_by_row(cursor, target_date, cap=None):
+    """従来方式: 集計結果を取得して1行ずつ UPSERT"""
+    
+    cursor.execute(*_extract_query(target_date, cap))
+    results = cursor.fetchall()
+    
+    insert_query = f"""
+        INSERT INTO daily_summary 
+        ({', '.join(SUMMARY_COLUMNS)})
+        VALUES (%s, %s, %s, %s, %s, %s)
+        {UPSERT_SET}
+    """
+    
+    for row in results:
+        cursor.execute(insert_query, row)
+    
+    return len(results)
+
+
+def _chunks(rows, size):
+    """イテラブルを size 行ずつのリストに分ける"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _to_csv(rows):
+    """COPY 用の CSV（ファイルライクオブジェクト）"""
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    return buf
 
 
 def record_job_history(db, job_name, status, records_processed, duration, error_message):
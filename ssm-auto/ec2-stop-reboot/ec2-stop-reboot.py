@@ -1,33 +1,155 @@
 # handler.py
-import os, time, boto3
-from botocore.exceptions import ClientError
+import json
 
-ec2 = boto3.client("ec2")
-ssm = boto3.client("ssm")
-ddb = boto3.resource("dynamodb").Table(os.environ["DEDUP_TABLE"])
+# 共通モジュール（lambda-prod の warm_cache / lease_lock）は Lambda レイヤーで提供する
+import warm_cache
+from lease_lock import LeaseLock
 
-TAG_KEY = os.environ["TAG_KEY"]
-TTL_SEC = int(os.environ.get("DEDUP_TTL_SEC", "900"))
-DOC     = os.environ["AUTOMATION_DOC"]
-P_IID   = os.environ.get("PARAM_KEY_INSTANCE_ID", "InstanceId")
-P_GRP   = os.environ.get("PARAM_KEY_GROUP", "Group")
+# event_router のルート名。統合時は STATE_CHANGE__<変数名> で同名の変数を上書きできる
+ROUTE = "state_change"
 
-def lock(key: str) -> bool:
-    now = int(time.time())
-    try:
-        ddb.put_item(Item={"k": key, "ttl": now + TTL_SEC, "ts": now},
-                     ConditionExpression="attribute_not_exists(k)")
-        return True
-    except ClientError:
-        return False
+def _env(name, *default):
+    return warm_cache.setting(ROUTE, name, *default)
+
+ec2 = warm_cache.client("ec2")
+ssm = warm_cache.client("ssm")
+locks = LeaseLock(_env("DEDUP_TABLE"), int(_env("DEDUP_TTL_SEC", "900")))
+
+TAG_KEY = _env("TAG_KEY")
+DOC     = _env("AUTOMATION_DOC")
+P_IID   = _env("PARAM_KEY_INSTANCE_ID", "InstanceId")
+P_GRP   = _env("PARAM_KEY_GROUP", "Group")
+DESCRIBE_FILTER_MAX = 200  # describe_instances の Filter 値の上限
+_NOT_CACHED = object()
 
 def get_group_and_iid(iid: str) -> tuple[str, str]:
-    r = ec2.describe_instances(InstanceIds=[iid])
-    tags = {t["Key"]: t["Value"] for t in r["Reservations"][0]["Instances"][0].get("Tags", [])}
-    grp = tags.get(TAG_KEY)
+    def _load():
+        r = ec2.describe_instances(InstanceIds=[iid])
+        tags = {t["Key"]: t["Value"] for t in r["Reservations"][0]["Instances"][0].get("Tags", [])}
+        return tags.get(TAG_KEY)
+    # 停止系イベントは1台につき複数回届くので、ウォームコンテナ内ではグループタグをキャッシュ
+    grp = warm_cache.instance_tags.get_or_load((iid, TAG_KEY), _load)
     return grp, iid
 
-def lambda_handler(event, _):
+def resolve_groups(iids: list[str]) -> dict[str, str | None]:
+    """
+    複数インスタンスのグループタグをまとめて取得する。キャッシュにないものだけ
+    describe_instances（instance-id フィルタ。存在しないIDがあってもエラーにならない）で引く。
+    """
+    groups = {}
+    missing = []
+    for iid in dict.fromkeys(iids):
+        cached = warm_cache.instance_tags.get((iid, TAG_KEY), _NOT_CACHED)
+        if cached is _NOT_CACHED:
+            missing.append(iid)
+        else:
+            groups[iid] = cached
+    for i in range(0, len(missing), DESCRIBE_FILTER_MAX):
+        chunk = missing[i:i + DESCRIBE_FILTER_MAX]
+        found = {}
+        pages = ec2.get_paginator("describe_instances").paginate(
+            Filters=[{"Name": "instance-id", "Values": chunk}])
+        for page in pages:
+            for res in page.get("Reservations", []):
+                for inst in res.get("Instances", []):
+                    tags = {t["Key"]: t["Value"] for t in inst.get("Tags", [])}
+                    found[inst["InstanceId"]] = tags.get(TAG_KEY)
+        for iid in chunk:
+            groups[iid] = found.get(iid)
+            warm_cache.instance_tags.put((iid, TAG_KEY), groups[iid])
+    return groups
+
+def _parse_record(record: dict) -> dict:
+    """SQS メッセージ本文（変換テンプレート済み or 素の EventBridge イベント）を共通形式にする"""
+    body = json.loads(record["body"])
+    if "instance_id" not in body and "detail" in body:
+        body = {
+            "type": "EC2_STATE_CHANGE",
+            "instance_id": body["detail"].get("instance-id"),
+            "state": body["detail"].get("state"),
+            "event_time": body.get("time"),
+            "event_id": body.get("id"),
+        }
+    body["messageId"] = record["messageId"]
+    return body
+
+def _attach(grp: str, token: str, execution_id: str):
+    """リースに ExecutionId を記録する。失敗してもオートメーションは起動済みなので処理は続ける
+    （記録できなかったリースは完了時に解放されず、LEASE_SEC で期限切れになる）"""
+    try:
+        locks.attach(grp, token, execution_id)
+    except Exception as e:
+        print(f"Failed to attach execution {execution_id} to lease {grp}: {e}")
+
+def lambda_handler_batch(event, context):
+    """
+    SQS（バッチウィンドウ付き）からまとめて受け取った停止系イベントを合流させて処理する。
+    - 同じインスタンスの stopping / stopped / shutting-down / terminated は1件にまとめる
+    - グループタグは describe_instances 1回（200件ずつ）で解決
+    - グループごとにロックを取り、オートメーションは1グループ1回だけ起動する
+    """
+    failures = []
+    events = []
+    for record in event.get("Records", []):
+        try:
+            events.append(_parse_record(record))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Skip malformed message {record.get('messageId')}: {e}")
+
+    # インスタンス単位に合流（最初のイベントを代表にする）
+    by_instance = {}
+    for ev in sorted(events, key=lambda e: e.get("event_time") or ""):
+        if ev.get("instance_id"):
+            by_instance.setdefault(ev["instance_id"], []).append(ev)
+
+    groups = resolve_groups(list(by_instance)) if by_instance else {}
+
+    # グループ単位に合流
+    by_group = {}
+    ignored = []
+    for iid, evs in by_instance.items():
+        grp = groups.get(iid)
+        if grp:
+            by_group.setdefault(grp, []).append(iid)
+        else:
+            ignored.append(iid)
+
+    owner = getattr(context, "aws_request_id", None)
+    leases = locks.acquire_many(list(by_group), owner=owner)
+
+    results = []
+    for grp, iids in by_group.items():
+        lease = leases.get(grp)
+        if not lease:
+            results.append({"status": "skipped_dedup", "group": grp, "instances": iids})
+            continue
+        iid = iids[0]
+        first = by_instance[iid][0]
+        try:
+            resp = ssm.start_automation_execution(
+                DocumentName=DOC,
+                Parameters={P_IID: [iid], P_GRP: [grp]},
+                ClientToken=first.get("event_id")  # 冪等（再配信時も同じ代表イベント）
+            )
+        except Exception as e:
+            print(f"Failed to start automation for {grp}: {e}")
+            locks.release(grp, token=lease["token"])
+            # グループに属するメッセージだけ再配信させる
+            failures.extend(ev["messageId"] for i in iids for ev in by_instance[i])
+            results.append({"status": "error", "group": grp, "iid": iid, "error": str(e)})
+            continue
+        _attach(grp, lease["token"], resp["AutomationExecutionId"])
+        warm_cache.invalidate_instance(iid)
+        results.append({"status": "started", "group": grp, "iid": iid, "coalesced": iids,
+                        "executionId": resp.get("AutomationExecutionId")})
+
+    print(json.dumps({"events": len(events), "instances": len(by_instance), "groups": len(by_group),
+                      "ignored": ignored, "results": results}, ensure_ascii=False))
+    return {"batchItemFailures": [{"itemIdentifier": m} for m in failures]}
+
+def lambda_handler(event, context):
+    if event.get("Records"):
+        return lambda_handler_batch(event, context)
     iid = event.get("instance_id")
     if not iid:
         return {"status": "ignored_no_instance"}
@@ -35,14 +157,23 @@ def lambda_handler(event, _):
     if not grp:
         return {"status": "ignored_no_group", "instanceId": iid}
 
-    # グループタグで排他
-    if not lock(grp):
+    # グループタグで排他（期限付きリース。完了時に ssm_automation_notifier が解放する）
+    owner = getattr(context, "aws_request_id", None) or event.get("event_id")
+    lease = locks.acquire(grp, owner=owner)
+    if not lease:
         return {"status": "skipped_dedup", "group": grp}
 
-    resp = ssm.start_automation_execution(
-        DocumentName=DOC,
-        Parameters={P_IID: [iid], P_GRP: [grp]},
-        ClientToken=event.get("event_id")  # 冪等
-    )
+    try:
+        resp = ssm.start_automation_execution(
+            DocumentName=DOC,
+            Parameters={P_IID: [iid], P_GRP: [grp]},
+            ClientToken=event.get("event_id")  # 冪等
+        )
+    except Exception:
+        # 起動できなければすぐに解放して次のイベントで再試行できるようにする
+        locks.release(grp, token=lease["token"])
+        raise
+    _attach(grp, lease["token"], resp["AutomationExecutionId"])
+    warm_cache.invalidate_instance(iid)
     return {"status": "started", "group": grp, "iid": iid,
             "executionId": resp.get("AutomationExecutionId")}
@@ -1,41 +1,142 @@
 # alarm_handler.py
 import os
 import json
-import boto3
+import time
+import uuid
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import warm_cache
+from change_calendar import LocalCalendar
 
-cw  = boto3.client("cloudwatch")
-ssm = boto3.client("ssm")
+# event_router のルート名。統合時は ALARM__<変数名> で同名の変数を上書きできる
+ROUTE = "alarm"
+
+def _env(name, *default):
+    return warm_cache.setting(ROUTE, name, *default)
+
+cw  = warm_cache.client("cloudwatch")
+ssm = warm_cache.client("ssm")
 
 # === 環境変数（差し替え） ===
-AUTOMATION_DOC    = os.environ["AUTOMATION_DOC"]                  # 例: Failover-Automation-Doc
-PARAM_IID         = os.environ.get("PARAM_KEY_INSTANCE_ID", "InstanceId")
-PARAM_RELALM_NAME = os.environ.get("PARAM_KEY_RELATED_ALARM_NAME", "RelatedAlarmName")
-CHANGE_CAL_ARN    = os.environ.get("CHANGE_CAL_ARN")              # 例: arn:aws:ssm:ap-northeast-1:123...:document/BusinessHours
+AUTOMATION_DOC    = _env("AUTOMATION_DOC")                        # 例: Failover-Automation-Doc
+PARAM_IID         = _env("PARAM_KEY_INSTANCE_ID", "InstanceId")
+PARAM_RELALM_NAME = _env("PARAM_KEY_RELATED_ALARM_NAME", "RelatedAlarmName")
+CHANGE_CAL_ARN    = _env("CHANGE_CAL_ARN", None)                  # 例: arn:aws:ssm:ap-northeast-1:123...:document/BusinessHours
+# ローカル判定用の iCalendar（カンマ区切りで複数可。例: 祝日.ics）。指定時は SSM を呼ばない
+CHANGE_CAL_ICS    = _env("CHANGE_CAL_ICS", None)
+CHANGE_CAL_DEFAULT_STATE = _env("CHANGE_CAL_DEFAULT_STATE", "OPEN")  # DEFAULT_OPEN 型なら OPEN
+CAL_STATE_MAX_CACHE_SEC  = int(_env("CAL_STATE_MAX_CACHE_SEC", "3600"))
+MAX_PARALLEL_AUTOMATIONS = int(_env("MAX_PARALLEL_AUTOMATIONS", "5"))
+DESCRIBE_BATCH_SIZE = 100  # DescribeAlarms の AlarmNames 上限
+MISSING = object()
+
+_local_calendar = None
+_remote_state = {"state": None, "expires_at": 0.0}
+
+def _get_local_calendar():
+    """同梱 ICS をコンテナごとに1回だけ解析する"""
+    global _local_calendar
+    if _local_calendar is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        paths = [p if os.path.isabs(p) else os.path.join(here, p)
+                 for p in (x.strip() for x in CHANGE_CAL_ICS.split(",")) if p]
+        _local_calendar = LocalCalendar.from_files(paths, CHANGE_CAL_DEFAULT_STATE)
+    return _local_calendar
+
+def _get_remote_state() -> str:
+    """get_calendar_state の結果を NextTransitionTime（最大 CAL_STATE_MAX_CACHE_SEC）まで再利用する"""
+    now = time.time()
+    if _remote_state["state"] and now < _remote_state["expires_at"]:
+        return _remote_state["state"]
+    r = ssm.get_calendar_state(CalendarNames=[CHANGE_CAL_ARN])
+    expires_at = now + CAL_STATE_MAX_CACHE_SEC
+    nxt = r.get("NextTransitionTime")
+    if nxt:
+        try:
+            expires_at = min(expires_at, datetime.fromisoformat(nxt.replace("Z", "+00:00")).timestamp())
+        except ValueError:
+            pass
+    _remote_state.update(state=r["State"], expires_at=expires_at)
+    return r["State"]
 
 def is_calendar_open() -> bool:
     """SSM Change Calendar が OPEN なら True"""
+    if CHANGE_CAL_ICS:
+        state, _next = _get_local_calendar().state_at()
+        return state == "OPEN"
     if not CHANGE_CAL_ARN:
         return True
-    r = ssm.get_calendar_state(CalendarNames=[CHANGE_CAL_ARN])
-    return r["State"] == "OPEN"
+    return _get_remote_state() == "OPEN"
 
-def get_child_alarm_and_instance_id_from_composite(event) -> tuple[str, str]:
-    """複合アラームイベントから子アラーム名と InstanceId を1つ取得"""
+def _instance_id_from_alarm(alarm: dict):
+    dims = alarm.get("Dimensions", [])
+    return next((d["Value"] for d in dims if d.get("Name") == "InstanceId"), None)
+
+def get_child_alarms_and_instance_ids_from_composite(event) -> list[tuple[str, str]]:
+    """
+    複合アラームイベントの triggeringAlarms すべてについて (子アラーム名, InstanceId) を返す。
+    キャッシュにない子アラームだけを DescribeAlarms（100件ずつ）でまとめて取得する。
+    """
     reason = json.loads(event["detail"]["state"]["reasonData"])
     if not reason.get("triggeringAlarms"):
         raise RuntimeError("No triggeringAlarms in reasonData")
-    child_arn  = reason["triggeringAlarms"][0]["arn"]
-    child_name = child_arn.split(":alarm:", 1)[1]
+    child_names = list(dict.fromkeys(
+        t["arn"].split(":alarm:", 1)[1] for t in reason["triggeringAlarms"]
+    ))
+
+    # ウォームコンテナ内では子アラーム → InstanceId をキャッシュ（見つからない結果も短時間保持）
+    resolved = {}
+    missing = []
+    for name in child_names:
+        iid = warm_cache.get_alarm_target(name, MISSING)
+        if iid is MISSING:
+            missing.append(name)
+        else:
+            resolved[name] = iid
+
+    for i in range(0, len(missing), DESCRIBE_BATCH_SIZE):
+        batch = missing[i:i + DESCRIBE_BATCH_SIZE]
+        found = {}
+        for page in cw.get_paginator("describe_alarms").paginate(AlarmNames=batch, AlarmTypes=["MetricAlarm"]):
+            for a in page.get("MetricAlarms", []):
+                found[a["AlarmName"]] = _instance_id_from_alarm(a)
+        for name in batch:
+            resolved[name] = found.get(name)
+            warm_cache.put_alarm_target(name, resolved[name])
+
+    pairs = [(name, resolved[name]) for name in child_names if resolved.get(name)]
+    if not pairs:
+        raise RuntimeError(f"No InstanceId dimension in child alarms: {child_names}")
+    return pairs
 
-    r = cw.describe_alarms(AlarmNames=[child_name])
-    if not r.get("MetricAlarms"):
-        raise RuntimeError(f"No MetricAlarms found for child alarm: {child_name}")
+def _client_token(event_id, iid: str) -> str:
+    """イベントID + インスタンスIDから決まる UUID（ClientToken は UUID 形式が必須）"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{event_id or uuid.uuid4()}:{iid}"))
 
-    dims = r["MetricAlarms"][0].get("Dimensions", [])
-    iid  = next((d["Value"] for d in dims if d.get("Name") == "InstanceId"), None)
-    if not iid:
-        raise RuntimeError(f"No InstanceId dimension in child alarm: {child_name}")
-    return child_name, iid
+def start_automations(targets: list[tuple[str, str]], composite_name: str, event_id) -> list[dict]:
+    """インスタンスごとに SSM オートメーションを並列（最大 MAX_PARALLEL_AUTOMATIONS）で起動する"""
+    def _start(target):
+        child_name, iid = target
+        params = {
+            PARAM_IID:         [iid],
+            PARAM_RELALM_NAME: [composite_name],
+        }
+        try:
+            resp = ssm.start_automation_execution(
+                DocumentName=AUTOMATION_DOC,
+                Parameters=params,
+                ClientToken=_client_token(event_id, iid)  # 冪等性（インスタンス単位）
+            )
+        except Exception as e:
+            return {"instanceId": iid, "childAlarm": child_name, "error": str(e)}
+        # フェイルオーバーで子アラームの InstanceId が書き換わるのでキャッシュを捨て、
+        # 書き換えまでの間に旧 InstanceId が再びキャッシュされないよう退役中にする
+        warm_cache.invalidate_instance(iid)
+        return {"instanceId": iid, "childAlarm": child_name,
+                "executionId": resp.get("AutomationExecutionId")}
+
+    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_AUTOMATIONS, len(targets))) as ex:
+        return list(ex.map(_start, targets))
 
 def lambda_handler_alarm(event, _context):
     # ALARM 遷移以外は無視
@@ -49,26 +150,27 @@ def lambda_handler_alarm(event, _context):
         return {"status": "suppressed_by_change_calendar",
                 "composite": event["detail"]["alarmName"]}
 
-    # 子アラーム・InstanceId 抽出
-    child_name, iid = get_child_alarm_and_instance_id_from_composite(event)
+    # 発火した子アラームすべての InstanceId を抽出（同一インスタンスは1回だけ）
+    targets = {}
+    for child_name, iid in get_child_alarms_and_instance_ids_from_composite(event):
+        targets.setdefault(iid, (child_name, iid))
 
     # RelatedAlarmName は「複合アラーム名」をそのまま渡す
     composite_name = event["detail"]["alarmName"]
 
-    # SSM 起動
-    params = {
-        PARAM_IID:         [iid],
-        PARAM_RELALM_NAME: [composite_name],
-    }
-    resp = ssm.start_automation_execution(
-        DocumentName=AUTOMATION_DOC,
-        Parameters=params,
-        ClientToken=event.get("id")  # 冪等性
-    )
+    # SSM 起動（インスタンスごとに並列）
+    executions = start_automations(list(targets.values()), composite_name, event.get("id"))
+    errors = [e for e in executions if "error" in e]
+    if errors:
+        # 一部でも失敗したら例外にして EventBridge に再試行させる。
+        # ClientToken がインスタンス単位で決まるので、起動済みのインスタンスは再試行でも二重に起動しない
+        started = [e for e in executions if "error" not in e]
+        print(json.dumps({"composite": composite_name, "started": started, "errors": errors},
+                         ensure_ascii=False))
+        raise RuntimeError(f"Failed to start automations for {len(errors)}/{len(executions)} instances: {errors}")
+
     return {
         "status": "started",
-        "instanceId": iid,
-        "childAlarm": child_name,
         "composite": composite_name,
-        "executionId": resp.get("AutomationExecutionId")
+        "executions": executions
     }
@@ -0,0 +1,139 @@
+# change_calendar.py
+# Change Calendar の OPEN / CLOSED 判定をローカルで行うためのモジュール。
+#
+# - 同梱の iCalendar（祝日.ics など）をコンテナごとに1回だけ解析し、
+#   ソート済み・結合済みの区間リストにして bisect で O(log n) 判定する
+# - SSM の get_calendar_state を使う場合も、返ってきた NextTransitionTime までは結果を再利用する
+#
+# Change Calendar の種類:
+#   DEFAULT_OPEN   … イベント中は CLOSED（祝日カレンダーなど）
+#   DEFAULT_CLOSED … イベント中のみ OPEN
+
+import bisect
+import re
+from datetime import datetime, timedelta, timezone
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # pragma: no cover
+    ZoneInfo = None
+
+DEFAULT_TZ = timezone(timedelta(hours=9))  # VTIMEZONE が読めないときは JST
+
+_OFFSET_RE = re.compile(r"^([+-])(\d{2})(\d{2})$")
+
+def _unfold(text):
+    """RFC5545 の行継続（先頭が空白の行）を前の行につなげる"""
+    lines = []
+    for raw in text.splitlines():
+        if raw[:1] in (" ", "\t") and lines:
+            lines[-1] += raw[1:]
+        elif raw.strip():
+            lines.append(raw.rstrip("\r"))
+    return lines
+
+def _split(line):
+    """'DTSTART;VALUE=DATE:20250101' -> ('DTSTART', {'VALUE': 'DATE'}, '20250101')"""
+    head, _, value = line.partition(":")
+    name, *params = head.split(";")
+    return name.upper(), dict(p.split("=", 1) for p in params if "=" in p), value.strip()
+
+def _tz(tzid, offsets):
+    if tzid and ZoneInfo is not None:
+        try:
+            return ZoneInfo(tzid)
+        except Exception:
+            pass
+    return offsets.get(tzid) or DEFAULT_TZ
+
+def _parse_time(value, params, offsets, default_tz):
+    if params.get("VALUE") == "DATE" or len(value) == 8:
+        d = datetime.strptime(value[:8], "%Y%m%d")
+        return d.replace(tzinfo=default_tz)
+    if value.endswith("Z"):
+        return datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+    tz = _tz(params.get("TZID"), offsets) if params.get("TZID") else default_tz
+    return datetime.strptime(value, "%Y%m%dT%H%M%S").replace(tzinfo=tz)
+
+def parse_ics(text):
+    """
+    iCalendar 文字列からイベント区間 [(開始epoch, 終了epoch)] を返す。
+    繰り返し（RRULE）には対応しないので、含まれていれば ValueError。
+    """
+    lines = _unfold(text)
+
+    # VTIMEZONE の固定オフセット（zoneinfo が使えない環境向け）と既定タイムゾーン
+    offsets = {}
+    cal_tzid = None
+    tzid = None
+    for line in lines:
+        name, _params, value = _split(line)
+        if name == "X-WR-TIMEZONE":
+            cal_tzid = value
+        elif name == "TZID":
+            tzid = value
+        elif name == "TZOFFSETTO" and tzid:
+            m = _OFFSET_RE.match(value)
+            if m:
+                sign = -1 if m.group(1) == "-" else 1
+                offsets[tzid] = timezone(sign * timedelta(hours=int(m.group(2)), minutes=int(m.group(3))))
+    default_tz = _tz(cal_tzid, offsets) if cal_tzid else DEFAULT_TZ
+
+    intervals = []
+    event = None
+    for line in lines:
+        name, params, value = _split(line)
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            event = {}
+        elif name == "END" and value.upper() == "VEVENT" and event is not None:
+            if "RRULE" in event:
+                raise ValueError("RRULE is not supported by the local calendar evaluator")
+            if "DTSTART" in event:
+                start = _parse_time(*event["DTSTART"], offsets, default_tz)
+                if "DTEND" in event:
+                    end = _parse_time(*event["DTEND"], offsets, default_tz)
+                elif event["DTSTART"][1].get("VALUE") == "DATE":
+                    end = start + timedelta(days=1)
+                else:
+                    end = start
+                if end > start:
+                    intervals.append((start.timestamp(), end.timestamp()))
+            event = None
+        elif event is not None and name in ("DTSTART", "DTEND", "RRULE"):
+            event[name] = (value, params)
+    return intervals
+
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class LocalCalendar:
+    """ソート済み区間で OPEN / CLOSED と次の切り替わり時刻を O(log n) で返す"""
+    def __init__(self, intervals, default_state="OPEN"):
+        merged = merge_intervals(intervals)
+        self.starts = [s for s, _ in merged]
+        self.ends = [e for _, e in merged]
+        self.default_state = default_state.upper()
+        self.event_state = "CLOSED" if self.default_state == "OPEN" else "OPEN"
+
+    @classmethod
+    def from_files(cls, paths, default_state="OPEN"):
+        intervals = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                intervals.extend(parse_ics(f.read()))
+        return cls(intervals, default_state)
+
+    def state_at(self, when=None):
+        """(状態, 次の切り替わり epoch or None)"""
+        t = (when or datetime.now(timezone.utc)).timestamp()
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i >= 0 and t < self.ends[i]:
+            return self.event_state, self.ends[i]
+        nxt = self.starts[i + 1] if i + 1 < len(self.starts) else None
+        return self.default_state, nxt
@@ -14,27 +14,34 @@
 #   TAG_KEY                     例: RelatedAlarm  （省略時は RelatedAlarm）
 
 import json
-import os
-import boto3
+import warm_cache
 
-ssm = boto3.client("ssm")
-ec2 = boto3.client("ec2")
+# event_router のルート名。統合時は LIFECYCLE__<変数名> で同名の変数を上書きできる
+ROUTE = "lifecycle"
 
-DOC     = os.environ["AUTOMATION_DOC"]
-P_IID   = os.environ["PARAM_KEY_INSTANCE_ID"]      # e.g., UnhealthyInstanceId
-P_ALM   = os.environ["PARAM_KEY_ALARM_NAME"]       # e.g., AlarmName
-TAG_KEY = os.environ.get("TAG_KEY", "RelatedAlarm")
+def _env(name, *default):
+    return warm_cache.setting(ROUTE, name, *default)
+
+ssm = warm_cache.client("ssm")
+ec2 = warm_cache.client("ec2")
+
+DOC     = _env("AUTOMATION_DOC")
+P_IID   = _env("PARAM_KEY_INSTANCE_ID")        # e.g., UnhealthyInstanceId
+P_ALM   = _env("PARAM_KEY_ALARM_NAME")         # e.g., AlarmName
+TAG_KEY = _env("TAG_KEY", "RelatedAlarm")
 
 def _get_alarm_name_from_instance_tag(instance_id: str) -> str | None:
-    """EC2タグから複合アラーム名（TAG_KEYの値）を取り出す。"""
-    resp = ec2.describe_tags(
-        Filters=[
-            {"Name": "resource-id", "Values": [instance_id]},
-            {"Name": "key", "Values": [TAG_KEY]},
-        ]
-    )
-    tags = resp.get("Tags", [])
-    return tags[0]["Value"] if tags else None
+    """EC2タグから複合アラーム名（TAG_KEYの値）を取り出す。ウォームコンテナ内ではキャッシュを使う。"""
+    def _load():
+        resp = ec2.describe_tags(
+            Filters=[
+                {"Name": "resource-id", "Values": [instance_id]},
+                {"Name": "key", "Values": [TAG_KEY]},
+            ]
+        )
+        tags = resp.get("Tags", [])
+        return tags[0]["Value"] if tags else None
+    return warm_cache.instance_tags.get_or_load((instance_id, TAG_KEY), _load)
 
 def lambda_handler_lifecycle(event, context):
     # EventBridge(CloudTrail) の Input Transformer で渡された値を前提に最小化
@@ -68,6 +75,8 @@ def lambda_handler_lifecycle(event, context):
         Parameters={P_IID: [iid], P_ALM: [alarm_name]},
         ClientToken=client_token
     )
+    # フェイルオーバーで置き換わるインスタンスのキャッシュは捨てる
+    warm_cache.invalidate_instance(iid)
     return {
         "status": "started",
         "instanceId": iid,
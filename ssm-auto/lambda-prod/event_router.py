@@ -0,0 +1,202 @@
+# event_router.py
+# alarm_handler / ec2_lifecycle_handler / stop_handler / ec2-stop-reboot を1つの Lambda にまとめる入口。
+#
+# - イベントを振り分けテーブル（ROUTES）で分類し、該当ハンドラに渡す
+# - ハンドラのモジュールは初めて使うときに読み込む（使わないルートの初期化・クライアント作成をしない）
+# - boto3 クライアントとキャッシュは warm_cache 経由で全ハンドラが共有する
+# - EventBridge 単体 / イベントの配列 / SQS バッチ（SNS 経由も可）を受け付ける
+#
+# ハンドラごとに同名の変数で値を変えたい場合は「ルート名の大文字 + __」を前に付けて指定する
+# （例: LIFECYCLE__TAG_KEY=RelatedAlarm）。各ハンドラが warm_cache.setting で自分のルート名の値を優先して読む
+# （ROUTES の name と各モジュールの ROUTE を揃えること）。
+#
+# 必要な環境変数:
+#   ROUTER_ROUTES       有効にするルート（カンマ区切り。省略時はすべて）
+#   ROUTER_MAX_WORKERS  バッチ配信を並列処理する最大数（既定 8）
+
+import os
+import sys
+import json
+import importlib
+import importlib.util
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import warm_cache
+
+ROUTER_ROUTES      = [r.strip() for r in os.environ.get("ROUTER_ROUTES", "").split(",") if r.strip()]
+ROUTER_MAX_WORKERS = int(os.environ.get("ROUTER_MAX_WORKERS", "8"))
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CLOUDTRAIL_EC2_ACTIONS = {"StopInstances", "RebootInstances", "TerminateInstances"}
+
+# === イベント判定 ===
+def _is_alarm_state_change(event):
+    return event.get("detail-type") == "CloudWatch Alarm State Change"
+
+def _is_cloudtrail_ec2(event):
+    if event.get("detail-type") == "AWS API Call via CloudTrail":
+        return event.get("detail", {}).get("eventName") in CLOUDTRAIL_EC2_ACTIONS
+    # Input Transformer 済み（{"instanceId": ..., "id": ...}）
+    return "instanceId" in event and "trigger" not in event and "type" not in event
+
+def _is_stop_trigger(event):
+    return event.get("trigger") == "ec2-stop"
+
+def _is_ec2_state_change(event):
+    return (event.get("type") in ("EC2_STATE_CHANGE", "EC2_REBOOT")
+            or event.get("detail-type") == "EC2 Instance State-change Notification")
+
+def _to_state_change_input(event):
+    """素の EC2 State-change イベントを ec2-stop-reboot の入力形式（eventbridge の変換テンプレート）にする"""
+    if event.get("type") in ("EC2_STATE_CHANGE", "EC2_REBOOT"):
+        return event
+    detail = event.get("detail", {})
+    return {
+        "type": "EC2_STATE_CHANGE",
+        "instance_id": detail.get("instance-id"),
+        "region": event.get("region"),
+        "event_time": event.get("time"),
+        "state": detail.get("state"),
+        "event_id": event.get("id"),
+    }
+
+# === 振り分けテーブル（上から順に判定） ===
+# module: import するモジュール名、path: ファイル名がモジュール名にできない場合の候補パス
+# batch_handler: SQS バッチをまとめて渡せるハンドラ（合流・一括解決をハンドラ側で行う）
+ROUTES = [
+    {"name": "alarm",        "match": _is_alarm_state_change,
+     "module": "alarm_handler",         "handler": "lambda_handler_alarm"},
+    {"name": "stop",         "match": _is_stop_trigger,
+     "module": "stop_handler",          "handler": "lambda_handler"},
+    {"name": "state_change", "match": _is_ec2_state_change, "transform": _to_state_change_input,
+     "module": "ec2_stop_reboot",       "handler": "lambda_handler", "batch_handler": "lambda_handler_batch",
+     "path": ["ec2-stop-reboot.py", os.path.join("..", "ec2-stop-reboot", "ec2-stop-reboot.py")]},
+    {"name": "lifecycle",    "match": _is_cloudtrail_ec2,
+     "module": "ec2_lifecycle_handler", "handler": "lambda_handler_lifecycle"},
+]
+
+_handlers = {}
+_load_lock = threading.Lock()
+
+def _import(route):
+    if "path" not in route:
+        return importlib.import_module(route["module"])
+    for rel in route["path"]:
+        path = os.path.join(HERE, rel)
+        if os.path.exists(path):
+            spec = importlib.util.spec_from_file_location(route["module"], path)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[route["module"]] = module
+            spec.loader.exec_module(module)
+            return module
+    raise ImportError(f"{route['module']} not found in {route['path']}")
+
+def _get_handler(route, attr="handler"):
+    name = (route["name"], attr)
+    handler = _handlers.get(name)
+    if handler is None:
+        with _load_lock:
+            handler = _handlers.get(name)
+            if handler is None:
+                module = sys.modules.get(route["module"])
+                if module is None:
+                    module = _import(route)
+                handler = _handlers[name] = getattr(module, route[attr])
+    return handler
+
+def classify(event):
+    """イベントに一致する最初のルートを返す（有効なルートのみ）"""
+    if not isinstance(event, dict):
+        return None
+    for route in ROUTES:
+        if ROUTER_ROUTES and route["name"] not in ROUTER_ROUTES:
+            continue
+        if route["match"](event):
+            return route
+    return None
+
+def dispatch(event, context):
+    route = classify(event)
+    if route is None:
+        return {"status": "ignored", "reason": "no route for event"}
+    payload = route["transform"](event) if "transform" in route else event
+    result = _get_handler(route)(payload, context)
+    if isinstance(result, dict):
+        result.setdefault("route", route["name"])
+    return result
+
+# === バッチ配信の展開 ===
+def _sqs_body(record):
+    body = json.loads(record["body"])
+    # SNS → SQS（raw delivery なし）の場合は Message を取り出す
+    if isinstance(body, dict) and body.get("Type") == "Notification" and "Message" in body:
+        body = json.loads(body["Message"])
+    return body
+
+def _run_all(items, fn):
+    if len(items) <= 1:
+        return [fn(x) for x in items]
+    with ThreadPoolExecutor(max_workers=min(ROUTER_MAX_WORKERS, len(items))) as ex:
+        return list(ex.map(fn, items))
+
+def _handle_sqs(records, context):
+    failures = []
+    singles = []
+    batches = {}
+    for record in records:
+        try:
+            body = _sqs_body(record)
+        except (ValueError, TypeError) as e:
+            print(f"Failed to parse message {record.get('messageId')}: {e}")
+            failures.append(record["messageId"])
+            continue
+        route = classify(body)
+        if route is not None and "batch_handler" in route:
+            # SNS の包みを外した本文で渡し直す
+            payload = route["transform"](body) if "transform" in route else body
+            batches.setdefault(route["name"], (route, []))[1].append(
+                {"messageId": record["messageId"], "body": json.dumps(payload)})
+        else:
+            singles.append((record["messageId"], body))
+
+    for route, batch in batches.values():
+        try:
+            result = _get_handler(route, "batch_handler")({"Records": batch}, context)
+            failures.extend(f["itemIdentifier"] for f in result.get("batchItemFailures", []))
+        except Exception as e:
+            print(f"Failed to process {route['name']} batch: {e}")
+            failures.extend(r["messageId"] for r in batch)
+
+    def _one(item):
+        message_id, body = item
+        try:
+            return message_id, dispatch(body, context), None
+        except Exception as e:
+            print(f"Failed to process message {message_id}: {e}")
+            return message_id, None, str(e)
+
+    outcomes = _run_all(singles, _one)
+    for message_id, result, error in outcomes:
+        print(json.dumps({"messageId": message_id, "result": result, "error": error},
+                         ensure_ascii=False, default=str))
+    failures.extend(m for m, _, err in outcomes if err)
+    # 失敗したメッセージだけ再配信させる（ReportBatchItemFailures を有効にしておくこと）
+    return {"batchItemFailures": [{"itemIdentifier": m} for m in failures]}
+
+def lambda_handler(event, context):
+    print(json.dumps(event, ensure_ascii=False, default=str))
+
+    if isinstance(event, dict) and event.get("Records"):
+        records = event["Records"]
+        if records[0].get("eventSource") == "aws:sqs":
+            return _handle_sqs(records, context)
+        if records[0].get("EventSource") == "aws:sns":
+            return _run_all([json.loads(r["Sns"]["Message"]) for r in records],
+                            lambda e: dispatch(e, context))
+
+    if isinstance(event, list):
+        return _run_all(event, lambda e: dispatch(e, context))
+
+    return dispatch(event, context)
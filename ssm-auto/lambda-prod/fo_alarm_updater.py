@@ -1,12 +1,20 @@
 # fo_alarm_updater.py
-import boto3, os, json, traceback
+import boto3, os, json, traceback, time
 from typing import List, Dict, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from rate_limiter import RateLimiter
 
-cw  = boto3.client("cloudwatch")
-rgt = boto3.client("resourcegroupstaggingapi")
+# adaptive: スロットリング時にクライアント側で送信レートを自動で絞る
+_boto_config = Config(retries={"max_attempts": 10, "mode": "adaptive"})
+cw  = boto3.client("cloudwatch", config=_boto_config)
+rgt = boto3.client("resourcegroupstaggingapi", config=_boto_config)
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 DEFAULT_TAG_KEY = os.environ.get("TAG_KEY", "failover")  # ← 既定は failover
+DESCRIBE_BATCH_SIZE = 100                                  # DescribeAlarms の AlarmNames 上限
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "8"))      # PutMetricAlarm の並列数
+PUT_TPS = float(os.environ.get("PUT_TPS", "20"))           # PutMetricAlarm の送信レート上限（/秒）
 
 def _log(level: str, msg: str, **kw):
     if level == "ERROR" or LOG_LEVEL == "DEBUG":
@@ -25,16 +33,52 @@ def _as_bool(v):
     if isinstance(v, str):  return v.lower() == "true"
     return bool(v) if v is not None else None
 
+_put_limiter = RateLimiter(PUT_TPS)
+
 def _replace_dims(dims: List[Dict[str, Any]], new_iid: str, new_ami: str|None) -> Tuple[bool, List[Dict[str, Any]]]:
-    """Dimensions 内の InstanceId / ImageId を新値に置換（存在時のみ）。変更有無と新配列を返す"""
+    """
+    Dimensions 内の InstanceId / ImageId を新値に置換（存在時のみ）。変更有無と新配列を返す。
+    元の配列は変更せず、変更がある場合のみ新しい配列（置換した要素だけ新しい dict）を作る。
+    """
     if not dims: return False, dims
-    changed = False
-    for d in dims:
+    new_dims = None
+    for i, d in enumerate(dims):
+        value = None
         if d.get("Name") == "InstanceId" and new_iid and d.get("Value") != new_iid:
-            d["Value"] = new_iid; changed = True
+            value = new_iid
         elif d.get("Name") == "ImageId" and new_ami and d.get("Value") != new_ami:
-            d["Value"] = new_ami; changed = True
-    return changed, dims
+            value = new_ami
+        if value is not None:
+            if new_dims is None:
+                new_dims = list(dims)
+            new_dims[i] = {**d, "Value": value}
+    if new_dims is None:
+        return False, dims
+    return True, new_dims
+
+def _replace_metric_dims(metrics: List[Dict[str, Any]], new_iid: str, new_ami: str|None) -> Tuple[bool, List[Dict[str, Any]]]:
+    """Metric Math の Metrics[] を copy-on-write で置換（変更したクエリだけ MetricStat.Metric を作り直す）"""
+    changed_any = False
+    new_metrics = []
+    for q in metrics:
+        ms = q.get("MetricStat")
+        if ms and ms.get("Metric"):
+            changed, dims2 = _replace_dims(ms["Metric"].get("Dimensions", []), new_iid, new_ami)
+            if changed:
+                q = {**q, "MetricStat": {**ms, "Metric": {**ms["Metric"], "Dimensions": dims2}}}
+                changed_any = True
+        new_metrics.append(q)
+    return changed_any, new_metrics
+
+def _describe_alarms_batched(names: List[str]) -> Dict[str, Dict[str, Any]]:
+    """DescribeAlarms を 100 件ずつまとめて呼び、名前 → メトリクスアラーム定義を返す"""
+    alarms: Dict[str, Dict[str, Any]] = {}
+    paginator = cw.get_paginator("describe_alarms")
+    for i in range(0, len(names), DESCRIBE_BATCH_SIZE):
+        for page in paginator.paginate(AlarmNames=names[i:i + DESCRIBE_BATCH_SIZE], AlarmTypes=["MetricAlarm"]):
+            for ma in page.get("MetricAlarms", []):
+                alarms[ma["AlarmName"]] = ma
+    return alarms
 
 def _list_alarms_by_tag(tag_key: str, tag_value: str) -> List[str]:
     """Resource Groups Tagging API でタグ一致する CloudWatch アラーム名を列挙"""
@@ -81,6 +125,7 @@ def _put_metric_alarm_single(ma: Dict[str, Any], dims: List[Dict[str, Any]]):
     elif ma.get("Statistic"):
         req["Statistic"] = ma["Statistic"]
     req = {k: v for k, v in req.items() if v is not None}
+    _put_limiter.acquire()
     cw.put_metric_alarm(**req)
 
 def _put_metric_alarm_math(ma: Dict[str, Any], metrics: List[Dict[str, Any]]):
@@ -103,6 +148,7 @@ def _put_metric_alarm_math(ma: Dict[str, Any], metrics: List[Dict[str, Any]]):
     if ma.get("ThresholdMetricId"):
         req["ThresholdMetricId"] = ma["ThresholdMetricId"]
     req = {k: v for k, v in req.items() if v is not None}
+    _put_limiter.acquire()
     cw.put_metric_alarm(**req)
 
 def lambda_handler(event, _):
@@ -122,53 +168,57 @@ def lambda_handler(event, _):
     if not (newi and tag_value):
         return {"ok": False, "reason": "missing required fields", "event": event}
 
+    t0 = time.monotonic()
     targets = _list_alarms_by_tag(tag_key, tag_value)
+    t1 = time.monotonic()
     _log("DEBUG", "targets resolved by tag", tagKey=tag_key, tagValue=tag_value, targets=targets)
 
     updated, skipped, errors = [], [], []
 
-    for name in targets:
-        try:
-            d = cw.describe_alarms(AlarmNames=[name])
-            mals = d.get("MetricAlarms", [])
-            if not mals:
-                skipped.append({"alarm": name, "reason": "not_metric_alarm"})
+    try:
+        alarms = _describe_alarms_batched(targets)
+    except Exception as e:
+        alarms = None
+        errors.append({"alarm": None, "error": str(e), "trace": traceback.format_exc()})
+    t2 = time.monotonic()
+
+    # 変更が必要なものだけを書き込みキューに積む
+    writes = []
+    for name in (targets if alarms is not None else []):
+        ma = alarms.get(name)
+        if ma is None:
+            skipped.append({"alarm": name, "reason": "not_metric_alarm"})
+            continue
+        if ma.get("Metrics"):
+            # Metric Math
+            changed, new_metrics = _replace_metric_dims(ma["Metrics"], newi, new_ami)
+            if changed:
+                writes.append((name, _put_metric_alarm_math, ma, new_metrics))
                 continue
-            ma = mals[0]
-
-            if ma.get("Metrics"):
-                # Metric Math
-                new_metrics = []
-                changed_any = False
-                for q in ma["Metrics"]:
-                    q2 = json.loads(json.dumps(q))  # deep copy
-                    ms = q2.get("MetricStat")
-                    if ms and ms.get("Metric"):
-                        dims = ms["Metric"].get("Dimensions", [])
-                        changed, dims2 = _replace_dims(dims, newi, new_ami)
-                        if changed:
-                            ms["Metric"]["Dimensions"] = dims2
-                            q2["MetricStat"] = ms
-                            changed_any = True
-                    new_metrics.append(q2)
-                if not changed_any:
-                    skipped.append({"alarm": name, "reason": "no_dimension_change"})
-                    continue
-                _put_metric_alarm_math(ma, new_metrics)
-
-            else:
-                # 単一メトリクス
-                dims = list(ma.get("Dimensions", []))
-                changed, dims2 = _replace_dims(dims, newi, new_ami)
-                if not changed:
-                    skipped.append({"alarm": name, "reason": "no_dimension_change"})
-                    continue
-                _put_metric_alarm_single(ma, dims2)
-
-            updated.append(name)
+        else:
+            # 単一メトリクス
+            changed, dims2 = _replace_dims(ma.get("Dimensions", []), newi, new_ami)
+            if changed:
+                writes.append((name, _put_metric_alarm_single, ma, dims2))
+                continue
+        skipped.append({"alarm": name, "reason": "no_dimension_change"})
 
+    def _write(w):
+        name, put, ma, arg = w
+        try:
+            put(ma, arg)
+            return name, None
         except Exception as e:
-            errors.append({"alarm": name, "error": str(e), "trace": traceback.format_exc()})
+            return name, {"alarm": name, "error": str(e), "trace": traceback.format_exc()}
+
+    if writes:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(writes))) as executor:
+            for name, err in executor.map(_write, writes):
+                if err:
+                    errors.append(err)
+                else:
+                    updated.append(name)
+    t3 = time.monotonic()
 
     return {
         "ok": True,
@@ -176,5 +226,11 @@ def lambda_handler(event, _):
         "tagValue": tag_value,
         "updated": updated,
         "skipped": skipped,
-        "errors": errors
+        "errors": errors,
+        "timingMs": {
+            "resolve": round((t1 - t0) * 1000),
+            "describe": round((t2 - t1) * 1000),
+            "rewrite": round((t3 - t2) * 1000),
+            "total": round((t3 - t0) * 1000)
+        }
     }
@@ -0,0 +1,192 @@
+# lease_lock.py
+# フェイルオーバーの二重起動を防ぐ DynamoDB のリース型ロック。
+#
+# 従来の lock() は attribute_not_exists(k) だけを条件にしていたため、
+# DynamoDB の TTL 削除（数時間遅れることがある）までロックが残り、正当な再実行まで止めていた。
+# ここでは期限（expires_at）を条件式で判定するので、期限切れのロックはすぐに取り直せる。
+#
+# - acquire   : 未取得 or 期限切れなら取得（owner / token / expires_at を記録）
+# - attach    : オートメーション起動後に ExecutionId を記録
+# - renew     : 実行中に期限を延長（ランブックから lambda_handler を呼ぶ）
+# - release   : 完了時に解放（ssm_automation_notifier から ExecutionId 指定で呼ぶ）
+# - acquire_many : 複数グループをまとめて取得（個別 or 全部まとめて）
+#
+# テーブル: パーティションキー k（文字列）。TTL 属性 ttl は期限 + LOCK_TTL_GRACE_SEC（掃除用）。
+#
+# 環境変数:
+#   LOCK_TABLE            ロックテーブル名（省略時は DEDUP_TABLE）
+#   LEASE_SEC             リース期間（秒。省略時は DEDUP_TTL_SEC、既定 900）
+#   LOCK_TTL_GRACE_SEC    期限後も履歴として残す秒数（既定 86400）
+
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+LOCK_TABLE         = os.environ.get("LOCK_TABLE") or os.environ.get("DEDUP_TABLE")
+LEASE_SEC          = int(os.environ.get("LEASE_SEC") or os.environ.get("DEDUP_TTL_SEC", "900"))
+LOCK_TTL_GRACE_SEC = int(os.environ.get("LOCK_TTL_GRACE_SEC", "86400"))
+TRANSACT_MAX_ITEMS = 100
+
+# ttl は予約語なので名前はプレースホルダにする
+# expires_at は「その秒から空き」とする。release は expires_at = 現在時刻にするので、
+# < で比べると解放と同じ秒の再取得が失敗する
+_FREE_CONDITION = (
+    "attribute_not_exists(k) OR expires_at <= :now"
+    " OR (attribute_not_exists(expires_at) AND #ttl < :now)"  # 旧形式（ttl のみ）のロック
+)
+
+def _is_condition_failure(e):
+    return e.response.get("Error", {}).get("Code") in ("ConditionalCheckFailedException",
+                                                        "TransactionCanceledException")
+
+class LeaseLock:
+    def __init__(self, table_name=LOCK_TABLE, lease_sec=LEASE_SEC, grace_sec=LOCK_TTL_GRACE_SEC):
+        self.table = boto3.resource("dynamodb").Table(table_name)
+        self.lease_sec = lease_sec
+        self.grace_sec = grace_sec
+
+    def _lease_item(self, key, owner, now, lease_sec):
+        expires_at = now + (lease_sec or self.lease_sec)
+        return {
+            "k": key,
+            "owner": owner or "<unknown>",
+            "token": str(uuid.uuid4()),
+            "ts": now,
+            "expires_at": expires_at,
+            "ttl": expires_at + self.grace_sec,
+        }
+
+    def acquire(self, key, owner=None, lease_sec=None):
+        """取得できればリース（dict）を、他が保持中なら None を返す"""
+        now = int(time.time())
+        item = self._lease_item(key, owner, now, lease_sec)
+        try:
+            self.table.put_item(
+                Item=item,
+                ConditionExpression=_FREE_CONDITION,
+                ExpressionAttributeNames={"#ttl": "ttl"},
+                ExpressionAttributeValues={":now": now},
+            )
+        except ClientError as e:
+            if _is_condition_failure(e):
+                return None
+            raise
+        return item
+
+    def acquire_many(self, keys, owner=None, lease_sec=None, all_or_nothing=False, max_workers=8):
+        """
+        複数キーをまとめて取得し {key: リース or None} を返す。
+        all_or_nothing=True なら TransactWriteItems で全部取れたときだけ取得する（最大100件）。
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        if not all_or_nothing:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as ex:
+                leases = ex.map(lambda k: self.acquire(k, owner, lease_sec), keys)
+                return dict(zip(keys, leases))
+
+        if len(keys) > TRANSACT_MAX_ITEMS:
+            raise ValueError(f"all_or_nothing supports at most {TRANSACT_MAX_ITEMS} keys")
+        now = int(time.time())
+        items = [self._lease_item(k, owner, now, lease_sec) for k in keys]
+        try:
+            self.table.meta.client.transact_write_items(TransactItems=[{
+                "Put": {
+                    "TableName": self.table.name,
+                    "Item": item,
+                    "ConditionExpression": _FREE_CONDITION,
+                    "ExpressionAttributeNames": {"#ttl": "ttl"},
+                    "ExpressionAttributeValues": {":now": now},
+                }
+            } for item in items])
+        except ClientError as e:
+            if _is_condition_failure(e):
+                return {k: None for k in keys}
+            raise
+        return dict(zip(keys, items))
+
+    def _update_held(self, key, update, condition, values, names=None):
+        params = {
+            "Key": {"k": key},
+            "UpdateExpression": update,
+            "ConditionExpression": condition,
+            "ExpressionAttributeValues": values,
+        }
+        if names:
+            params["ExpressionAttributeNames"] = names
+        try:
+            self.table.update_item(**params)
+            return True
+        except ClientError as e:
+            if _is_condition_failure(e):
+                return False
+            raise
+
+    def attach(self, key, token, execution_id):
+        """取得したリースに ExecutionId を記録する（以降は ExecutionId で延長・解放できる）"""
+        return self._update_held(
+            key, "SET execution_id = :eid", "#tok = :tok",
+            {":eid": execution_id, ":tok": token}, {"#tok": "token"})
+
+    def renew(self, key, token=None, execution_id=None, lease_sec=None):
+        """保持中（token か ExecutionId が一致）なら期限を延長する"""
+        now = int(time.time())
+        expires_at = now + (lease_sec or self.lease_sec)
+        cond, values, names = self._holder_condition(token, execution_id)
+        values.update({":exp": expires_at, ":ttl": expires_at + self.grace_sec, ":now": now})
+        names["#ttl"] = "ttl"
+        return self._update_held(
+            key, "SET expires_at = :exp, #ttl = :ttl, renewed_at = :now",
+            cond, values, names)
+
+    def release(self, key, token=None, execution_id=None):
+        """保持中（token か ExecutionId が一致）なら即時に解放する。履歴のため項目は残す"""
+        now = int(time.time())
+        cond, values, names = self._holder_condition(token, execution_id)
+        values.update({":now": now, ":ttl": now + self.grace_sec})
+        names["#ttl"] = "ttl"
+        return self._update_held(
+            key, "SET expires_at = :now, released_at = :now, #ttl = :ttl", cond, values, names)
+
+    @staticmethod
+    def _holder_condition(token, execution_id):
+        if token:
+            return "#tok = :tok", {":tok": token}, {"#tok": "token"}
+        if execution_id:
+            return "execution_id = :eid", {":eid": execution_id}, {}
+        raise ValueError("token or execution_id is required")
+
+_default = None
+
+def default_lock():
+    """環境変数の設定で作ったロック（コンテナ内で1つ）"""
+    global _default
+    if _default is None:
+        _default = LeaseLock()
+    return _default
+
+def lambda_handler(event, _):
+    """
+    ランブック（aws:invokeLambdaFunction）から延長・解放するための入口。
+    例: {"action": "renew", "key": "{{ Group }}", "execution_id": "{{ automation:EXECUTION_ID }}"}
+    """
+    action = event.get("action", "renew")
+    key = event.get("key")
+    if not key:
+        # ロックなしで起動された実行（Group 未指定）は何もしない
+        return {"ok": False, "action": action, "reason": "no key"}
+    eid = event.get("execution_id")
+    token = event.get("token")
+    lock = default_lock()
+    if action == "renew":
+        ok = lock.renew(key, token=token, execution_id=eid, lease_sec=event.get("lease_sec"))
+    elif action == "release":
+        ok = lock.release(key, token=token, execution_id=eid)
+    else:
+        return {"ok": False, "reason": f"unknown action: {action}"}
+    return {"ok": ok, "action": action, "key": key}
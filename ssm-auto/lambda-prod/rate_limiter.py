@@ -0,0 +1,30 @@
+# rate_limiter.py
+# スレッド間で共有するトークンバケット。並列で API を呼ぶ処理の送信レートを rate 回/秒に抑える。
+# boto3 の retries mode=adaptive はスロットリングを受けてから絞るので、
+# 大量に並列で書き込む処理ではこちらで先にレートを抑えておく。
+#
+# fo_alarm_updater.py と ../../CW Alarm閾値変更/app.py で共有する（共通モジュールのレイヤーで配布）。
+
+import time
+import threading
+
+class RateLimiter:
+    """トークンバケット（スレッド間で共有）。rate 回/秒を超えないよう acquire で待つ"""
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
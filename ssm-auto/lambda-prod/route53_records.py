@@ -0,0 +1,214 @@
+# route53_records.py
+# フェイルオーバー時に Route 53 のレコードの IP を旧 → 新へまとめて書き換える。
+# ランブック（ssm-auto/ssm の modifyRecordSets）から aws:invokeLambdaFunction で呼び出す。
+#
+# - ホストゾーンの「IP → レコード」索引をウォームコンテナ内に保持し、毎回ゾーン全体を列挙しない
+# - 索引は次の場合に作り直す
+#     ・INDEX_TTL_SEC を過ぎた
+#     ・get_hosted_zone のレコード数が索引作成時と違う（他経路での追加・削除）
+#     ・索引で見つけたレコードを1件ずつ確認（list_resource_record_sets の StartRecordName 指定）して値が違った
+#     ・旧 IP が索引に1件もない（件数を変えずに他経路で値が書き換えられた可能性がある）
+#   作り直した索引でも見つからない旧 IP があれば RecordsNotFoundError にしてステップを失敗させる
+#   （DNS が旧インスタンスを指したままフェイルオーバーが成功扱いにならないように。AllowMissing=true で無視）
+# - 自分で書き換えた分は索引に反映する（作り直し不要）
+# - ChangeId での無効化は行わない。Route 53 にはゾーン単位の最新 ChangeId を取る API がなく、
+#   他のコンテナや手作業による変更は ChangeId では検知できないため、上のレコード数・現物照合・作り直しで判定する
+# - 複数インスタンス分を1回の ChangeResourceRecordSets にまとめる（1000件ずつ）
+# - 加重 / 複数値回答 / フェイルオーバー / 位置情報などのレコードは SetIdentifier ごとに扱い、
+#   TTL・Weight・HealthCheckId などはそのまま、該当する値だけを置き換える
+# - Wait=true なら INSYNC になるまでバックオフ（ジッター付き）で待つ
+#
+# 受け取り（Payload）:
+# {
+#   "HostedZoneId": "Z0123...",
+#   "Replacements": [{"OldIp": "10.0.1.10", "NewIp": "10.0.2.20"}, ...],   # または OldIp / NewIp を直接
+#   "Wait": false,
+#   "AllowMissing": false
+# }
+
+import os
+import time
+import random
+import threading
+import boto3
+from botocore.config import Config
+
+_boto_config = Config(retries={"max_attempts": 10, "mode": "adaptive"})
+route53 = boto3.client("route53", config=_boto_config)
+
+INDEX_TTL_SEC      = int(os.environ.get("R53_INDEX_TTL_SEC", "900"))
+CHANGE_BATCH_SIZE  = 1000   # ChangeResourceRecordSets の上限
+WAIT_TIMEOUT_SEC   = int(os.environ.get("R53_WAIT_TIMEOUT_SEC", "120"))
+WAIT_FIRST_SEC     = 1.0
+WAIT_MAX_SEC       = 10.0
+INDEXED_TYPES      = ("A", "AAAA")
+
+# ゾーンID -> {"built_at", "record_count", "records": {(名前, 種別, SetIdentifier): rrset}, "by_ip": {ip: set(キー)}}
+_indexes = {}
+_lock = threading.Lock()
+
+def _record_key(rrset):
+    return (rrset["Name"], rrset["Type"], rrset.get("SetIdentifier"))
+
+def _values(rrset):
+    return [r["Value"] for r in rrset.get("ResourceRecords", [])]
+
+def _record_count(zone_id):
+    return route53.get_hosted_zone(Id=zone_id)["HostedZone"].get("ResourceRecordSetCount")
+
+def build_index(zone_id):
+    """ゾーンの A / AAAA レコード（エイリアス以外）を列挙して IP → レコードの索引を作る"""
+    records = {}
+    by_ip = {}
+    count = _record_count(zone_id)
+    for page in route53.get_paginator("list_resource_record_sets").paginate(HostedZoneId=zone_id):
+        for rrset in page["ResourceRecordSets"]:
+            if rrset["Type"] not in INDEXED_TYPES or "ResourceRecords" not in rrset:
+                continue
+            key = _record_key(rrset)
+            records[key] = rrset
+            for ip in _values(rrset):
+                by_ip.setdefault(ip, set()).add(key)
+    index = {"built_at": time.time(), "record_count": count, "records": records, "by_ip": by_ip}
+    with _lock:
+        _indexes[zone_id] = index
+    print(f"Built Route 53 index for {zone_id}: {len(records)} records, {len(by_ip)} IPs")
+    return index
+
+def get_index(zone_id):
+    """有効な索引を返す（期限切れ・レコード数の変化があれば作り直す）"""
+    with _lock:
+        index = _indexes.get(zone_id)
+    if index is None or time.time() - index["built_at"] > INDEX_TTL_SEC:
+        return build_index(zone_id)
+    if _record_count(zone_id) != index["record_count"]:
+        print(f"Record count of {zone_id} changed, rebuilding index")
+        return build_index(zone_id)
+    return index
+
+def invalidate(zone_id=None):
+    with _lock:
+        if zone_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(zone_id, None)
+
+def _fetch_record(zone_id, key):
+    """索引のレコードが今も同じかを1件だけ取り直して確認する（ゾーン全体は読まない）"""
+    name, rtype, set_id = key
+    params = {"HostedZoneId": zone_id, "StartRecordName": name, "StartRecordType": rtype, "MaxItems": "1"}
+    if set_id is not None:
+        params["StartRecordIdentifier"] = set_id
+    resp = route53.list_resource_record_sets(**params)
+    for rrset in resp["ResourceRecordSets"]:
+        if _record_key(rrset) == key:
+            return rrset
+    return None
+
+def _lookup(zone_id, index, old_ips):
+    """旧 IP を含むレコードを索引から探し、現物と照合した最新の rrset を返す。食い違い・見つからない IP があれば None"""
+    found = {}
+    for ip in old_ips:
+        keys = index["by_ip"].get(ip)
+        if not keys:
+            return None
+        for key in keys:
+            if key in found:
+                continue
+            current = _fetch_record(zone_id, key)
+            if current is None or ip not in _values(current):
+                return None
+            found[key] = current
+    return found
+
+class RecordsNotFoundError(RuntimeError):
+    """旧 IP を持つレコードがゾーンに見つからない"""
+
+def plan_changes(zone_id, replacements, allow_missing=False):
+    """置換（旧 IP → 新 IP）に該当するレコードの UPSERT 一覧を返す"""
+    mapping = {r["OldIp"]: r["NewIp"] for r in replacements if r.get("OldIp") and r.get("NewIp")}
+    index = get_index(zone_id)
+    found = _lookup(zone_id, index, mapping)
+    if found is None:
+        # 索引が古い（他経路で値が変わった）ので作り直して再検索
+        index = build_index(zone_id)
+        missing = [ip for ip in mapping if not index["by_ip"].get(ip)]
+        if missing and not allow_missing:
+            raise RecordsNotFoundError(f"No A/AAAA records in {zone_id} for old IPs: {missing}")
+        found = _lookup(zone_id, index, [ip for ip in mapping if ip not in missing])
+        if found is None:
+            # 作り直した直後にまた書き換わった。ステップの再実行に任せる
+            raise RuntimeError(f"Records in {zone_id} changed while planning; retry")
+
+    changes = []
+    for rrset in found.values():
+        new_rrset = dict(rrset)
+        new_values = list(dict.fromkeys(mapping.get(v, v) for v in _values(rrset)))
+        new_rrset["ResourceRecords"] = [{"Value": v} for v in new_values]
+        changes.append({"Action": "UPSERT", "ResourceRecordSet": new_rrset})
+    return index, changes
+
+def _apply_to_index(zone_id, index, changes):
+    """自分で行った変更を索引に反映する（作り直しを避ける）"""
+    with _lock:
+        for c in changes:
+            rrset = c["ResourceRecordSet"]
+            key = _record_key(rrset)
+            old = index["records"].get(key)
+            for ip in _values(old or {}):
+                index["by_ip"].get(ip, set()).discard(key)
+            index["records"][key] = rrset
+            for ip in _values(rrset):
+                index["by_ip"].setdefault(ip, set()).add(key)
+        _indexes[zone_id] = index
+
+def wait_insync(change_ids, timeout=WAIT_TIMEOUT_SEC):
+    """すべての変更が INSYNC になるまで待つ（最初は短く、以降は指数バックオフ + ジッター）"""
+    deadline = time.monotonic() + timeout
+    pending = set(change_ids)
+    delay = WAIT_FIRST_SEC
+    while pending:
+        for cid in list(pending):
+            if route53.get_change(Id=cid)["ChangeInfo"]["Status"] == "INSYNC":
+                pending.discard(cid)
+        if not pending:
+            return True
+        if time.monotonic() + delay > deadline:
+            return False
+        time.sleep(delay * random.uniform(0.5, 1.0))
+        delay = min(delay * 2, WAIT_MAX_SEC)
+    return True
+
+def update_records(zone_id, replacements, wait=False, allow_missing=False):
+    started = time.monotonic()
+    index, changes = plan_changes(zone_id, replacements, allow_missing)
+    change_ids = []
+    for i in range(0, len(changes), CHANGE_BATCH_SIZE):
+        batch = changes[i:i + CHANGE_BATCH_SIZE]
+        resp = route53.change_resource_record_sets(
+            HostedZoneId=zone_id,
+            ChangeBatch={"Comment": "failover", "Changes": batch}
+        )
+        change_id = resp["ChangeInfo"]["Id"]
+        change_ids.append(change_id)
+        _apply_to_index(zone_id, index, batch)
+
+    insync = wait_insync(change_ids) if (wait and change_ids) else None
+    return {
+        "HostedZoneId": zone_id,
+        "HasChanges": bool(changes),
+        "Changed": [{"Name": c["ResourceRecordSet"]["Name"], "Type": c["ResourceRecordSet"]["Type"],
+                     "SetIdentifier": c["ResourceRecordSet"].get("SetIdentifier")} for c in changes],
+        "ChangeIds": change_ids,
+        "InSync": insync,
+        "ElapsedMs": int((time.monotonic() - started) * 1000),
+    }
+
+def lambda_handler_update_records(event, _context):
+    zone_id = event["HostedZoneId"]
+    replacements = event.get("Replacements") or [{"OldIp": event.get("OldIp"), "NewIp": event.get("NewIp")}]
+    wait = str(event.get("Wait", "false")).lower() == "true"
+    allow_missing = str(event.get("AllowMissing", "false")).lower() == "true"
+    result = update_records(zone_id, replacements, wait=wait, allow_missing=allow_missing)
+    print(result)
+    return result
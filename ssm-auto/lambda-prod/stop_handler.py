@@ -1,11 +1,17 @@
-import boto3, os
+import warm_cache
 
-ssm = boto3.client("ssm")
-ec2 = boto3.client("ec2")
+# event_router のルート名。統合時は STOP__<変数名> で同名の変数を上書きできる
+ROUTE = "stop"
 
-DOC   = os.environ["AUTOMATION_DOC"]
-P_IID = os.environ["PARAM_KEY_INSTANCE_ID"]
-P_ALM = os.environ["PARAM_KEY_ALARM_NAME"]
+def _env(name, *default):
+    return warm_cache.setting(ROUTE, name, *default)
+
+ssm = warm_cache.client("ssm")
+ec2 = warm_cache.client("ec2")
+
+DOC   = _env("AUTOMATION_DOC")
+P_IID = _env("PARAM_KEY_INSTANCE_ID")
+P_ALM = _env("PARAM_KEY_ALARM_NAME")
 TAG_KEY = "RelatedAlarmName"
 
 def lambda_handler(event, _):
@@ -13,21 +19,25 @@ def lambda_handler(event, _):
     if not iid:
         return {"status": "error", "reason": "no instance id"}
 
-    r = ec2.describe_tags(
-        Filters=[
-            {"Name": "resource-id", "Values": [iid]},
-            {"Name": "key", "Values": [TAG_KEY]}
-        ]
-    )
-    if not r["Tags"]:
-        return {"status": "skip", "reason": "no tag", "instanceId": iid}
+    def _load():
+        r = ec2.describe_tags(
+            Filters=[
+                {"Name": "resource-id", "Values": [iid]},
+                {"Name": "key", "Values": [TAG_KEY]}
+            ]
+        )
+        return r["Tags"][0]["Value"] if r["Tags"] else None
 
-    alarm_name = r["Tags"][0]["Value"]
+    # ウォームコンテナ内ではタグ値をキャッシュ（タグなしも短時間保持）
+    alarm_name = warm_cache.instance_tags.get_or_load((iid, TAG_KEY), _load)
+    if not alarm_name:
+        return {"status": "skip", "reason": "no tag", "instanceId": iid}
 
     resp = ssm.start_automation_execution(
         DocumentName=DOC,
         Parameters={P_IID: [iid], P_ALM: [alarm_name]},
         ClientToken=event.get("id", iid)
     )
+    warm_cache.invalidate_instance(iid)
 
     return {"status": "started", "instanceId": iid, "alarmName": alarm_name}
@@ -0,0 +1,117 @@
+# target_waiter.py
+# ターゲットグループからの登録解除 / 登録（healthy）を待つ共通処理。
+# ランブック（ssm-auto/ssm の waitForDeregistration / waitForRegistration）から
+# aws:invokeLambdaFunction で呼び出す。
+#
+# 従来の while True + time.sleep(15) との違い:
+# - 対象ターゲットだけを describe_target_health（Targets 指定）で確認する
+# - 最初は短い間隔で確認し、以降は指数バックオフ（ジッター付き）。間隔は WAITER_MAX_DELAY_SEC まで
+# - ターゲットグループの deregistration_delay.timeout_seconds（登録解除）や
+#   ヘルスチェック間隔 × 正常しきい値（登録）から完了見込み時刻を出し、その直後に確認が来るよう待ち時間を調整する
+# - 複数ターゲットグループ・複数ターゲットを1回の呼び出しでまとめて待つ
+# - 期限（TimeoutSeconds）を過ぎたら例外にしてステップを失敗させる（無限ループしない）
+#
+# 受け取り（Payload）:
+# {
+#   "Action": "deregistered" | "healthy",
+#   "Targets": [{"TargetGroupArn": "arn:...", "InstanceId": "i-..."}, ...],
+#   "TimeoutSeconds": 300
+# }
+
+import os
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+
+_boto_config = Config(retries={"max_attempts": 10, "mode": "adaptive"})
+elbv2 = boto3.client("elbv2", config=_boto_config)
+
+FIRST_DELAY_SEC = float(os.environ.get("WAITER_FIRST_DELAY_SEC", "1"))
+MAX_DELAY_SEC   = float(os.environ.get("WAITER_MAX_DELAY_SEC", "10"))
+DEFAULT_TIMEOUT_SEC = int(os.environ.get("WAITER_TIMEOUT_SEC", "290"))  # ステップの timeoutSeconds より少し短く
+MAX_WORKERS     = int(os.environ.get("WAITER_MAX_WORKERS", "8"))
+
+def _target_state(tg_arn, iid):
+    """(状態, 理由)。登録されていなければ ("unused", "Target.NotRegistered")"""
+    resp = elbv2.describe_target_health(TargetGroupArn=tg_arn, Targets=[{"Id": iid}])
+    for d in resp.get("TargetHealthDescriptions", []):
+        if d["Target"]["Id"] == iid:
+            health = d.get("TargetHealth", {})
+            return health.get("State"), health.get("Reason")
+    return "unused", "Target.NotRegistered"
+
+def _is_done(action, state, reason):
+    if action == "deregistered":
+        return state == "unused" and reason in (None, "Target.NotRegistered")
+    return state == "healthy"
+
+def expected_seconds(action, tg_arn):
+    """完了までの見込み秒数（ターゲットグループの設定から）"""
+    if action == "deregistered":
+        attrs = elbv2.describe_target_group_attributes(TargetGroupArn=tg_arn)["Attributes"]
+        return next((int(a["Value"]) for a in attrs
+                     if a["Key"] == "deregistration_delay.timeout_seconds"), 300)
+    tg = elbv2.describe_target_groups(TargetGroupArns=[tg_arn])["TargetGroups"][0]
+    return tg.get("HealthCheckIntervalSeconds", 30) * tg.get("HealthyThresholdCount", 5)
+
+def _next_delay(delay, now, eta):
+    """バックオフした待ち時間。完了見込み時刻をまたぐ場合は見込み時刻の直後に確認する"""
+    wait = delay * random.uniform(0.5, 1.0)
+    if now < eta < now + wait:
+        wait = max(eta - now + 0.5, FIRST_DELAY_SEC)
+    return wait
+
+def wait_for_targets(action, targets, timeout=DEFAULT_TIMEOUT_SEC):
+    """
+    targets（TargetGroupArn / InstanceId の組）がすべて action の状態になるまで待つ。
+    戻り値は各ターゲットの結果（所要ミリ秒・確認回数・最後の状態）。期限切れは TimeoutError。
+    """
+    if action not in ("deregistered", "healthy"):
+        raise ValueError(f"unknown action: {action}")
+    started = time.monotonic()
+    deadline = started + timeout
+
+    pending = {(t["TargetGroupArn"], t["InstanceId"]): {"polls": 0, "state": None}
+               for t in targets}
+    tg_arns = list(dict.fromkeys(tg for tg, _ in pending))
+    workers = max(1, min(MAX_WORKERS, len(pending)))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        etas = dict(zip(tg_arns, ex.map(lambda tg: started + expected_seconds(action, tg), tg_arns)))
+
+        results = {}
+        delay = FIRST_DELAY_SEC
+        while pending:
+            keys = list(pending)
+            for key, (state, reason) in zip(keys, ex.map(lambda k: _target_state(*k), keys)):
+                info = pending[key]
+                info["polls"] += 1
+                info["state"] = state
+                if _is_done(action, state, reason):
+                    info["elapsedMs"] = int((time.monotonic() - started) * 1000)
+                    results[key] = pending.pop(key)
+            if not pending:
+                break
+            now = time.monotonic()
+            if now >= deadline:
+                waiting = [{"TargetGroupArn": tg, "InstanceId": iid, "state": i["state"]}
+                           for (tg, iid), i in pending.items()]
+                raise TimeoutError(f"Timed out waiting for targets to be {action}: {waiting}")
+            eta = min(etas[tg] for tg, _ in pending)
+            time.sleep(min(_next_delay(delay, now, eta), deadline - now))
+            delay = min(delay * 2, MAX_DELAY_SEC)
+
+    return [{"TargetGroupArn": tg, "InstanceId": iid, **info} for (tg, iid), info in results.items()]
+
+def lambda_handler_wait_targets(event, _context):
+    action = event.get("Action", "healthy")
+    targets = event.get("Targets") or [{"TargetGroupArn": event["TargetGroupArn"],
+                                        "InstanceId": event["InstanceId"]}]
+    timeout = int(event.get("TimeoutSeconds") or DEFAULT_TIMEOUT_SEC)
+    started = time.monotonic()
+    results = wait_for_targets(action, targets, timeout)
+    result = {"ok": True, "action": action, "results": results,
+              "elapsedMs": int((time.monotonic() - started) * 1000)}
+    print(result)
+    return result
@@ -1,8 +1,16 @@
 # update_alarms.py
 import os
+import time
+import random
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-cw = boto3.client("cloudwatch")
+# adaptive: スロットリング時にクライアント側で送信レートを自動で絞る
+_boto_config = Config(retries={"max_attempts": 10, "mode": "adaptive"})
+cw  = boto3.client("cloudwatch", config=_boto_config)
+rgt = boto3.client("resourcegroupstaggingapi", config=_boto_config)
 
 # === 受け取りは SSM から（Payload で飛んでくる想定） ===
 # {
@@ -12,30 +20,51 @@ cw = boto3.client("cloudwatch")
 # }
 
 TAG_KEY_FOR_ALARM = os.environ.get("ALARM_TAG_KEY", "RelatedAlarmName")
+# PutMetricAlarm の並列数（CloudWatch の TPS 上限を超えないよう小さめに）
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "8"))
+# DescribeAlarms の AlarmNames 上限
+DESCRIBE_BATCH_SIZE = 100
+# スロットリング時の再試行（adaptive リトライで吸収しきれなかった分）
+MAX_THROTTLE_RETRIES = int(os.environ.get("MAX_THROTTLE_RETRIES", "5"))
+THROTTLE_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException")
 
 def list_alarms_by_tag_value(tag_value: str) -> list[str]:
     """タグ Key=RelatedAlarmName, Value=tag_value を持つアラーム名を列挙"""
-    # CloudWatch リソースタグは ListTagsForResource で個別に引く必要があるため、
-    # ここでは DescribeAlarms で全部一覧→フィルタ、が簡単（数が多いなら工夫）
+    # Resource Groups Tagging API でタグ一致分だけを取得（全アラームの ListTagsForResource は不要）
     names = []
-    paginator = cw.get_paginator("describe_alarms")
-    for page in paginator.paginate():
-        for a in page.get("MetricAlarms", []):
-            arn = a.get("AlarmArn")
-            if not arn:
-                continue
-            tags = cw.list_tags_for_resource(ResourceARN=arn).get("Tags", [])
-            if any(t["Key"] == TAG_KEY_FOR_ALARM and t["Value"] == tag_value for t in tags):
-                names.append(a["AlarmName"])
+    paginator = rgt.get_paginator("get_resources")
+    for page in paginator.paginate(
+        ResourceTypeFilters=["cloudwatch:alarm"],
+        TagFilters=[{"Key": TAG_KEY_FOR_ALARM, "Values": [tag_value]}]
+    ):
+        for m in page.get("ResourceTagMappingList", []):
+            # arn:aws:cloudwatch:region:acct:alarm:AlarmName
+            names.append(m["ResourceARN"].split(":alarm:", 1)[1])
     return names
 
-def update_alarm_instance_dimension(alarm_name: str, old_iid: str, new_iid: str) -> bool:
-    """該当アラームの Dimensions.InstanceId = old → new に置換し PutMetricAlarm"""
-    r = cw.describe_alarms(AlarmNames=[alarm_name])
-    if not r.get("MetricAlarms"):
-        return False
-    alarm = r["MetricAlarms"][0]
+def describe_metric_alarms(names: list[str]) -> dict:
+    """アラーム定義を 100 件ずつまとめて取得し、名前 → 定義の dict で返す"""
+    alarms = {}
+    for i in range(0, len(names), DESCRIBE_BATCH_SIZE):
+        batch = names[i:i + DESCRIBE_BATCH_SIZE]
+        paginator = cw.get_paginator("describe_alarms")
+        for page in paginator.paginate(AlarmNames=batch, AlarmTypes=["MetricAlarm"]):
+            for a in page.get("MetricAlarms", []):
+                alarms[a["AlarmName"]] = a
+    return alarms
+
+def _call_with_backoff(func, **kwargs):
+    """スロットリング系エラーのみ指数バックオフ（ジッター付き）で再試行"""
+    for attempt in range(MAX_THROTTLE_RETRIES + 1):
+        try:
+            return func(**kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in THROTTLE_CODES or attempt == MAX_THROTTLE_RETRIES:
+                raise
+            time.sleep(min(10, 0.2 * (2 ** attempt)) * random.uniform(0.5, 1.0))
 
+def update_alarm_instance_dimension(alarm: dict, old_iid: str, new_iid: str) -> bool:
+    """該当アラームの Dimensions.InstanceId = old → new に置換し PutMetricAlarm"""
     dims = alarm.get("Dimensions", [])
     changed = False
     for d in dims:
@@ -66,7 +95,7 @@ def update_alarm_instance_dimension(alarm_name: str, old_iid: str, new_iid: str)
     }
     # optional の None を削る
     put_args = {k:v for k,v in put_args.items() if v is not None}
-    cw.put_metric_alarm(**put_args)
+    _call_with_backoff(cw.put_metric_alarm, **put_args)
     return True
 
 def lambda_handler_update_alarms(event, _context):
@@ -75,14 +104,32 @@ def lambda_handler_update_alarms(event, _context):
     new_iid  = event["NewInstanceId"]
 
     names = list_alarms_by_tag_value(related)
+    alarms = describe_metric_alarms(names)
+
     updated = []
-    skipped = []
+    skipped = [name for name in names if name not in alarms]  # 複合アラーム・削除済み
+    errors = []
+
+    def _update(name):
+        try:
+            return name, update_alarm_instance_dimension(alarms[name], old_iid, new_iid), None
+        except Exception as e:
+            return name, False, str(e)
+
+    targets = [name for name in names if name in alarms]
+    if targets:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(targets))) as executor:
+            for name, changed, error in executor.map(_update, targets):
+                if error:
+                    errors.append({"alarm": name, "error": error})
+                elif changed:
+                    updated.append(name)
+                else:
+                    skipped.append(name)
 
-    for name in names:
-        if update_alarm_instance_dimension(name, old_iid, new_iid):
-            updated.append(name)
-        else:
-            skipped.append(name)
+    if errors:
+        # 従来どおり Lambda をエラー終了させ、Automation のステップを失敗扱いにする
+        raise RuntimeError(f"failed to update {len(errors)} alarms (updated={len(updated)}): {errors}")
 
     return {
         "status": "done",
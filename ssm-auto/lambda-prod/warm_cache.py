@@ -0,0 +1,147 @@
+# warm_cache.py
+# ウォームコンテナ間で使い回すモジュールレベルの TTL + LRU キャッシュ。
+# 同じインスタンス / 複合アラームが短時間に何度も発火しても、
+# describe_tags / describe_instances / describe_alarms を毎回呼ばないようにする。
+#
+# - 値は TTL（秒）経過で失効。上限件数を超えたら最も古く使われたものから捨てる
+# - 「見つからなかった」結果（None）も短い TTL でキャッシュする（ネガティブキャッシュ）
+# - フェイルオーバーでインスタンスIDが変わる場合は invalidate / invalidate_where で明示的に消す
+# - boto3 クライアントも client() で初回利用時に1つだけ作り、同じコンテナ内のハンドラで共有する
+#
+# 各 Lambda のデプロイパッケージに本ファイルを同梱する（または Lambda レイヤーに入れる）。
+
+import os
+import time
+import threading
+from collections import OrderedDict
+import boto3
+
+DEFAULT_TTL_SEC          = int(os.environ.get("CACHE_TTL_SEC", "300"))
+DEFAULT_NEGATIVE_TTL_SEC = int(os.environ.get("NEGATIVE_CACHE_TTL_SEC", "60"))
+DEFAULT_MAX_ENTRIES      = int(os.environ.get("CACHE_MAX_ENTRIES", "1024"))
+# フェイルオーバーを開始したインスタンスを「退役中」として覚えておく秒数。
+# ランブックが子アラームを書き換えるまで（起動待ちなどで数分〜十数分）をカバーする長さにする
+RETIRED_INSTANCE_TTL_SEC = int(os.environ.get("RETIRED_INSTANCE_TTL_SEC", "1800"))
+
+_MISSING = object()
+
+class TTLCache:
+    def __init__(self, ttl=DEFAULT_TTL_SEC, negative_ttl=DEFAULT_NEGATIVE_TTL_SEC, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """有効な値があれば返す。なければ default"""
+        value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def _lookup(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+        return _MISSING
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """キャッシュになければ loader() を呼んで結果（None も含む）を保存して返す"""
+        value = self._lookup(key)
+        if value is not _MISSING:
+            return value
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """predicate(key, value) が True のエントリをすべて消す"""
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if predicate(k, v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+# 用途別の共有キャッシュ（同じコンテナ内のハンドラで共有）
+instance_tags = TTLCache()   # (instance_id, tag_key) -> タグ値 or None
+alarm_targets = TTLCache()   # 子アラーム名 -> InstanceId or None
+retired_instances = TTLCache(ttl=RETIRED_INSTANCE_TTL_SEC)   # フェイルオーバー中の旧 InstanceId -> True
+
+def invalidate_instance(instance_id):
+    """
+    フェイルオーバー開始時に呼ぶ。子アラームの InstanceId は新インスタンスに書き換わるので、
+    旧インスタンスを指しているエントリを消し、退役中として記録する。
+    ランブックが子アラームを書き換える前にアラームが揺れて旧 InstanceId が読まれても、
+    退役中の間は alarm_targets に入れない（put_alarm_target / get_alarm_target を使う）。
+    （旧インスタンス自身のタグは変わらないので instance_tags は残し、同じ停止イベントの連打を吸収する）
+    """
+    retired_instances.put(instance_id, True)
+    alarm_targets.invalidate_where(lambda _k, v: v == instance_id)
+
+def is_retired(instance_id):
+    return instance_id is not None and retired_instances.get(instance_id, False)
+
+def get_alarm_target(alarm_name, default=None):
+    """子アラーム名 -> InstanceId。退役中のインスタンスを指すエントリはないものとして扱う"""
+    value = alarm_targets.get(alarm_name, _MISSING)
+    if value is _MISSING or is_retired(value):
+        return default
+    return value
+
+def put_alarm_target(alarm_name, instance_id):
+    """退役中のインスタンス（書き換え前の子アラーム）はキャッシュしない"""
+    if is_retired(instance_id):
+        alarm_targets.invalidate(alarm_name)
+        return
+    alarm_targets.put(alarm_name, instance_id)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client(service, **kwargs):
+    """boto3 クライアントを (サービス名, 引数) ごとに1つだけ作って使い回す"""
+    key = (service, tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        c = _clients.get(key)
+        if c is None:
+            c = _clients[key] = boto3.client(service, **kwargs)
+    return c
+
+def setting(route, name, default=_MISSING):
+    """環境変数を読む。統合ルーター（event_router）で同名の変数をハンドラごとに分けられるよう、
+    <ROUTE>__<NAME>（ルート名の大文字）があればそちらを優先する。default 省略時は未設定で KeyError"""
+    value = os.environ.get(f"{route.upper()}__{name}")
+    if value is not None:
+        return value
+    if default is _MISSING:
+        return os.environ[name]
+    return os.environ.get(name, default)
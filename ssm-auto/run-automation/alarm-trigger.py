@@ -6,19 +6,18 @@
 	•	DEDUP_TTL_SEC = 900
 
 2) 追記するIAM
-	•	dynamodb:PutItem を ec2-events-dedup テーブルに許可
+	•	dynamodb:PutItem / dynamodb:UpdateItem を ec2-events-dedup テーブルに許可
 （既存のCW/SSM/Logs許可は流用）
 
 3) 追記するコード（alarm_handler.py）
 
 以下を既存にマージ。関数名は衝突しない。
 
-# === 追加 import ===
-import time
-from botocore.exceptions import ClientError
+# === 追加 import ===（lease_lock.py を同梱）
+from lease_lock import LeaseLock
 
-# === 追加 クライアント/テーブル ===
-ddb = boto3.resource("dynamodb").Table(os.environ["DEDUP_TABLE"])
+# === 追加 ロック ===
+locks = LeaseLock(os.environ["DEDUP_TABLE"], int(os.environ.get("DEDUP_TTL_SEC","900")))
 
 # === 追加 環境変数 ===
 TAG_KEY        = os.environ["TAG_KEY"]                 # 例: FailoverGroup
@@ -32,16 +31,8 @@ def get_group_from_instance(iid: str) -> str | None:
     return tags.get(TAG_KEY)
 
 # === 追加: DynamoDBロック ===
-def acquire_lock(key: str) -> bool:
-    now = int(time.time())
-    try:
-        ddb.put_item(
-            Item={"k": key, "ttl": now + DEDUP_TTL_SEC, "ts": now},
-            ConditionExpression="attribute_not_exists(k)"
-        )
-        return True
-    except ClientError:
-        return False
+# 期限（expires_at）を条件式で判定するリース型ロック。TTL削除の遅れに影響されない。
+# 完了時は ssm_automation_notifier が ExecutionId 指定で解放する。
 
 4) 既存ハンドラへの組み込みポイント
 
@@ -60,7 +51,8 @@ def lambda_handler_alarm(event, _context):
         return {"status": "ignored_no_group", "instanceId": iid, "alarm": composite_name}
 
     # === 追加: DynamoDBで排他（グループ単位の一回のみ）===
-    if not acquire_lock(group):
+    lease = locks.acquire(group, owner=_context.aws_request_id)
+    if not lease:
         return {"status": "skipped_dedup", "group": group, "instanceId": iid, "alarm": composite_name}
 
     # === 既存: SSM 起動（必要ならGroupも渡す）===
@@ -75,6 +67,7 @@ def lambda_handler_alarm(event, _context):
         Parameters=params,
         ClientToken=event.get("id")  # 既存の冪等トークン
     )
+    locks.attach(group, lease["token"], resp["AutomationExecutionId"])
     return {
         "status": "started",
         "instanceId": iid,
@@ -85,7 +78,7 @@ def lambda_handler_alarm(event, _context):
     }
 
 5) 注意点
-	•	TTLはオートメーション想定時間+余裕に合わせる。短すぎると再実行、長すぎると必要な再起動もブロック。初期値900秒で開始、実測で調整。
+	•	DEDUP_TTL_SEC はリース期間。オートメーション完了時に解放されるので、長めにしても再実行はブロックしない（通知Lambdaが落ちた場合の上限）。長いランブックは lease_lock.lambda_handler（action=renew）で延長する。
 	•	キーはタグ値。同じグループの別EC2でも一度きりにしたい要件を満たす。インスタンス単位にしたい場合は key = f"{group}:{iid}" に変更。
 	•	タグ未設定は即スキップしログへ。運用でタグの付与を徹底。
 	•	例外処理は最小化。ConditionalCheckFailed は exceptでまとめてFalse返しで十分（詳細な内訳が要るならコードで分岐）。
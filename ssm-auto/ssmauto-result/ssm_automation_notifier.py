@@ -1,8 +1,53 @@
-import os, boto3, json
+import os, time, boto3, json
 
 ssm = boto3.client("ssm")
 sns = boto3.client("sns")
 TOPIC = os.environ["SNS_TOPIC_ARN"]
+# ec2-stop-reboot のグループロックを完了時に解放する（LOCK_TABLE / DEDUP_TABLE 未設定なら何もしない）
+LOCK_TABLE = os.environ.get("LOCK_TABLE") or os.environ.get("DEDUP_TABLE")
+P_GRP      = os.environ.get("PARAM_KEY_GROUP", "Group")
+FINAL_STATUSES = {"Success", "Failed", "TimedOut", "Cancelled", "CompletedWithSuccess", "CompletedWithFailure"}
+
+# フェーズ別所要時間のメトリクス（CloudWatch Embedded Metric Format でログに出す）
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SsmAuto/Failover")
+# フェーズ名 -> ランブック（ssm-auto/ssm）のステップ名
+PHASES = {
+    "Lookup":       ["getLaunchTemplateId", "getOtherAZLaunchTemplateId", "getTargetGroupName", "getBackupTag",
+                     "getBackupVaultName", "getAmiArn", "extractAmiId", "getLaunchTemplateParameterName",
+                     "putLaunchTemplateParameter", "getTargetGroupArn", "getInstanceIp", "getInstanceState",
+                     "parallelLookups"],
+    "Deregister":   ["deregisterTarget", "renewLeaseBeforeDeregistration", "waitForDeregistration"],
+    "Stop":         ["stopInstance", "renewLeaseBeforeStop", "waitForStop"],
+    "RunInstances": ["runInstances", "sleep", "renewLeaseBeforeRunning", "waitForInstanceRunning"],
+    "AlarmRewrite": ["updateChildAlarmsByLambda"],
+    "Register":     ["registerTarget", "renewLeaseBeforeRegistration", "waitForRegistration"],
+    "Route53":      ["getNewInstanceIp", "modifyRecordSets"],
+    "Backup":       ["startBackup", "renewLeaseBeforeBackup", "waitForBackupCompletion"],
+}
+# ここまで終われば利用者から見た復旧とみなす（RTO の終点）
+RECOVERY_STEPS = {"waitForRegistration", "modifyRecordSets", "registerTarget", "waitForInstanceRunning"}
+
+_locks = None
+
+def _get_locks():
+    global _locks
+    if _locks is None:
+        # 共通モジュールの Lambda レイヤー（LOCK_TABLE を設定する場合のみ必要）
+        from lease_lock import LeaseLock
+        _locks = LeaseLock(LOCK_TABLE)
+    return _locks
+
+def _release_group_lock(params, exec_id, status):
+    """このオートメーションが保持しているグループロックを解放する（別の実行が取り直したものは触らない）"""
+    group = (params.get(P_GRP) or [None])[0]
+    if not LOCK_TABLE or not group or status not in FINAL_STATUSES:
+        return None
+    try:
+        return _get_locks().release(group, execution_id=exec_id)
+    except Exception as e:
+        # 通知は止めない。ロックはリース期限で自然に解放される
+        print(f"Failed to release lock {group}: {e}")
+        return False
 
 def _get_new_instance_id(steps):
     for s in steps:
@@ -19,6 +64,63 @@ def _get_failed_step(steps):
             return s.get("StepName") or "<unknown>", (s.get("FailureMessage") or s.get("Response") or "<none>")
     return "<unknown>", "<none>"
 
+def _step_durations(steps):
+    """ステップ名 -> (開始, 終了, 所要ミリ秒)。実行されなかったステップ（分岐でスキップ）は含めない"""
+    out = {}
+    for st in steps:
+        start, end = st.get("ExecutionStartTime"), st.get("ExecutionEndTime")
+        if start and end:
+            out[st["StepName"]] = (start, end, int((end - start).total_seconds() * 1000))
+    return out
+
+def _emf(dimensions, values, metrics, unit="Milliseconds"):
+    """EMF 形式の1レコード（print すると CloudWatch Logs がメトリクスとして取り込む）"""
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": dimensions,
+                "Metrics": [{"Name": name, "Unit": unit} for name in metrics],
+            }],
+        },
+        **values,
+        **metrics,
+    }
+
+def emit_phase_metrics(ae, steps, doc, group, status):
+    """フェーズ別・ステップ別の所要時間と RTO を EMF で出力し、出力した値を返す"""
+    durations = _step_durations(steps)
+    dims = {"Document": doc, "FailoverGroup": group}
+
+    phase_ms = {}
+    for phase, names in PHASES.items():
+        ms = sum(durations[n][2] for n in names if n in durations)
+        if any(n in durations for n in names):
+            phase_ms[f"{phase}Duration"] = ms
+
+    metrics = dict(phase_ms)
+    exec_start, exec_end = ae.get("ExecutionStartTime"), ae.get("ExecutionEndTime")
+    if exec_start and exec_end:
+        metrics["AutomationDuration"] = int((exec_end - exec_start).total_seconds() * 1000)
+    # 並列参照ステップが出力した「逐次に呼んだ場合との差」
+    for st in steps:
+        if st.get("StepName") == "parallelLookups":
+            saved = ((st.get("Outputs") or {}).get("SavedMs") or [None])[0]
+            if saved is not None:
+                metrics["LookupParallelSaved"] = int(float(saved))
+    recovered = [durations[n][1] for n in RECOVERY_STEPS if n in durations]
+    if status == "Success" and exec_start and recovered:
+        # 起動からトラフィックが新インスタンスに戻るまで（バックアップ待ちは含めない）
+        metrics["RTO"] = int((max(recovered) - exec_start).total_seconds() * 1000)
+
+    records = [_emf([["Document", "FailoverGroup"], ["Document"]], {**dims, "Status": status}, metrics)]
+    for name, (_s, _e, ms) in durations.items():
+        records.append(_emf([["Document", "StepName"]], {"Document": doc, "StepName": name}, {"StepDuration": ms}))
+    for r in records:
+        print(json.dumps(r, ensure_ascii=False))
+    return metrics
+
 def lambda_handler(event, _):
     # イベント必須項目
     d = event.get("detail", {})
@@ -41,6 +143,9 @@ def lambda_handler(event, _):
     # 追加パラメータ
     failover = (params.get("failover") or ["<unknown>"])[0]
 
+    # グループロック解放（次のフェイルオーバーをすぐ受け付けられるようにする）
+    lock_released = _release_group_lock(params, exec_id, status)
+
     # 旧/新インスタンスID
     # 成功時の旧IDは UnhealthyInstanceId のみ
     old_iid_success = (params.get("UnhealthyInstanceId") or ["<unknown>"])[0]
@@ -53,6 +158,14 @@ def lambda_handler(event, _):
         ReverseOrder=True
     ).get("StepExecutions", [])
 
+    # フェーズ別の所要時間（どのフェーズを短縮すべきかの計測用）
+    group = (params.get(P_GRP) or params.get("AlarmName") or [failover])[0]
+    try:
+        timings = emit_phase_metrics(ae, steps, doc, group, status)
+    except Exception as e:
+        print(f"Failed to emit phase metrics: {e}")
+        timings = {}
+
     if status == "Success":
         new_iid = _get_new_instance_id(steps)
         lines = [
@@ -62,6 +175,7 @@ def lambda_handler(event, _):
             f"ExecutionId : {exec_id}",
             f"旧インスタンスID : {old_iid_success}",
             f"新インスタンスID : {new_iid}",
+            f"RTO : {timings['RTO'] / 1000:.1f}s" if "RTO" in timings else "RTO : <unknown>",
             f"region/account : {region}/{account}",
             f"Start/End : {start_t} / {end_t}",
             f"EventTime : {evt_time}",
@@ -101,4 +215,5 @@ def lambda_handler(event, _):
         Subject=subject[:100],
         Message="\n".join(lines)
     )
-    return {"ok": True, "status": status, "subject": subject}
+    return {"ok": True, "status": status, "subject": subject, "lockReleased": lock_released,
+            "timings": timings}